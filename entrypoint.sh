@@ -2,6 +2,12 @@
 
 cd /nalkinscloud-api
 
+# Worker containers pass a management command (for example 'send_emails'), migrations are run by the API container
+if [ $# -gt 0 ]; then
+    echo "Start worker: manage.py $*" 2>&1
+    exec python manage.py "$@"
+fi
+
 echo "#######################" 2>&1
 echo "Start Models Migrations" 2>&1
 echo "#######################" 2>&1
@@ -13,6 +19,11 @@ python manage.py migrate
 #echo "####################" 2>&1
 #python manage.py collectstatic --no-input
 
+# Metrics of all gunicorn workers are aggregated through this directory, values of a previous run are dropped
+export PROMETHEUS_MULTIPROC_DIR=${PROMETHEUS_MULTIPROC_DIR:-/tmp/prometheus-metrics}
+rm -rf "$PROMETHEUS_MULTIPROC_DIR"
+mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+
 echo "#####################" 2>&1
 echo "Start Gunicorn server" 2>&1
 echo "#####################" 2>&1
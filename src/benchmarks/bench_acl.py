@@ -0,0 +1,84 @@
+# Compare compiled topic trie (nalkinscloud_mosquitto.acl) against a linear scan over the access list,
+# for a single device holding thousands of rules, usage:
+# python -m benchmarks.bench_acl --rules 5000 --output acl_results.json
+import argparse
+import random
+
+from benchmarks.utils import setup_django, benchmark, print_results, write_results
+
+setup_django()
+
+from nalkinscloud_mosquitto.acl import TopicTrie  # noqa: E402
+from nalkinscloud_mosquitto.functions import topic_matches_pattern  # noqa: E402
+
+
+def generate_rules(count):
+    """
+    Generate access list rules in the shapes the API writes ('device_id/#')
+    and the shapes used by shared / hand written access lists
+    """
+    rules = []
+    for index in range(count):
+        shape = index % 4
+        if shape == 0:
+            rules.append(('device_%d/#' % index, 2))
+        elif shape == 1:
+            rules.append(('device_%d/+/switch' % index, 2))
+        elif shape == 2:
+            rules.append(('user_%d/device_%d/temperature' % (index, index), 1))
+        else:
+            rules.append(('site_%d/+/+/humidity' % index, 1))
+    return rules
+
+
+def linear_max_rw(rules, topic):
+    best = 0
+    for pattern, rw in rules:
+        if rw > best and topic_matches_pattern(pattern, topic):
+            best = rw
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ACL topic matching benchmark')
+    parser.add_argument('--rules', type=int, default=5000, help='Number of access list rules of the device')
+    parser.add_argument('--rounds', type=int, default=1000)
+    parser.add_argument('--output', help='Write json results to this path')
+    args = parser.parse_args()
+
+    rules = generate_rules(args.rules)
+    trie = TopicTrie()
+    for pattern, rw in rules:
+        trie.insert(pattern, rw)
+
+    randomizer = random.Random(0)
+    last = args.rules - 1
+    topics = {
+        'hit_first_rule': 'device_0/temperature',
+        'hit_last_rule': 'site_%d/a/b/humidity' % (last - last % 4 + 3),
+        'hit_random_rule': 'device_%d/kitchen/switch' % (randomizer.randrange(args.rules // 4) * 4 + 1),
+        'miss': 'unknown_device/temperature',
+    }
+
+    results = []
+    for case, topic in sorted(topics.items()):
+        assert trie.max_rw(topic) == linear_max_rw(rules, topic), 'Trie and linear scan disagree on %s' % topic
+        results.append({'name': 'trie_%s' % case,
+                        'stats': benchmark(lambda: trie.max_rw(topic), rounds=args.rounds)})
+        results.append({'name': 'linear_%s' % case,
+                        'stats': benchmark(lambda: linear_max_rw(rules, topic), rounds=max(args.rounds // 10, 1))})
+
+    def compile_trie():
+        compiled = TopicTrie()
+        for rule_pattern, rule_rw in rules:
+            compiled.insert(rule_pattern, rule_rw)
+
+    results.append({'name': 'trie_compile', 'stats': benchmark(compile_trie, rounds=max(args.rounds // 100, 3))})
+
+    print_results(results)
+    if args.output:
+        write_results(args.output, 'acl', results, params={'rules': args.rules, 'rounds': args.rounds})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+# Measure messages ingestion throughput (nalkinscloud_mosquitto.ingestion) end to end,
+# messages are published by a local broker stand-in, received by the subscriber and written in batches
+# to a throwaway test database, compared against one INSERT per message, usage:
+# python -m benchmarks.bench_ingestion --messages 50000 --output ingestion_results.json
+import argparse
+import multiprocessing
+import time
+
+from benchmarks.utils import setup_django, write_results
+
+setup_django()
+
+from django.db import connection  # noqa: E402
+from django.utils import timezone  # noqa: E402
+
+from nalkinscloud_mosquitto.ingestion import MessageIngestor, MQTTMessageSubscriber  # noqa: E402
+from nalkinscloud_mosquitto.models import Device, DeviceModel, DeviceType, Message  # noqa: E402
+from nalkinscloud_mosquitto.testing import LocalMQTTBroker  # noqa: E402
+
+DEVICE_ID = 'bench_ingest_device'
+
+
+def run_broker(messages_count, port_queue, publish_event, stop_event):
+    """
+    Run the broker stand-in in its own process (like a real broker), so it does not share the GIL with the ingestor
+    """
+    broker = LocalMQTTBroker().start()
+    port_queue.put(broker.port)
+    broker.wait_for_subscriptions(1, timeout=30)
+    publish_event.wait()
+    for index in range(messages_count):
+        broker.publish('%s/temperature' % DEVICE_ID, str(index))
+    stop_event.wait()
+    broker.stop()
+
+
+def bench_ingestor(messages_count, batch_size, flush_interval):
+    port_queue = multiprocessing.Queue()
+    publish_event = multiprocessing.Event()
+    stop_event = multiprocessing.Event()
+    broker_process = multiprocessing.Process(target=run_broker,
+                                             args=(messages_count, port_queue, publish_event, stop_event))
+    broker_process.start()
+
+    ingestor = MessageIngestor(batch_size=batch_size, flush_interval=flush_interval)
+    subscriber = MQTTMessageSubscriber(ingestor, host='127.0.0.1', port=port_queue.get(), topic='#')
+    ingestor.start()
+    subscriber.start()
+    while not subscriber.client.is_connected():
+        time.sleep(0.01)
+    time.sleep(0.5)  # Let the subscription complete
+
+    start = time.monotonic()
+    publish_event.set()
+    while ingestor.written_count + ingestor.rejected_count + ingestor.failed_count < messages_count:
+        time.sleep(0.001)
+    duration = time.monotonic() - start
+
+    stop_event.set()
+    subscriber.stop()
+    ingestor.stop()
+    broker_process.join()
+    stats = ingestor.stats()
+    stats['messages_per_second'] = round(messages_count / duration)
+    return duration, stats
+
+
+def bench_single_inserts(messages_count):
+    start = time.monotonic()
+    for index in range(messages_count):
+        Message.objects.create(device_id=DEVICE_ID, topic='%s/temperature' % DEVICE_ID, message=str(index), qos=0,
+                               date_created=timezone.now())
+    return time.monotonic() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Messages ingestion benchmark')
+    parser.add_argument('--messages', type=int, default=50000)
+    parser.add_argument('--single-insert-messages', type=int, default=5000,
+                        help='Number of messages written with one INSERT each, as baseline')
+    parser.add_argument('--batch-size', type=int, default=2000)
+    parser.add_argument('--flush-interval', type=float, default=0.5)
+    parser.add_argument('--output', help='Write json results to this path')
+    args = parser.parse_args()
+
+    old_database_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0)
+    try:
+        Device.objects.create_device(device_id=DEVICE_ID, password='bench', is_enabled=True,
+                                     model=DeviceModel.objects.get(model='esp8266'),
+                                     type=DeviceType.objects.get(type='dht'))
+
+        duration, stats = bench_ingestor(args.messages, args.batch_size, args.flush_interval)
+        single_duration = bench_single_inserts(args.single_insert_messages)
+    finally:
+        connection.creation.destroy_test_db(old_database_name, verbosity=0)
+
+    results = [
+        {'name': 'batched_ingestion',
+         'stats': {'messages': args.messages, 'seconds': duration,
+                   'messages_per_second': stats['messages_per_second'],
+                   'flushes': stats['flushes'], 'dropped': stats['dropped']}},
+        {'name': 'single_inserts',
+         'stats': {'messages': args.single_insert_messages, 'seconds': single_duration,
+                   'messages_per_second': round(args.single_insert_messages / single_duration)}},
+    ]
+    print('%-20s %10s %10s %12s' % ('name', 'messages', 'seconds', 'messages/s'))
+    for result in results:
+        print('%-20s %10d %10.3f %12d' % (result['name'], result['stats']['messages'], result['stats']['seconds'],
+                                          result['stats']['messages_per_second']))
+    if args.output:
+        write_results(args.output, 'ingestion', results, vars(args))
+
+
+if __name__ == '__main__':
+    main()
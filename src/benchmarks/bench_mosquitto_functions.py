@@ -0,0 +1,165 @@
+# Time the nalkinscloud_mosquitto.functions helpers used by device activation, removal and registration,
+# against a throwaway test database seeded with realistic table sizes, usage:
+# python -m benchmarks.bench_mosquitto_functions --users 10000 --devices 100000 --acl-rows 1000000 \
+#     --output mosquitto_functions_results.json --compare mosquitto_functions_master.json
+import argparse
+import itertools
+import random
+import time
+
+from benchmarks.utils import setup_django, benchmark, print_results, write_results, compare_results
+
+setup_django()
+
+from django.contrib.auth.hashers import make_password  # noqa: E402
+from django.db import connection  # noqa: E402
+
+from django_user_email_extension.models import User  # noqa: E402
+from nalkinscloud_mosquitto.acl import acl_engine  # noqa: E402
+from nalkinscloud_mosquitto.functions import is_device_owned_by_user, insert_into_access_list, \
+    remove_from_access_list, insert_new_client_to_devices  # noqa: E402
+from nalkinscloud_mosquitto.models import AccessList, CustomerDevice, Device, DeviceModel, DeviceType  # noqa: E402
+
+# Types of the initial data (mosquitto_initial_data.yaml) used by customer devices
+DEVICE_TYPES = ('dht', 'switch', 'magnet', 'distillery')
+SHARED_DEVICE_ID = 'bench_shared_device'
+
+
+def get_user_email(index):
+    return 'bench_user_%d@nalkins.cloud' % index
+
+
+def get_device_id(index):
+    return 'bench_device_%d' % index
+
+
+def bulk_create(model, objects, batch_size=10000):
+    """
+    bulk_create objects of an iterable in batches, so millions of rows are never all in memory
+    """
+    objects = iter(objects)
+    while True:
+        batch = list(itertools.islice(objects, batch_size))
+        if not batch:
+            return
+        model.objects.bulk_create(batch)
+
+
+def seed(users_count, devices_count, acl_rows_count, shared_device_owners):
+    """
+    Create users (each with its 'user' device), customer devices spread over the users,
+    access list rows spread over all devices and one device owned by 'shared_device_owners' users,
+    rows are inserted with bulk_create so no signals are sent
+
+    :return: tuple of (users list, customer device ids list)
+    """
+    start = time.monotonic()
+    password = make_password('nalkinscloud')
+    esp8266 = DeviceModel.objects.get(model='esp8266')
+    application_model = DeviceModel.objects.get(model='application')
+    user_type = DeviceType.objects.get(type='user')
+    device_types = [DeviceType.objects.get(type=device_type) for device_type in DEVICE_TYPES]
+
+    emails = [get_user_email(i) for i in range(users_count)]
+    bulk_create(User, (User(email=email, password=password, is_active=True) for email in emails))
+    users_by_email = User.objects.in_bulk(emails, field_name='email')
+    users = [users_by_email[email] for email in emails]
+
+    customer_devices_count = max(devices_count - users_count, 1)
+    device_ids = [get_device_id(i) for i in range(customer_devices_count)]
+    bulk_create(Device, itertools.chain(
+        (Device(device_id=email, password=password, model=application_model, type=user_type, is_enabled=True)
+         for email in emails),
+        (Device(device_id=device_id, password=password, model=esp8266, type=device_types[i % len(device_types)],
+                is_enabled=True) for i, device_id in enumerate(device_ids)),
+        [Device(device_id=SHARED_DEVICE_ID, password=password, model=esp8266, type=device_types[0], is_enabled=True)]))
+    bulk_create(CustomerDevice, itertools.chain(
+        (CustomerDevice(user_id=users[i % users_count], device_id_id=device_id, device_name='device %d' % i)
+         for i, device_id in enumerate(device_ids)),
+        (CustomerDevice(user_id=users[i], device_id_id=SHARED_DEVICE_ID, device_name='shared')
+         for i in range(min(shared_device_owners, users_count)))))
+
+    # Like the API writes, 'device/#' for each device (and user), the rest are per topic rules
+    all_device_ids = emails + device_ids
+
+    def access_lists():
+        for i in range(acl_rows_count):
+            device_id = all_device_ids[i % len(all_device_ids)]
+            topic = '%s/#' % device_id if i < len(all_device_ids) else '%s/topic_%d' % (device_id, i)
+            yield AccessList(device_id=device_id, topic=topic, rw=2, is_enabled=True)
+
+    bulk_create(AccessList, access_lists())
+    print('Seeded %d users, %d devices, %d access list rows in %.1f seconds' % (
+        users_count, Device.objects.count(), AccessList.objects.count(), time.monotonic() - start))
+    return users, device_ids
+
+
+def main():
+    parser = argparse.ArgumentParser(description='nalkinscloud_mosquitto.functions benchmark')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--devices', type=int, default=100000, help='Including the users devices')
+    parser.add_argument('--acl-rows', type=int, default=1000000)
+    parser.add_argument('--shared-device-owners', type=int, default=100,
+                        help='Owners of a single device, for the worst case of ownership checks')
+    parser.add_argument('--rounds', type=int, default=200)
+    parser.add_argument('--output', help='Write json results to this path')
+    parser.add_argument('--compare', help='Json results of a previous run, to print the changes against')
+    args = parser.parse_args()
+
+    old_database_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0)
+    try:
+        users, device_ids = seed(args.users, args.devices, args.acl_rows, args.shared_device_owners)
+        randomizer = random.Random(0)
+        results = []
+
+        def add_result(name, func, arguments):
+            """
+            Time func over the arguments (one tuple per call, the first for the warmup call)
+            """
+            arguments = iter(arguments)
+            acl_engine.clear()
+            results.append({'name': name, 'stats': benchmark(lambda: func(*next(arguments)), rounds=args.rounds)})
+
+        # Arguments are built before timing, one more than rounds for the warmup call
+        indexes = [randomizer.randrange(len(device_ids)) for _ in range(args.rounds + 1)]
+        owned = [(Device(device_id=device_ids[i]), users[i % len(users)]) for i in indexes]
+        not_owned = [(Device(device_id=device_ids[i]), users[(i + 1) % len(users)]) for i in indexes]
+        shared_device = Device(device_id=SHARED_DEVICE_ID)
+        last_shared_owner = users[min(args.shared_device_owners, len(users)) - 1]
+        assert is_device_owned_by_user(*owned[0]) and is_device_owned_by_user(shared_device, last_shared_owner)
+        assert len(users) == 1 or not is_device_owned_by_user(*not_owned[0])
+        add_result('is_device_owned_by_user_owner', is_device_owned_by_user, owned)
+        add_result('is_device_owned_by_user_not_owner', is_device_owned_by_user, not_owned)
+        add_result('is_device_owned_by_user_shared_device', is_device_owned_by_user,
+                   [(shared_device, last_shared_owner)] * (args.rounds + 1))
+
+        new_rules = [(Device(device_id=device_ids[i]), 'bench/new_topic_%d' % round_index)
+                     for round_index, i in enumerate(indexes)]
+        add_result('insert_into_access_list_new', insert_into_access_list, new_rules)
+        add_result('insert_into_access_list_existing', insert_into_access_list,
+                   [(Device(device_id=device_ids[i]), '%s/#' % device_ids[i]) for i in indexes])
+
+        # Removes the rows created by 'insert_into_access_list_new'
+        add_result('remove_from_access_list_existing', remove_from_access_list,
+                   [(device.device_id, topic) for device, topic in new_rules])
+        add_result('remove_from_access_list_missing', remove_from_access_list,
+                   [(device_ids[i], 'bench/missing_topic') for i in indexes])
+
+        add_result('insert_new_client_to_devices_new', insert_new_client_to_devices,
+                   [('bench_new_%d@nalkins.cloud' % round_index, 'nalkinscloud', '127.0.0.1')
+                    for round_index in range(args.rounds + 1)])
+        add_result('insert_new_client_to_devices_existing', insert_new_client_to_devices,
+                   [(users[i % len(users)].email, 'nalkinscloud', '127.0.0.1') for i in indexes])
+    finally:
+        connection.creation.destroy_test_db(old_database_name, verbosity=0)
+
+    print_results(results)
+    if args.compare:
+        compare_results(args.compare, results, ('mean', 'median', 'p99'))
+    if args.output:
+        write_results(args.output, 'mosquitto_functions', results, vars(args))
+
+
+if __name__ == '__main__':
+    main()
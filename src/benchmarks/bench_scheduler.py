@@ -0,0 +1,190 @@
+# Compare the scheduler engines of the 'run_scheduler' command, against a throwaway test database:
+# next run time computation of the weekly cron jobs created by the API (CronTrigger vs scheduler.timing_wheel),
+# and a burst of jobs due at once run by the APScheduler configuration (LeasedBackgroundScheduler, DjangoJobStore)
+# and by the timing wheel (LeasedTimingWheelScheduler), both run jobs inline so only scheduling is measured, usage:
+# python -m benchmarks.bench_scheduler --jobs 20000 --output scheduler_results.json --compare scheduler_master.json
+import argparse
+import datetime
+import pickle
+import random
+import time
+
+from benchmarks.utils import setup_django, benchmark, calculate_stats, print_results, write_results, \
+    compare_results
+
+setup_django()
+
+from apscheduler.events import EVENT_JOB_EXECUTED  # noqa: E402
+from apscheduler.executors.debug import DebugExecutor  # noqa: E402
+from apscheduler.job import Job  # noqa: E402
+from apscheduler.schedulers.base import BaseScheduler, STATE_RUNNING  # noqa: E402
+from apscheduler.schedulers.blocking import BlockingScheduler  # noqa: E402
+from apscheduler.triggers.cron import CronTrigger  # noqa: E402
+from django.db import connection  # noqa: E402
+from pytz import utc  # noqa: E402
+
+from nalkinscloud_django.settings import SCHEDULER_DUE_JOBS_BATCH_SIZE  # noqa: E402
+from scheduler.functions import release_lease  # noqa: E402
+from scheduler.jobstores import DjangoJobStore  # noqa: E402
+from scheduler.models import ScheduledJob  # noqa: E402
+from scheduler.schedulers import LeasedBackgroundScheduler, LeasedTimingWheelScheduler  # noqa: E402
+from scheduler.timing_wheel import get_next_weekly_time, get_weekdays_mask  # noqa: E402
+
+# Jobs are reconstituted by the job store from this reference (the script itself runs as __main__)
+JOB_FUNC = 'benchmarks.bench_scheduler:run_job'
+
+
+def run_job(job_id):
+    pass
+
+
+def get_random_weekdays(randomizer, include_weekday=None):
+    weekdays = set(randomizer.sample(range(7), randomizer.randint(1, 7)))
+    if include_weekday is not None:
+        weekdays.add(include_weekday)
+    return sorted(weekdays)
+
+
+def seed(jobs_count, due):
+    """
+    Replace the jobs of the job store with jobs_count weekly cron jobs (as created by the API),
+    all due at 'due' (their weekdays include the weekday of due)
+
+    :param due: datetime
+    """
+    ScheduledJob.objects.all().delete()
+    randomizer = random.Random(0)
+    scheduler = BlockingScheduler(timezone=utc)  # Jobs only reference it, never started
+    rows = []
+    for index in range(jobs_count):
+        trigger = CronTrigger(day_of_week=','.join(str(weekday) for weekday in
+                                                   get_random_weekdays(randomizer, due.weekday())),
+                              hour=due.hour, minute=due.minute, second=due.second, timezone=utc)
+        job_id = 'bench_job_%d' % index
+        job = Job(scheduler, id=job_id, func=JOB_FUNC, trigger=trigger, executor='default', args=(job_id,),
+                  kwargs={}, name=job_id, misfire_grace_time=3600, coalesce=False, max_instances=1,
+                  next_run_time=due)
+        rows.append(ScheduledJob(id=job_id, next_run_time=due.timestamp(),
+                                 job_state=pickle.dumps(job.__getstate__(), pickle.HIGHEST_PROTOCOL)))
+    ScheduledJob.objects.bulk_create(rows)
+
+
+def run_apscheduler(jobs_count):
+    """
+    Run the due jobs with the APScheduler configuration of the 'run_scheduler' command (without its thread pool),
+    by calling the scheduler loop until all jobs ran
+
+    :return: float seconds
+    """
+    executed = []
+    runner = LeasedBackgroundScheduler(lease_name='bench_apscheduler')
+    runner.configure(jobstores={'default': DjangoJobStore(due_jobs_batch_size=SCHEDULER_DUE_JOBS_BATCH_SIZE)},
+                     executors={'default': DebugExecutor()},
+                     timezone=utc)
+    runner.add_listener(lambda event: executed.append(event.job_id), EVENT_JOB_EXECUTED)
+    BaseScheduler.start(runner, paused=True)  # Without the scheduler thread, the loop is called below
+    runner.state = STATE_RUNNING
+
+    start = time.perf_counter()
+    while len(executed) < jobs_count:
+        runner._process_jobs()
+    duration = time.perf_counter() - start
+    BaseScheduler.shutdown(runner)
+    release_lease(runner.lease_name, runner.lease_owner)
+    return duration
+
+
+def run_wheel(jobs_count):
+    """
+    Load the jobs in a timing wheel, then run the due jobs
+
+    :return: tuple of (float seconds loading, float seconds running)
+    """
+    executed = []
+    runner = LeasedTimingWheelScheduler(executed.extend, lease_name='bench_wheel')
+    start = time.perf_counter()
+    runner.renew_lease(time.time())
+    runner.sync_jobs()
+    sync_duration = time.perf_counter() - start
+
+    start = time.perf_counter()
+    runner.run_pending()
+    duration = time.perf_counter() - start
+    release_lease(runner.lease_name, runner.lease_owner)
+    assert len(executed) == jobs_count
+    return sync_duration, duration
+
+
+def get_burst_result(name, timings, jobs_count):
+    stats = calculate_stats(timings)
+    stats['jobs_per_second'] = jobs_count / stats['mean']
+    return {'name': name, 'stats': stats}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Scheduler engines benchmark')
+    parser.add_argument('--jobs', type=int, default=20000, help='Jobs due at once')
+    parser.add_argument('--rounds', type=int, default=3, help='Rounds of the due jobs burst')
+    parser.add_argument('--next-fire-rounds', type=int, default=20000)
+    parser.add_argument('--output', help='Write json results to this path')
+    parser.add_argument('--compare', help='Json results of a previous run, to print the changes against')
+    args = parser.parse_args()
+
+    # Next run time of weekly jobs, arguments are built before timing, one more than rounds for the warmup call
+    randomizer = random.Random(0)
+    start_date = datetime.datetime(2019, 1, 1, tzinfo=utc)
+    cases = []
+    for _ in range(args.next_fire_rounds + 1):
+        weekdays = get_random_weekdays(randomizer)
+        hour, minute, second = randomizer.randrange(24), randomizer.randrange(60), randomizer.randrange(60)
+        trigger = CronTrigger(day_of_week=','.join(str(weekday) for weekday in weekdays),
+                              hour=hour, minute=minute, second=second, timezone=utc)
+        now = start_date + datetime.timedelta(seconds=randomizer.randrange(86400 * 365))
+        cases.append((trigger, now, get_weekdays_mask(weekdays), hour * 3600 + minute * 60 + second))
+    triggers_cases = iter(cases)
+    weekly_cases = iter([(now.timestamp(), weekdays_mask, time_of_day)
+                         for _, now, weekdays_mask, time_of_day in cases])
+
+    def get_trigger_next_fire_time():
+        trigger, now, _, _ = next(triggers_cases)
+        return trigger.get_next_fire_time(None, now)
+
+    results = [
+        {'name': 'next_fire_cron_trigger', 'stats': benchmark(get_trigger_next_fire_time,
+                                                              rounds=args.next_fire_rounds)},
+        {'name': 'next_fire_weekly_time', 'stats': benchmark(lambda: get_next_weekly_time(*next(weekly_cases)),
+                                                             rounds=args.next_fire_rounds)},
+    ]
+
+    old_database_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0)
+    try:
+        apscheduler_timings = []
+        wheel_sync_timings = []
+        wheel_timings = []
+        for _ in range(args.rounds):
+            due = datetime.datetime.now(utc).replace(microsecond=0)
+            seed(args.jobs, due)
+            apscheduler_timings.append(run_apscheduler(args.jobs))
+            seed(args.jobs, due)
+            sync_duration, duration = run_wheel(args.jobs)
+            wheel_sync_timings.append(sync_duration)
+            wheel_timings.append(duration)
+    finally:
+        connection.creation.destroy_test_db(old_database_name, verbosity=0)
+
+    results += [get_burst_result('due_burst_apscheduler', apscheduler_timings, args.jobs),
+                get_burst_result('due_burst_wheel_load', wheel_sync_timings, args.jobs),
+                get_burst_result('due_burst_wheel', wheel_timings, args.jobs)]
+
+    print_results(results)
+    for result in results[2:]:
+        print('%-45s %12.0f jobs/s' % (result['name'], result['stats']['jobs_per_second']))
+    if args.compare:
+        compare_results(args.compare, results, ('mean', 'median', 'p99'))
+    if args.output:
+        write_results(args.output, 'scheduler', results, vars(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,271 @@
+# Load test of the REST API end to end, over HTTP against a local threaded server (a forked process)
+# serving a throwaway test database seeded with users, access tokens and devices of the initial data types,
+# reports throughput and latency percentiles per endpoint, usage:
+# python -m benchmarks.load_test --users 200 --devices-per-user 5 --requests 2000 --concurrency 16 \
+#     --output load_results.json --compare load_results_master.json
+import argparse
+import datetime
+import http.client
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import tempfile
+import threading
+import time
+
+from benchmarks.utils import setup_django, calculate_stats, percentile, write_results, compare_results
+
+setup_django()
+
+from django.contrib.auth.hashers import make_password  # noqa: E402
+from django.db import connection, connections  # noqa: E402
+from django.utils import timezone  # noqa: E402
+from oauth2_provider.models import AccessToken, Application  # noqa: E402
+
+from django_user_email_extension.models import User  # noqa: E402
+from nalkinscloud_django.settings import PROJECT_NAME  # noqa: E402
+from nalkinscloud_mosquitto.models import CustomerDevice, Device, DeviceModel, DeviceType  # noqa: E402
+
+ENDPOINTS = ('health_check', 'device_list', 'get_device_pass', 'device_activation', 'register')
+CLIENT_ID = 'bench_client_id'
+CLIENT_SECRET = 'bench_client_secret'
+PASSWORD = 'nalkinscloud'
+# Types of the initial data (mosquitto_initial_data.yaml) used by customer devices
+DEVICE_TYPES = ('dht', 'switch', 'magnet', 'distillery')
+
+
+def get_user_email(user_index):
+    return 'bench_user_%d@nalkins.cloud' % user_index
+
+
+def get_user_device_id(user_index, device_index):
+    return 'bench_device_%d_%d' % (user_index, device_index)
+
+
+def get_free_device_id(index):
+    return 'bench_free_device_%d' % index
+
+
+def seed(users_count, devices_per_user, free_devices_count, batch_size=1000):
+    """
+    Create users (each with an access token and its 'user' device), devices owned by the users
+    and free devices to activate, passwords are hashed once since hashing dominates the seeding time
+
+    :return: list of access tokens (strings), token of user i at index i
+    """
+    password = make_password(PASSWORD)
+    expires = timezone.now() + datetime.timedelta(days=1)
+    application = Application.objects.create(client_id=CLIENT_ID, client_secret=CLIENT_SECRET, name='bench',
+                                             client_type=Application.CLIENT_CONFIDENTIAL,
+                                             authorization_grant_type=Application.GRANT_PASSWORD)
+    esp8266 = DeviceModel.objects.get(model='esp8266')
+    application_model = DeviceModel.objects.get(model='application')
+    user_type = DeviceType.objects.get(type='user')
+    device_types = [DeviceType.objects.get(type=device_type) for device_type in DEVICE_TYPES]
+
+    emails = [get_user_email(i) for i in range(users_count)]
+    User.objects.bulk_create([User(email=email, password=password, is_active=True) for email in emails],
+                             batch_size=batch_size)
+    users_by_email = User.objects.in_bulk(emails, field_name='email')
+    users = [users_by_email[email] for email in emails]
+
+    tokens = ['bench_token_%d' % i for i in range(users_count)]
+    AccessToken.objects.bulk_create([AccessToken(user=user, application=application, token=token, scope='read write',
+                                                 expires=expires) for user, token in zip(users, tokens)],
+                                    batch_size=batch_size)
+
+    devices = [Device(device_id=user.email, password=password, model=application_model, type=user_type,
+                      is_enabled=True) for user in users]
+    devices += [Device(device_id=get_user_device_id(i, k), password=password, model=esp8266,
+                       type=device_types[(i + k) % len(device_types)], is_enabled=True)
+                for i in range(users_count) for k in range(devices_per_user)]
+    devices += [Device(device_id=get_free_device_id(i), password=password, model=esp8266,
+                       type=device_types[i % len(device_types)], is_enabled=True) for i in range(free_devices_count)]
+    Device.objects.bulk_create(devices, batch_size=batch_size)
+
+    CustomerDevice.objects.bulk_create([CustomerDevice(user_id=user, device_id_id=get_user_device_id(i, k),
+                                                       device_name='device %d' % k)
+                                        for i, user in enumerate(users) for k in range(devices_per_user)],
+                                       batch_size=batch_size)
+    return tokens
+
+
+def run_server(port, log_level, ready_event):
+    """
+    Serve the API with django's threaded WSGI server, in a forked process with its own database connections
+    """
+    from django.core.servers.basehttp import WSGIRequestHandler, ThreadedWSGIServer
+    from django.core.wsgi import get_wsgi_application
+
+    class NoDelayRequestHandler(WSGIRequestHandler):
+        # Headers and body are written separately, without TCP_NODELAY the body waits for the delayed ACK
+        def setup(self):
+            super().setup()
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    connections.close_all()
+    server = ThreadedWSGIServer(('127.0.0.1', port), NoDelayRequestHandler)
+    server.set_app(get_wsgi_application())  # Configures logging again, set levels after
+    logging.getLogger(PROJECT_NAME).setLevel(log_level)
+    logging.getLogger('django.server').setLevel(logging.ERROR)
+    ready_event.set()
+    server.serve_forever()
+
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def build_request(endpoint, index, tokens, devices_per_user):
+    """
+    :return: tuple of (path, body dict, access token or None)
+    """
+    user_index = index % len(tokens)
+    token = tokens[user_index]
+    if endpoint == 'health_check':
+        return '/health_check/', {}, token
+    if endpoint == 'device_list':
+        return '/device_list/', {}, token
+    if endpoint == 'get_device_pass':
+        return '/get_device_pass/', {'device_id': get_user_device_id(user_index, index % devices_per_user)}, token
+    if endpoint == 'device_activation':
+        return '/device_activation/', {'device_id': get_free_device_id(index), 'device_name': 'free %d' % index}, token
+    if endpoint == 'register':
+        return '/register/', {'client_secret': CLIENT_SECRET, 'email': 'bench_register_%d@nalkins.cloud' % index,
+                              'password': PASSWORD, 'first_name': 'bench', 'last_name': str(index)}, None
+    raise ValueError('Unknown endpoint %s' % endpoint)
+
+
+def run_endpoint(port, endpoint, requests_count, concurrency, tokens, devices_per_user):
+    """
+    Send requests_count requests of an endpoint from 'concurrency' threads, each over its own keep alive connection
+
+    :return: dict of results
+    """
+    indexes = itertools.count()
+    indexes_lock = threading.Lock()
+    timings = []
+    statuses = {}
+    results_lock = threading.Lock()
+
+    def worker():
+        http_connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        worker_timings = []
+        worker_statuses = {}
+        while True:
+            with indexes_lock:
+                index = next(indexes)
+            if index >= requests_count:
+                break
+            path, body, token = build_request(endpoint, index, tokens, devices_per_user)
+            headers = {'Content-Type': 'application/json'}
+            if token:
+                headers['Authorization'] = 'Bearer ' + token
+            start = time.perf_counter()
+            for attempt in range(2):
+                try:
+                    http_connection.request('POST', path, body=json.dumps(body).encode('utf-8'), headers=headers)
+                    response = http_connection.getresponse()
+                    response.read()
+                    status = response.status
+                    if response.getheader('Connection', '').lower() == 'close':
+                        http_connection.close()
+                    break
+                except (http.client.HTTPException, ConnectionError):
+                    http_connection.close()  # Reconnected on the next request
+                    status = 'connection_error'
+            worker_timings.append(time.perf_counter() - start)
+            worker_statuses[status] = worker_statuses.get(status, 0) + 1
+        http_connection.close()
+        with results_lock:
+            timings.extend(worker_timings)
+            for status, count in worker_statuses.items():
+                statuses[str(status)] = statuses.get(str(status), 0) + count
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - start
+
+    stats = calculate_stats(timings)
+    stats.update({
+        'p50': percentile(sorted(timings), 50),
+        'requests': len(timings),
+        'seconds': duration,
+        'requests_per_second': len(timings) / duration,
+        'errors': sum(count for status, count in statuses.items() if not status.startswith('2')),
+        'statuses': statuses,
+    })
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='REST API load test')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--devices-per-user', type=int, default=5)
+    parser.add_argument('--requests', type=int, default=1000, help='Requests sent per endpoint')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--endpoints', default=','.join(ENDPOINTS), help='Comma separated, of: ' + ', '.join(ENDPOINTS))
+    parser.add_argument('--server-log-level', default='WARNING')
+    parser.add_argument('--output', help='Write json results to this path')
+    parser.add_argument('--compare', help='Json results of a previous run, to print the changes against')
+    args = parser.parse_args()
+    endpoints = args.endpoints.split(',')
+
+    # Served by another process, so an sqlite test database must be a file
+    database_file = None
+    if connection.vendor == 'sqlite':
+        database_file = os.path.join(tempfile.mkdtemp(), 'load_test.sqlite3')
+        connection.settings_dict['TEST']['NAME'] = database_file
+    old_database_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0)
+    server_process = None
+    try:
+        tokens = seed(args.users, args.devices_per_user,
+                      free_devices_count=args.requests if 'device_activation' in endpoints else 0)
+        connections.close_all()
+
+        port = get_free_port()
+        ready_event = multiprocessing.get_context('fork').Event()
+        server_process = multiprocessing.get_context('fork').Process(
+            target=run_server, args=(port, args.server_log_level, ready_event), daemon=True)
+        server_process.start()
+        ready_event.wait(30)
+
+        results = []
+        for endpoint in endpoints:
+            # Warm up (imports, caches) without measuring
+            run_endpoint(port, 'health_check', args.concurrency, args.concurrency, tokens, args.devices_per_user)
+            stats = run_endpoint(port, endpoint, args.requests, args.concurrency, tokens, args.devices_per_user)
+            results.append({'name': endpoint, 'stats': stats})
+    finally:
+        if server_process is not None:
+            server_process.terminate()
+            server_process.join()
+        connection.creation.destroy_test_db(old_database_name, verbosity=0)
+        if database_file and os.path.exists(database_file):
+            os.remove(database_file)
+
+    print('%-20s %9s %7s %10s %10s %10s %10s' % ('endpoint', 'requests', 'errors', 'req/s',
+                                                   'p50 (ms)', 'p95 (ms)', 'p99 (ms)'))
+    for result in results:
+        stats = result['stats']
+        print('%-20s %9d %7d %10.1f %10.2f %10.2f %10.2f' % (
+            result['name'], stats['requests'], stats['errors'], stats['requests_per_second'],
+            stats['p50'] * 1000, stats['p95'] * 1000, stats['p99'] * 1000))
+    if args.compare:
+        compare_results(args.compare, results, ('requests_per_second', 'p50', 'p95', 'p99'))
+    if args.output:
+        write_results(args.output, 'load_test', results, vars(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+# Shared helpers for the scripts in this directory, benchmarks are run as standalone scripts from 'src', for example:
+# python -m benchmarks.bench_acl --rules 5000
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.dirname(BENCHMARKS_DIR)
+
+
+def setup_django():
+    """
+    Configure Django (same as manage.py does), must be called before importing any model
+    """
+    if SRC_DIR not in sys.path:
+        sys.path.insert(0, SRC_DIR)
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'nalkinscloud_django.settings')
+    import django
+    django.setup()
+
+
+def get_git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=SRC_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def percentile(sorted_values, percent):
+    """
+    Return the percentile (nearest rank) of an already sorted list
+
+    :param sorted_values: list of numbers
+    :param percent: number between 0 and 100
+    :return: number
+    """
+    if not sorted_values:
+        return 0.0
+    index = max(int(round(percent / 100.0 * len(sorted_values))) - 1, 0)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+def calculate_stats(timings):
+    """
+    Return statistics dict of a list of timings (seconds)
+
+    :param timings: list of floats
+    :return: dict
+    """
+    timings = sorted(timings)
+    mean = statistics.mean(timings)
+    return {
+        'rounds': len(timings),
+        'min': timings[0],
+        'max': timings[-1],
+        'mean': mean,
+        'median': statistics.median(timings),
+        'stddev': statistics.stdev(timings) if len(timings) > 1 else 0.0,
+        'p95': percentile(timings, 95),
+        'p99': percentile(timings, 99),
+        'ops': 1.0 / mean if mean else 0.0,
+    }
+
+
+def benchmark(func, rounds=100, warmup=1):
+    """
+    Call func 'rounds' times (after 'warmup' calls) and return its timing statistics
+
+    :param func: callable with no arguments
+    :param rounds: int
+    :param warmup: int
+    :return: dict
+    """
+    for _ in range(warmup):
+        func()
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return calculate_stats(timings)
+
+
+def print_results(results):
+    print('%-45s %12s %12s %12s %12s' % ('name', 'mean (us)', 'median (us)', 'p99 (us)', 'ops/s'))
+    for result in results:
+        stats = result['stats']
+        print('%-45s %12.2f %12.2f %12.2f %12.1f' % (result['name'], stats['mean'] * 1e6,
+                                                   stats['median'] * 1e6, stats['p99'] * 1e6, stats['ops']))
+
+
+def write_results(path, suite, results, params=None):
+    """
+    Write results as json, so results of different commits can be compared
+
+    :param path: string file path
+    :param suite: string benchmark suite name
+    :param results: list of dicts with 'name' and 'stats' keys
+    :param params: dict of parameters the suite ran with
+    :return: None
+    """
+    output = {
+        'suite': suite,
+        'commit': get_git_revision(),
+        'datetime': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': sys.version.split()[0],
+        'params': params or {},
+        'benchmarks': results,
+    }
+    with open(path, 'w') as output_file:
+        json.dump(output, output_file, indent=2)
+
+
+def compare_results(path, results, keys):
+    """
+    Print the change of each 'keys' stat of results against the results of a previous run
+
+    :param path: string file path of json results written by write_results
+    :param results: list of dicts with 'name' and 'stats' keys
+    :param keys: list of stats names
+    :return: None
+    """
+    with open(path) as baseline_file:
+        baseline = json.load(baseline_file)
+    baseline_stats = {result['name']: result['stats'] for result in baseline['benchmarks']}
+    print('Compared to %s (commit %s):' % (path, baseline.get('commit')))
+    for result in results:
+        old_stats = baseline_stats.get(result['name'])
+        if old_stats is None:
+            print('%-45s %s' % (result['name'], 'not in baseline'))
+            continue
+        changes = []
+        for key in keys:
+            old, new = old_stats.get(key), result['stats'].get(key)
+            if old and new is not None:
+                changes.append('%s %+.1f%%' % (key, 100.0 * (new - old) / old))
+        print('%-45s %s' % (result['name'], ', '.join(changes)))
@@ -0,0 +1,11 @@
+from django.contrib import admin
+
+from nalkinscloud_api.models import OutboundEmail
+
+
+@admin.register(OutboundEmail)
+class OutboundEmailAdmin(admin.ModelAdmin):
+    list_display = ('to_email', 'subject', 'status', 'attempts', 'next_attempt_at', 'date_sent')
+    list_filter = ('status',)
+    search_fields = ('to_email',)
+    ordering = ('-date_created',)
@@ -10,6 +10,10 @@ logger = logging.getLogger(PROJECT_NAME)
 class NalkinsCloudAPIConfig(AppConfig):
     name = 'nalkinscloud_api'
 
+    def ready(self):
+        # Connect signal receivers
+        import nalkinscloud_api.signals
+
     # def ready(self):
     #     logger.info("#################################\n"
     #                 "Nalkinscloud API is up and running\n"
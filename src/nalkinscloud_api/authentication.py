@@ -0,0 +1,81 @@
+import hashlib
+import logging
+
+from django.db import DEFAULT_DB_ALIAS
+from django.utils import timezone
+from oauth2_provider.contrib.rest_framework import OAuth2Authentication
+from oauth2_provider.models import AccessToken
+
+from django_user_email_extension.models import User
+from nalkinscloud_mosquitto.cache import TTLCache
+from nalkinscloud_django.settings import PROJECT_NAME, OAUTH2_TOKEN_CACHE_TTL, OAUTH2_TOKEN_CACHE_SIZE
+
+# Define logger
+logger = logging.getLogger(PROJECT_NAME)
+
+# Token hash -> (access token field values, user field values) of validated access tokens
+access_token_cache = TTLCache(max_size=OAUTH2_TOKEN_CACHE_SIZE, ttl=OAUTH2_TOKEN_CACHE_TTL)
+
+
+def get_token_cache_key(token):
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+def invalidate_access_token(token):
+    access_token_cache.invalidate(get_token_cache_key(token))
+
+
+def get_field_values(instance):
+    return tuple(getattr(instance, field.attname) for field in instance._meta.concrete_fields)
+
+
+def from_field_values(model, values):
+    """
+    Build a model instance from values returned by get_field_values, without a query
+    """
+    return model.from_db(DEFAULT_DB_ALIAS, [field.attname for field in model._meta.concrete_fields], values)
+
+
+class CachedOAuth2Authentication(OAuth2Authentication):
+    """
+    OAuth2Authentication that remembers validated bearer tokens (by their sha256) for OAUTH2_TOKEN_CACHE_TTL seconds,
+    a cached token is used until it expires, tokens are forgotten once revoked, deleted or their user changes
+    (see signals.py), other processes see a revocation after at most OAUTH2_TOKEN_CACHE_TTL seconds
+
+    A cached token returns new AccessToken and User instances built from the cached values,
+    so requests never share (and mutate) the same instances
+    """
+
+    def authenticate(self, request):
+        token = self.get_bearer_token(request)
+        if token is None:
+            return super().authenticate(request)
+
+        cache_key = get_token_cache_key(token)
+        cached = access_token_cache.get(cache_key)
+        if cached is not None:
+            access_token_values, user_values = cached
+            access_token = from_field_values(AccessToken, access_token_values)
+            if not access_token.is_expired():
+                user = from_field_values(User, user_values)
+                access_token.user = user
+                return user, access_token
+            access_token_cache.invalidate(cache_key)
+
+        result = super().authenticate(request)
+        if result is not None:
+            user, access_token = result
+            ttl = min(OAUTH2_TOKEN_CACHE_TTL, (access_token.expires - timezone.now()).total_seconds())
+            if ttl > 0:
+                access_token_cache.set(cache_key, (get_field_values(access_token), get_field_values(user)), ttl)
+        return result
+
+    @staticmethod
+    def get_bearer_token(request):
+        """
+        Return the token of an 'Authorization: Bearer <token>' header, None if there is no such header
+        """
+        authorization = request.META.get('HTTP_AUTHORIZATION', '').split()
+        if len(authorization) == 2 and authorization[0].lower() == 'bearer':
+            return authorization[1]
+        return None
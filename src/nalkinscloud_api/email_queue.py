@@ -0,0 +1,117 @@
+import datetime
+import logging
+
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from nalkinscloud_api.models import OutboundEmail
+from nalkinscloud_django.settings import PROJECT_NAME, EMAIL_HOST_USER, EMAIL_QUEUE_BATCH_SIZE, \
+    EMAIL_QUEUE_MAX_ATTEMPTS, EMAIL_QUEUE_RETRY_DELAY, EMAIL_QUEUE_MAX_RETRY_DELAY, EMAIL_QUEUE_LEASE_TIME
+
+# Define logger
+logger = logging.getLogger(PROJECT_NAME)
+
+
+def queue_email(subject, body, to_email, from_email=EMAIL_HOST_USER, html_body=''):
+    """
+    Queue an email, it is sent by the 'send_emails' worker
+
+    :param subject: string
+    :param body: string
+    :param to_email: string
+    :param from_email: string, DEFAULT_FROM_EMAIL if empty
+    :param html_body: optional string
+    :return: OutboundEmail
+    """
+    return OutboundEmail.objects.create(subject=subject, body=body, html_body=html_body or '',
+                                        from_email=from_email or '', to_email=to_email)
+
+
+def get_retry_delay(attempts):
+    """
+    :param attempts: int number of failed attempts
+    :return: timedelta, exponential backoff
+    """
+    return datetime.timedelta(seconds=min(EMAIL_QUEUE_RETRY_DELAY * 2 ** (attempts - 1), EMAIL_QUEUE_MAX_RETRY_DELAY))
+
+
+def claim_emails(batch_size=EMAIL_QUEUE_BATCH_SIZE, now=None):
+    """
+    Claim due emails for EMAIL_QUEUE_LEASE_TIME seconds, so other workers skip them,
+    emails of a worker that died while sending become due again once the lease ends
+
+    :param batch_size: int
+    :param now: optional aware datetime
+    :return: list of OutboundEmail
+    """
+    now = now or timezone.now()
+    with transaction.atomic():
+        ids = list(OutboundEmail.objects.select_for_update(skip_locked=True)
+                   .filter(status=OutboundEmail.STATUS_PENDING, next_attempt_at__lte=now)
+                   .order_by('next_attempt_at').values_list('id', flat=True)[:batch_size])
+        OutboundEmail.objects.filter(id__in=ids).update(
+            attempts=F('attempts') + 1, next_attempt_at=now + datetime.timedelta(seconds=EMAIL_QUEUE_LEASE_TIME))
+    return list(OutboundEmail.objects.filter(id__in=ids).order_by('next_attempt_at', 'id'))
+
+
+def build_message(email, connection):
+    message = EmailMultiAlternatives(email.subject, email.body, email.from_email or None, [email.to_email],
+                                     connection=connection)
+    if email.html_body:
+        message.attach_alternative(email.html_body, 'text/html')
+    return message
+
+
+def mark_failed(email, error, now):
+    email.last_error = str(error)
+    if email.attempts >= EMAIL_QUEUE_MAX_ATTEMPTS:
+        email.status = OutboundEmail.STATUS_FAILED
+        logger.error('Giving up sending email %s to %s after %d attempts: %s',
+                     email.id, email.to_email, email.attempts, error)
+    else:
+        email.next_attempt_at = now + get_retry_delay(email.attempts)
+        logger.warning('Failed sending email %s to %s (attempt %d): %s', email.id, email.to_email, email.attempts, error)
+    email.save(update_fields=['status', 'next_attempt_at', 'last_error'])
+
+
+def send_queued_emails(batch_size=EMAIL_QUEUE_BATCH_SIZE, connection=None):
+    """
+    Send a batch of due emails over a single connection to the mail server,
+    failed emails are retried with exponential backoff, up to EMAIL_QUEUE_MAX_ATTEMPTS attempts
+
+    :param batch_size: int
+    :param connection: optional email backend instance, EMAIL_BACKEND by default
+    :return: tuple of (sent count, failed count)
+    """
+    emails = claim_emails(batch_size)
+    if not emails:
+        return 0, 0
+
+    connection = connection or get_connection(fail_silently=False)
+    sent_ids = []
+    failed_count = 0
+    try:
+        connection.open()
+    except Exception as e:  # Mail server unreachable, retry the whole batch later
+        now = timezone.now()
+        for email in emails:
+            mark_failed(email, e, now)
+        return 0, len(emails)
+
+    try:
+        for email in emails:
+            try:
+                connection.send_messages([build_message(email, connection)])
+                sent_ids.append(email.id)
+            except Exception as e:
+                mark_failed(email, e, timezone.now())
+                failed_count += 1
+    finally:
+        connection.close()
+        if sent_ids:
+            OutboundEmail.objects.filter(id__in=sent_ids).update(status=OutboundEmail.STATUS_SENT,
+                                                                 date_sent=timezone.now(), last_error='')
+    logger.info('Sent %d queued emails, %d failed', len(sent_ids), failed_count)
+    return len(sent_ids), failed_count
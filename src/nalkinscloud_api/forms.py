@@ -0,0 +1,21 @@
+from django.contrib.auth.forms import PasswordResetForm
+from django.template import loader
+
+from nalkinscloud_api.email_queue import queue_email
+
+
+class QueuedPasswordResetForm(PasswordResetForm):
+    """
+    PasswordResetForm that queues the reset email (see email_queue.py) instead of sending it inside the request
+    """
+
+    def send_mail(self, subject_template_name, email_template_name,
+                  context, from_email, to_email, html_email_template_name=None):
+        subject = loader.render_to_string(subject_template_name, context)
+        # Email subject *must not* contain newlines
+        subject = ''.join(subject.splitlines())
+        body = loader.render_to_string(email_template_name, context)
+        html_body = ''
+        if html_email_template_name is not None:
+            html_body = loader.render_to_string(html_email_template_name, context)
+        queue_email(subject, body, to_email, from_email=from_email, html_body=html_body)
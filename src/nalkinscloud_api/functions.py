@@ -1,16 +1,27 @@
 
 from django.contrib.auth.hashers import make_password
+from django.core.serializers.json import DjangoJSONEncoder
 
 from django_user_email_extension.models import User
 from oauth2_provider.models import Application
 
+from nalkinscloud_django.settings import PROJECT_NAME, CLIENT_SECRET_CACHE_TTL
+
 # For password generating
 import random
 import string
 
+import hashlib
+import logging
+import threading
+import time
+
 from pytz import utc
 import datetime
 
+# Define logger
+logger = logging.getLogger(PROJECT_NAME)
+
 
 def build_json_response(status, value):
     """
@@ -26,6 +37,59 @@ def build_json_response(status, value):
     }
 
 
+def stream_json_response(status, values, output='json', error_message='Response interrupted'):
+    """
+    Generate a json response chunk by chunk, values are consumed lazily so the response is never held in memory,
+    the status code is sent before the values are read, so a failure while reading them is reported in the body:
+    'json' output ends with its status (the build_json_response keys, "status" is written last,
+    'failed' with an "error" on failure, a body cut short is not valid json),
+    'ndjson' output ends with a {"status": "failed", "message": error_message} record on failure
+
+    :param status: string
+    :param values: iterable of json serializable values
+    :param output: 'json' for the build_json_response format, 'ndjson' for one value per line
+    :param error_message: string, sent to the client on failure
+    :return: iterator of strings
+    """
+    encoder = DjangoJSONEncoder()
+    if output == 'ndjson':
+        try:
+            for value in values:
+                yield encoder.encode(value) + '\n'
+        except Exception:
+            logger.exception('Failed to stream the response')
+            yield encoder.encode(build_json_response('failed', error_message)) + '\n'
+        return
+
+    yield '{"message": ['
+    separator = ''
+    try:
+        for value in values:
+            yield separator + encoder.encode(value)
+            separator = ', '
+    except Exception:
+        logger.exception('Failed to stream the response')
+        yield '], "status": "failed", "error": %s}' % encoder.encode(error_message)
+        return
+    yield '], "status": %s}' % encoder.encode(status)
+
+
+def build_bulk_item_response(device_id, result):
+    """
+    Generate the response of a single item of a bulk request
+
+    :param device_id: string
+    :param result: tuple of (boolean, string)
+    :return: dict
+    """
+    is_success, value = result
+    return {
+        'device_id': device_id,
+        'status': 'success' if is_success else 'failed',
+        'message': value
+    }
+
+
 def generate_user_name(first_name, last_name):
     """
     Generate username using first_name, last_name and random create stings, for example:
@@ -115,11 +179,45 @@ def is_client_id_exists(client_id):
     return Application.objects.filter(client_id=client_id).exists()
 
 
+# sha256 hashes of all applications client secrets, loaded on first use (see signals.py)
+_client_secret_hashes = None
+_client_secret_hashes_loaded_at = 0
+_client_secret_hashes_lock = threading.Lock()
+
+
+def get_client_secret_hash(client_secret):
+    return hashlib.sha256(client_secret.encode('utf-8')).hexdigest()
+
+
+def get_client_secret_hashes():
+    """
+    Return the set of client secrets hashes, reloaded with a single query once invalidated
+    or after CLIENT_SECRET_CACHE_TTL seconds (applications changed by another process)
+
+    :return: frozenset of strings
+    """
+    global _client_secret_hashes, _client_secret_hashes_loaded_at
+    with _client_secret_hashes_lock:
+        if _client_secret_hashes is None or \
+                time.monotonic() - _client_secret_hashes_loaded_at > CLIENT_SECRET_CACHE_TTL:
+            _client_secret_hashes = frozenset(get_client_secret_hash(client_secret) for client_secret in
+                                              Application.objects.values_list('client_secret', flat=True))
+            _client_secret_hashes_loaded_at = time.monotonic()
+        return _client_secret_hashes
+
+
+def invalidate_client_secret_hashes():
+    global _client_secret_hashes
+    with _client_secret_hashes_lock:
+        _client_secret_hashes = None
+
+
 def is_client_secret_exists(client_secret):
     """
-    Check if client_secret exist in 'Application' model (oauth2_provider)
+    Check if client_secret exist in 'Application' model (oauth2_provider),
+    checked against the cached secrets hashes, so invalid secrets are rejected without a query
 
     :param client_secret:
     :return: True if client_secret exists
     """
-    return Application.objects.filter(client_secret=client_secret).exists()
+    return get_client_secret_hash(client_secret) in get_client_secret_hashes()
@@ -1,6 +1,13 @@
 
 # Used by as logging filter for Graylog (see setting.py)
+import contextvars
 import logging
+import random
+
+from nalkinscloud_django.settings import LOG_SAMPLE_RATE
+
+# False while handling a request that was not sampled (see LogSamplingMiddleware)
+request_sampled = contextvars.ContextVar('request_sampled', default=True)
 
 
 class FieldFilter(logging.Filter):
@@ -9,6 +16,35 @@ class FieldFilter(logging.Filter):
         self.fields = fields
 
     def filter(self, record):
-        for k, v in self.fields.items():
-            setattr(record, k, v)
+        record.__dict__.update(self.fields)
         return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Drop records below 'level' logged while handling requests that were not sampled,
+    so all records of a sampled request are kept together, records logged outside requests are always kept
+    """
+
+    def __init__(self, level=logging.WARNING):
+        self.level = level if isinstance(level, int) else logging.getLevelName(level)
+
+    def filter(self, record):
+        return record.levelno >= self.level or request_sampled.get()
+
+
+class LogSamplingMiddleware(object):
+    """
+    Sample 'rate' (0 to 1) of the requests, see SamplingFilter
+    """
+
+    def __init__(self, get_response, rate=None):
+        self.get_response = get_response
+        self.rate = LOG_SAMPLE_RATE if rate is None else rate
+
+    def __call__(self, request):
+        token = request_sampled.set(self.rate >= 1 or random.random() < self.rate)
+        try:
+            return self.get_response(request)
+        finally:
+            request_sampled.reset(token)
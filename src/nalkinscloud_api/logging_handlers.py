@@ -0,0 +1,156 @@
+# Used by the LOGGING setting (see setting.py), records are handed to a queue on the logging thread
+# and handled (formatted and sent) by a background listener thread
+import atexit
+import logging
+import os
+import queue
+import threading
+
+from logging.handlers import QueueHandler, QueueListener
+
+from graypy import GELFTCPHandler
+
+
+class BatchQueueListener(QueueListener):
+    """
+    QueueListener handling the records waiting in the queue together (up to batch_size records),
+    handlers implementing handle_batch(records) receive them in a single call
+    """
+
+    def __init__(self, queue, *handlers, batch_size=100):
+        super().__init__(queue, *handlers, respect_handler_level=True)
+        self.batch_size = batch_size
+
+    def _monitor(self):
+        q = self.queue
+        while True:
+            record = q.get()
+            batch = []
+            stop = False
+            while True:
+                if record is self._sentinel:
+                    stop = True
+                    break
+                batch.append(record)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    record = q.get_nowait()
+                except queue.Empty:
+                    break
+            if batch:
+                self.handle_batch(batch)
+            if stop:
+                return
+
+    def handle_batch(self, records):
+        for handler in self.handlers:
+            handler_records = [record for record in records if record.levelno >= handler.level]
+            if not handler_records:
+                continue
+            if hasattr(handler, 'handle_batch'):
+                handler.handle_batch(handler_records)
+            else:
+                for record in handler_records:
+                    handler.handle(record)
+
+
+class QueueListenerHandler(QueueHandler):
+    """
+    Put records on a bounded queue and return, the queue is drained by a BatchQueueListener thread
+    sending the records to 'targets' handlers, records are dropped (and counted) while the queue is full,
+    so logging never blocks the caller
+
+    Records are formatted by the listener thread, arguments of log calls should not be changed after the call
+
+    :param targets: list of handlers (as 'cfg://handlers.<name>' in LOGGING, named before this handler)
+    :param queue_size: int
+    :param batch_size: int, max records handled together
+    """
+
+    def __init__(self, targets, queue_size=10000, batch_size=100):
+        super().__init__(queue.Queue(maxsize=queue_size))
+        self.handlers = [targets[i] for i in range(len(targets))]  # Resolve 'cfg://' references
+        for handler in self.handlers:
+            if not isinstance(handler, logging.Handler):
+                raise ValueError('target not configured yet: %r' % handler)
+        self.batch_size = batch_size
+        self.dropped_count = 0
+        self._listener = None
+        self._listener_lock = threading.Lock()
+        self.start()
+        atexit.register(self.stop)
+        if hasattr(os, 'register_at_fork'):  # Threads do not survive fork, start a listener in the child
+            os.register_at_fork(after_in_child=self._restart_in_child)
+
+    def start(self):
+        with self._listener_lock:
+            if self._listener is None:
+                self._listener = BatchQueueListener(self.queue, *self.handlers, batch_size=self.batch_size)
+                self._listener.start()
+
+    def stop(self):
+        """
+        Handle all queued records and stop the listener thread
+        """
+        with self._listener_lock:
+            if self._listener is not None:
+                self._listener.stop()
+                self._listener = None
+
+    def flush(self):
+        """
+        Wait until queued records are handled, by restarting a running listener
+        """
+        if self._listener is not None:
+            self.stop()
+            self.start()
+
+    def close(self):
+        self.stop()
+        super().close()
+
+    def _restart_in_child(self):
+        self._listener_lock = threading.Lock()
+        self._listener = None
+        self.queue = queue.Queue(maxsize=self.queue.maxsize)
+        self.start()
+
+    def prepare(self, record):
+        # Tracebacks reference the frames (and request objects) of the caller, render them now
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped_count += 1
+
+
+class GELFBatchTCPHandler(GELFTCPHandler):
+    """
+    GELF TCP handler sending a batch of records (null byte delimited frames) with a single send
+    """
+
+    def handle_batch(self, records):
+        frames = []
+        for record in records:
+            if not self.filter(record):
+                continue
+            try:
+                frames.append(self.makePickle(record))
+            except Exception:
+                self.handleError(record)
+        if not frames:
+            return
+        self.acquire()
+        try:
+            self.send(b''.join(frames))
+        except Exception:
+            self.handleError(records[-1])
+        finally:
+            self.release()
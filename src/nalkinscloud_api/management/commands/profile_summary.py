@@ -0,0 +1,81 @@
+import json
+import os
+import re
+
+from collections import Counter, defaultdict
+
+from django.core.management.base import BaseCommand
+
+from nalkinscloud_django.settings import PROFILING_DIR
+
+
+def normalize_sql(sql):
+    """
+    Replace literal values of a query, so queries differing only by their values are counted together
+
+    :param sql: string
+    :return: string
+    """
+    sql = re.sub(r"'(?:[^']|'')*'", '?', sql.replace('%s', '?'))
+    sql = re.sub(r'\b\d+(?:\.\d+)?\b', '?', sql)
+    sql = re.sub(r'\((?:\?, )+\?\)', '(...)', sql)
+    return re.sub(r'\s+', ' ', sql).strip()
+
+
+class Command(BaseCommand):
+    help = 'Summarize profiles written by ProfilingMiddleware, hottest functions and queries per endpoint'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dir', default=PROFILING_DIR)
+        parser.add_argument('--view', help='Only summarize profiles of this view name')
+        parser.add_argument('--limit', type=int, default=10, help='Functions and queries shown per endpoint')
+
+    def handle(self, *args, **options):
+        endpoints = defaultdict(list)
+        for file_name in sorted(os.listdir(options['dir'])):
+            if not file_name.endswith('.json'):
+                continue
+            with open(os.path.join(options['dir'], file_name)) as profile_file:
+                profile = json.load(profile_file)
+            if options['view'] and profile['view'] != options['view']:
+                continue
+            endpoints[(profile['view'], profile['method'])].append(profile)
+
+        if not endpoints:
+            self.stdout.write('No profiles found in %s' % options['dir'])
+            return
+
+        for (view, method), profiles in sorted(endpoints.items(), key=lambda item: -len(item[1])):
+            self.write_endpoint_summary(view, method, profiles, options['limit'])
+
+    def write_endpoint_summary(self, view, method, profiles, limit):
+        durations = sorted(profile['duration'] for profile in profiles)
+        self.stdout.write('%s %s: %d profiles, avg %.1f ms, max %.1f ms, avg %.1f queries' % (
+            method, view, len(profiles), 1000 * sum(durations) / len(durations), 1000 * durations[-1],
+            sum(profile['queries_count'] for profile in profiles) / len(profiles)))
+
+        # Self samples count the innermost function of a stack, total samples every function in the stack once
+        self_samples, total_samples = Counter(), Counter()
+        for profile in profiles:
+            for stack, count in profile['stacks'].items():
+                frames = stack.split(';')
+                self_samples[frames[-1]] += count
+                for frame in set(frames):
+                    total_samples[frame] += count
+        samples_count = sum(self_samples.values())
+        if samples_count:
+            self.stdout.write('  Hottest functions (self %, total %):')
+            for frame, count in self_samples.most_common(limit):
+                self.stdout.write('    %5.1f%% %5.1f%%  %s' % (
+                    100.0 * count / samples_count, 100.0 * total_samples[frame] / samples_count, frame))
+
+        queries_time, queries_count = Counter(), Counter()
+        for profile in profiles:
+            for query in profile['queries']:
+                sql = normalize_sql(query['sql'])
+                queries_time[sql] += query['duration']
+                queries_count[sql] += 1
+        if queries_time:
+            self.stdout.write('  Hottest queries (total ms, count):')
+            for sql, duration in queries_time.most_common(limit):
+                self.stdout.write('    %8.1f %5d  %s' % (1000 * duration, queries_count[sql], sql))
@@ -0,0 +1,49 @@
+import logging
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+
+from nalkinscloud_api.scheduler import create_scheduler, create_wheel_scheduler
+from nalkinscloud_django.settings import PROJECT_NAME, SCHEDULER_ENGINE, SCHEDULER_THREAD_POOL_SIZE, \
+    SCHEDULER_PROCESS_POOL_SIZE
+
+# Define logger
+logger = logging.getLogger(PROJECT_NAME)
+
+
+class Command(BaseCommand):
+    help = 'Run the scheduled jobs added through the API, due jobs run while holding the scheduler lease'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--engine', choices=('apscheduler', 'wheel'), default=SCHEDULER_ENGINE,
+                            help='Run due jobs with APScheduler, or in batches from a timing wheel')
+        parser.add_argument('--threads', type=int, default=SCHEDULER_THREAD_POOL_SIZE,
+                            help='Size of the thread pool running jobs')
+        parser.add_argument('--processes', type=int, default=SCHEDULER_PROCESS_POOL_SIZE,
+                            help="Size of the 'processpool' executor")
+
+    def handle(self, *args, **options):
+        stop_event = threading.Event()
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+
+        if options['engine'] == 'wheel':
+            scheduler = create_wheel_scheduler(options['threads'])
+            logger.info('Scheduler %s started (timing wheel)', scheduler.lease_owner)
+            try:
+                scheduler.run(stop_event)  # Waits for running jobs, then releases the lease
+            except KeyboardInterrupt:
+                pass
+            logger.info('Scheduler %s stopped', scheduler.lease_owner)
+            return
+
+        scheduler = create_scheduler(options['threads'], options['processes'])
+        scheduler.start()
+        logger.info('Scheduler %s started', scheduler.lease_owner)
+        try:
+            while not stop_event.wait(60):
+                pass
+        except KeyboardInterrupt:
+            pass
+        scheduler.shutdown()  # Waits for running jobs, then releases the lease
+        logger.info('Scheduler %s stopped', scheduler.lease_owner)
@@ -0,0 +1,56 @@
+import logging
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, DatabaseError
+
+from nalkinscloud_api.email_queue import send_queued_emails
+from nalkinscloud_django.settings import PROJECT_NAME, EMAIL_QUEUE_BATCH_SIZE, EMAIL_QUEUE_POLL_INTERVAL
+
+# Define logger
+logger = logging.getLogger(PROJECT_NAME)
+
+
+class Command(BaseCommand):
+    help = 'Send queued emails (registration verification, password reset) in batches over one SMTP connection'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=EMAIL_QUEUE_BATCH_SIZE)
+        parser.add_argument('--poll-interval', type=float, default=EMAIL_QUEUE_POLL_INTERVAL,
+                            help='Seconds to wait before polling the queue again once it is empty')
+        parser.add_argument('--once', action='store_true', help='Send due emails and exit')
+
+    def handle(self, *args, **options):
+        if options['once']:
+            sent_count, failed_count = self.send_due_emails(options['batch_size'])
+            self.stdout.write('Sent %d emails, %d failed' % (sent_count, failed_count))
+            return
+
+        stop_event = threading.Event()
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+        logger.info('Sending queued emails')
+        try:
+            while not stop_event.is_set():
+                close_old_connections()
+                try:
+                    sent_count, failed_count = send_queued_emails(options['batch_size'])
+                except DatabaseError:
+                    logger.exception('Failed reading the email queue')
+                    sent_count = 0
+                # Keep sending while full batches are sent, wait once the queue is drained
+                if sent_count < options['batch_size']:
+                    stop_event.wait(options['poll_interval'])
+        except KeyboardInterrupt:
+            pass
+        logger.info('Email queue worker stopped')
+
+    @staticmethod
+    def send_due_emails(batch_size):
+        sent_count, failed_count = 0, 0
+        while True:
+            batch_sent_count, batch_failed_count = send_queued_emails(batch_size)
+            sent_count += batch_sent_count
+            failed_count += batch_failed_count
+            if batch_sent_count + batch_failed_count < batch_size:
+                return sent_count, failed_count
@@ -0,0 +1,41 @@
+# Generated by Django 3.0.12 on 2026-10-18 11:14
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboundEmail',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('subject', models.CharField(max_length=256, verbose_name='Subject')),
+                ('body', models.TextField(verbose_name='Body')),
+                ('html_body', models.TextField(blank=True, default='', verbose_name='HTML Body')),
+                ('from_email', models.CharField(blank=True, default='', max_length=256, verbose_name='From')),
+                ('to_email', models.EmailField(max_length=255, verbose_name='To')),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('sent', 'Sent'), ('failed', 'Failed')], default='pending', max_length=16, verbose_name='Status')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='Attempts')),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Next Attempt')),
+                ('last_error', models.TextField(blank=True, default='', verbose_name='Last Error')),
+                ('date_created', models.DateTimeField(auto_now_add=True, verbose_name='Date Created')),
+                ('date_sent', models.DateTimeField(blank=True, null=True, verbose_name='Date Sent')),
+            ],
+            options={
+                'verbose_name': 'outbound_email',
+                'verbose_name_plural': 'outbound_emails',
+                'db_table': 'outbound_emails',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='outboundemail',
+            index=models.Index(fields=['status', 'next_attempt_at'], name='outbound_emails_due_idx'),
+        ),
+    ]
@@ -0,0 +1,40 @@
+from django.db import models
+from django.utils import timezone
+from django.utils.translation import ugettext_lazy as _
+
+
+class OutboundEmail(models.Model):
+    """
+    Email waiting to be sent by the email queue worker (nalkinscloud_api.email_queue), instead of inside the request
+    """
+    STATUS_PENDING = 'pending'
+    STATUS_SENT = 'sent'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = (
+        (STATUS_PENDING, _('Pending')),
+        (STATUS_SENT, _('Sent')),
+        (STATUS_FAILED, _('Failed')),
+    )
+
+    subject = models.CharField(_('Subject'), max_length=256)
+    body = models.TextField(_('Body'))
+    html_body = models.TextField(_('HTML Body'), blank=True, default='')
+    from_email = models.CharField(_('From'), max_length=256, blank=True, default='')
+    to_email = models.EmailField(_('To'), max_length=255)
+    status = models.CharField(_('Status'), max_length=16, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    attempts = models.PositiveIntegerField(_('Attempts'), default=0)
+    next_attempt_at = models.DateTimeField(_('Next Attempt'), default=timezone.now)
+    last_error = models.TextField(_('Last Error'), blank=True, default='')
+    date_created = models.DateTimeField(_('Date Created'), auto_now_add=True, blank=True)
+    date_sent = models.DateTimeField(_('Date Sent'), null=True, blank=True)
+
+    def __str__(self):
+        return '%s to %s (%s)' % (self.subject, self.to_email, self.status)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='outbound_emails_due_idx'),
+        ]
+        verbose_name = _('outbound_email')
+        verbose_name_plural = _('outbound_emails')
+        db_table = 'outbound_emails'
@@ -0,0 +1,14 @@
+from rest_framework.pagination import CursorPagination
+
+from nalkinscloud_django.settings import DEVICE_LIST_PAGE_SIZE, DEVICE_LIST_MAX_PAGE_SIZE
+
+
+class CustomerDeviceCursorPagination(CursorPagination):
+    """
+    Keyset pagination over CustomerDevice rows, pages are fetched with 'WHERE id > <cursor> LIMIT <page_size>'
+    so page cost does not grow with the offset into the users device list
+    """
+    ordering = 'id'  # Unique and never changes, so cursors stay stable while devices are added/removed
+    page_size = DEVICE_LIST_PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = DEVICE_LIST_MAX_PAGE_SIZE
@@ -1,51 +1,134 @@
-from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.events import EVENT_JOB_SUBMITTED, EVENT_JOB_MISSED
 from apscheduler.executors.pool import ProcessPoolExecutor
 from nalkinscloud_api.functions import generate_random_16_char_string
-from nalkinscloud_django.settings import PROJECT_NAME
-
-# from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+from nalkinscloud_django.settings import PROJECT_NAME, SCHEDULER_LEASE_TTL, SCHEDULER_LEASE_RENEW_INTERVAL, \
+    SCHEDULER_DUE_JOBS_BATCH_SIZE, SCHEDULER_THREAD_POOL_SIZE, SCHEDULER_PROCESS_POOL_SIZE, SCHEDULER_WHEEL_TICK, \
+    MQTT_BROKER_HOST, MQTT_BROKER_PORT, MQTT_BROKER_TRANSPORT, MQTT_PUBLISHER_USERNAME, MQTT_PUBLISHER_PASSWORD, \
+    MQTT_PUBLISHER_POOL_SIZE, MQTT_PUBLISHER_QOS, MQTT_PUBLISHER_TIMEOUT, MQTT_PUBLISHER_BATCH_WINDOW
+from nalkinscloud_django.metrics import observe_scheduler_event
+from nalkinscloud_mosquitto.publisher import MQTTClientPool, BatchPublisher
+from scheduler.jobstores import DjangoJobStore
+from scheduler.schedulers import LeasedBackgroundScheduler, JobStoreScheduler, LeasedTimingWheelScheduler
 
 import logging
-import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from pytz import utc
 
-now = datetime.datetime.now()
-
 # Define logger
 logger = logging.getLogger(PROJECT_NAME)
 
 # Since we use 'apscheduler' The first weekday is always monday.
-days_to_ints = {'Sunday': '6', 'Monday': '0', 'Tuesday': '1',
-                'Wednesday': '2', 'Thursday': '3', 'Friday': '4', 'Saturday': '5'}
-'''
-jobstores = {
-    'mongo': {'type': 'mongodb'},
-    # 'default': SQLAlchemyJobStore(url='sqlite:///jobs.sqlite')
-}'''
-
-executors = {
-    'default': {'type': 'threadpool', 'max_workers': 20},
-    'processpool': ProcessPoolExecutor(max_workers=5)
-}
+days_to_ints = {'sunday': 6, 'monday': 0, 'tuesday': 1,
+                'wednesday': 2, 'thursday': 3, 'friday': 4, 'saturday': 5}
 
+# Stored with each job, jobs added by the web processes are picked up by the 'run_scheduler' process
+# within its lease renew interval, so they may start that late
 job_defaults = {
     'coalesce': False,
-    'max_instances': 3
+    'max_instances': 3,
+    'misfire_grace_time': SCHEDULER_LEASE_RENEW_INTERVAL * 2
 }
-scheduler = BackgroundScheduler()
 
-scheduler.configure(executors=executors, job_defaults=job_defaults, timezone=utc)
-# scheduler.configure(jobstores=jobstores, executors=executors, job_defaults=job_defaults, timezone=utc)
 
-scheduler.start()
+def create_scheduler(thread_pool_size=SCHEDULER_THREAD_POOL_SIZE, process_pool_size=SCHEDULER_PROCESS_POOL_SIZE):
+    """
+    Return a (not started) scheduler running the due jobs of the job store while holding the scheduler lease,
+    used by the 'run_scheduler' command
+
+    :param thread_pool_size: int
+    :param process_pool_size: int
+    :return: LeasedBackgroundScheduler
+    """
+    runner = LeasedBackgroundScheduler(lease_ttl=SCHEDULER_LEASE_TTL,
+                                       lease_renew_interval=SCHEDULER_LEASE_RENEW_INTERVAL)
+    runner.configure(jobstores={'default': DjangoJobStore(due_jobs_batch_size=SCHEDULER_DUE_JOBS_BATCH_SIZE)},
+                     executors={'default': {'type': 'threadpool', 'max_workers': thread_pool_size},
+                                'processpool': ProcessPoolExecutor(max_workers=process_pool_size)},
+                     job_defaults=job_defaults,
+                     timezone=utc)
+    runner.add_listener(observe_scheduler_event, EVENT_JOB_SUBMITTED | EVENT_JOB_MISSED)
+    return runner
+
+
+def execute_scheduled_jobs(jobs):
+    """
+    Run a batch of due jobs (all jobs of a timing wheel tick), a failing job does not stop the others
+
+    :param jobs: list of apscheduler.job.Job
+    """
+    for job in jobs:
+        try:
+            job.func(*job.args, **job.kwargs)
+        except Exception:
+            logger.exception('Scheduled job %s failed', job.id)
+
+
+def create_wheel_scheduler(thread_pool_size=SCHEDULER_THREAD_POOL_SIZE):
+    """
+    Return a scheduler running the due jobs of the job store from a timing wheel while holding the scheduler lease,
+    used by the 'run_scheduler' command with '--engine wheel'
+
+    :param thread_pool_size: int, threads running the batches of due jobs
+    :return: LeasedTimingWheelScheduler
+    """
+    return LeasedTimingWheelScheduler(execute_scheduled_jobs,
+                                      executor=ThreadPoolExecutor(max_workers=thread_pool_size),
+                                      lease_ttl=SCHEDULER_LEASE_TTL,
+                                      lease_renew_interval=SCHEDULER_LEASE_RENEW_INTERVAL,
+                                      tick=SCHEDULER_WHEEL_TICK,
+                                      jobstore=DjangoJobStore(due_jobs_batch_size=SCHEDULER_DUE_JOBS_BATCH_SIZE))
+
+
+# Created on first use, only adds and removes jobs of the job store (see get_scheduler)
+scheduler = None
+scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """
+    Return the scheduler jobs are added to and removed from, it only writes the job store,
+    so importing this module (views do) starts no threads or processes,
+    jobs are run by the 'run_scheduler' command process
+
+    :return: JobStoreScheduler
+    """
+    global scheduler
+    with scheduler_lock:
+        if scheduler is None:
+            scheduler = JobStoreScheduler(jobstores={'default': DjangoJobStore()}, job_defaults=job_defaults,
+                                          timezone=utc)
+            scheduler.start()
+        return scheduler
+
+
+# Created on first job execution, so only the process running due jobs connects to the broker
+publisher = None
+publisher_lock = threading.Lock()
+
+
+def get_publisher():
+    global publisher
+    with publisher_lock:
+        if publisher is None:
+            pool = MQTTClientPool(host=MQTT_BROKER_HOST,
+                                  port=MQTT_BROKER_PORT,
+                                  size=MQTT_PUBLISHER_POOL_SIZE,
+                                  transport=MQTT_BROKER_TRANSPORT,
+                                  username=MQTT_PUBLISHER_USERNAME,
+                                  password=MQTT_PUBLISHER_PASSWORD,
+                                  qos=MQTT_PUBLISHER_QOS)
+            publisher = BatchPublisher(pool,
+                                       batch_window=MQTT_PUBLISHER_BATCH_WINDOW,
+                                       timeout=MQTT_PUBLISHER_TIMEOUT)
+        return publisher
 
 
 # define the function that is to be executed
-def execute_scheduled_job(topic, payload):
-    # publish_message(topic, payload)
-    print(topic)
-    print(payload)
+def execute_scheduled_job(topic, payload, job_id=None):
+    # Jobs firing at the same time are published together by the batch publisher
+    get_publisher().submit(topic, payload, job_id=job_id)
 
 
 def schedule_new_job(device_id,
@@ -56,58 +139,52 @@ def schedule_new_job(device_id,
                      end_date_time_selected,
                      utc_start_date,
                      utc_end_date):
-    logger.info(now)
     logger.info('Started function "do_scheduled_job"')
-    logger.info('Device id: ' + device_id)
-    logger.info('Topic: ' + topic)
+    logger.info("Device id: %s", device_id)
+    logger.info("Topic: %s", topic)
     # Understand what should be sent when time arrived,
     # if job_action True then send 1, else send 0 as the message payload
     if job_action:
         message_payload = '1'
     else:
         message_payload = '0'
-    logging.info('message_payload: ' + message_payload)
+    logger.info('message_payload: %s', message_payload)
 
     # Generate random id for the job, its build from the device id + random 16 character long string
     job_id = device_id + generate_random_16_char_string()
 
     # If user selected repeated job, a cron like scheduler should run
     if is_repeated_job:
-        logging.info('Setting scheduled job with cron (repeated)')
+        logger.info('Setting scheduled job with cron (repeated)')
+        # Runs on the selected days at the time of day of the start date
+        time_of_day = {'hour': utc_start_date.hour, 'minute': utc_start_date.minute, 'second': utc_start_date.second}
         # If user selected an end date then do
         if end_date_time_selected:
             # Use 'cron' trigger, and use start, and end date
-            scheduler.add_job(execute_scheduled_job, 'cron', id=job_id,
-                              day_of_week=return_days_from_dict(repeated_days_array),
-                              start_date=utc_start_date,
-                              end_date=utc_end_date,
-                              replace_existing=True,
-                              args=[topic, message_payload])
+            get_scheduler().add_job(execute_scheduled_job, 'cron', id=job_id,
+                                    day_of_week=return_days_from_dict(repeated_days_array),
+                                    start_date=utc_start_date,
+                                    end_date=utc_end_date,
+                                    **time_of_day,
+                                    replace_existing=True,
+                                    args=[topic, message_payload, job_id])
         # If user did not marked end date then do
         else:
             # Use 'cron' trigger, use start date only
-            scheduler.add_job(execute_scheduled_job, 'cron', id=job_id,
-                              day_of_week=return_days_from_dict(repeated_days_array),
-                              start_date=utc_start_date,
-                              replace_existing=True,
-                              args=[topic, message_payload])
+            get_scheduler().add_job(execute_scheduled_job, 'cron', id=job_id,
+                                    day_of_week=return_days_from_dict(repeated_days_array),
+                                    start_date=utc_start_date,
+                                    **time_of_day,
+                                    replace_existing=True,
+                                    args=[topic, message_payload, job_id])
 
     # If a 'single time' job requested then
     else:  # Then there can be 2 options, with end time or not
-        logging.info('Setting scheduled job with date (one time run)')
-        if end_date_time_selected:
-            # Use 'date' trigger, that means run once
-            # Run function with end date
-            scheduler.add_job(execute_scheduled_job, 'date', id=job_id,
-                              start_date=utc_start_date,
-                              end_date=utc_end_date,
-                              replace_existing=True, args=[topic, message_payload])
-        else:
-            # Use 'date' trigger, that means run once
-            # Run function only with start date
-            scheduler.add_job(execute_scheduled_job, 'date', id=job_id,
-                              run_date=utc_start_date,
-                              replace_existing=True, args=[topic, message_payload])
+        logger.info('Setting scheduled job with date (one time run)')
+        # Use 'date' trigger, that means run once at start date, an end date does not apply
+        get_scheduler().add_job(execute_scheduled_job, 'date', id=job_id,
+                                run_date=utc_start_date,
+                                replace_existing=True, args=[topic, message_payload, job_id])
 
     return job_id
 
@@ -115,22 +192,18 @@ def schedule_new_job(device_id,
 # Param - receives a String
 # Kills the job with an equal id
 def remove_job_by_id(job_id):
-    logger.info(now)
     logger.info('Started function "remove_job_by_id"')
 
-    scheduler.remove_job(job_id)
+    get_scheduler().remove_job(job_id)
 
 
-# Function will receive a dictionary, and return a string
+# Function will receive a dictionary, and return a cron 'day_of_week' string, for example '0,3'
 # Param example:
 # {'Sunday': False, 'Monday': True, 'Tuesday': False,
 #  'Wednesday': False, 'Thursday': True, 'Friday': False, 'Saturday': False}
 def return_days_from_dict(days_to_repeat):
-    logger.info(now)
     logger.info('Started function "return_days_from_dict"')
-    result = ''
-    # Iterate on the input dict, and on the hard coded 'days_to_ints' dict
-    for (key, value), (key2, value2) in days_to_repeat.items(), days_to_ints.items():
-        if value:  # If current value equals True, then this day was selected for repeated job
-            result += value2  # Append the 'True' day to the result
-    return result
+    # Day names are matched case insensitive, selected days ('True') are mapped to their 'days_to_ints' number
+    days = sorted(days_to_ints[day.lower()] for day, is_selected in days_to_repeat.items() if is_selected)
+    # No selected day runs every day
+    return ','.join(str(day) for day in days) or '*'
@@ -2,6 +2,11 @@
 # REST API
 from rest_framework import serializers
 
+from nalkinscloud_mosquitto.functions import CUSTOMER_DEVICE_FIELDS
+from nalkinscloud_mosquitto.models import CustomerDevice
+from nalkinscloud_mosquitto.rollups import ROLLUP_RESOLUTIONS
+from nalkinscloud_django.settings import DEVICE_BULK_MAX_SIZE, MESSAGE_ROLLUP_MAX_POINTS, DEVICE_MESSAGES_MAX_DAYS
+
 
 class RegistrationSerializer(serializers.Serializer):
     client_secret = serializers.CharField(required=True, max_length=256)
@@ -16,6 +21,17 @@ class DeviceActivationSerializer(serializers.Serializer):
     device_name = serializers.CharField(required=True, max_length=256)
 
 
+class BulkDeviceActivationSerializer(serializers.Serializer):
+    devices = DeviceActivationSerializer(many=True, required=True, allow_empty=False)
+
+    @staticmethod
+    def validate_devices(value):
+        if len(value) > DEVICE_BULK_MAX_SIZE:
+            raise serializers.ValidationError('Ensure this field has no more than %d elements.'
+                                              % DEVICE_BULK_MAX_SIZE)
+        return value
+
+
 class ForgotPasswordSerializer(serializers.Serializer):
     client_secret = serializers.CharField(required=True, max_length=256)
     email = serializers.CharField(required=True, max_length=256)
@@ -25,6 +41,20 @@ class DeviceIdOnlySerializer(serializers.Serializer):
     device_id = serializers.CharField(required=True, max_length=256)
 
 
+class DeviceMemberSerializer(serializers.Serializer):
+    device_id = serializers.CharField(required=True, max_length=256)
+    email = serializers.CharField(required=True, max_length=256)
+
+
+class DeviceShareSerializer(DeviceMemberSerializer):
+    role = serializers.ChoiceField(required=True, choices=CustomerDevice.ROLE_CHOICES)
+
+
+class BulkDeviceIdsSerializer(serializers.Serializer):
+    device_ids = serializers.ListField(child=serializers.CharField(max_length=256), required=True,
+                                       allow_empty=False, max_length=DEVICE_BULK_MAX_SIZE)
+
+
 class ResetPasswordSerializer(serializers.Serializer):
     current_password = serializers.CharField(required=True, max_length=256)
     new_password = serializers.CharField(required=True, max_length=256)
@@ -72,3 +102,50 @@ class SetScheduledJobSerializer(serializers.Serializer):
 class DelScheduledJobSerializer(serializers.Serializer):
     device_id = serializers.CharField(required=True, max_length=256)
     job_id = serializers.CharField(required=True, max_length=256)
+
+
+class DeviceListPageSerializer(serializers.Serializer):
+    device_type = serializers.CharField(required=False, max_length=32)
+    device_model = serializers.CharField(required=False, max_length=32)
+    fields = serializers.CharField(required=False, max_length=256)
+
+    @staticmethod
+    def validate_fields(value):
+        fields = [field.strip() for field in value.split(',') if field.strip()]
+        unknown_fields = [field for field in fields if field not in CUSTOMER_DEVICE_FIELDS]
+        if not fields or unknown_fields:
+            raise serializers.ValidationError('fields must be a comma separated subset of: '
+                                              + ', '.join(CUSTOMER_DEVICE_FIELDS))
+        return fields
+
+
+class DeviceRollupsSerializer(serializers.Serializer):
+    device_id = serializers.CharField(required=True, max_length=256)
+    topic = serializers.CharField(required=True, max_length=256)
+    resolution = serializers.ChoiceField(required=True, choices=list(ROLLUP_RESOLUTIONS))
+    start = serializers.DateTimeField(required=True)
+    end = serializers.DateTimeField(required=True)
+
+    def validate(self, data):
+        if data['end'] <= data['start']:
+            raise serializers.ValidationError('end should be after start')
+        points = (data['end'] - data['start']).total_seconds() / ROLLUP_RESOLUTIONS[data['resolution']]
+        if points > MESSAGE_ROLLUP_MAX_POINTS:
+            raise serializers.ValidationError('Requested range has more than %d points, use a lower resolution'
+                                              % MESSAGE_ROLLUP_MAX_POINTS)
+        return data
+
+
+class DeviceMessagesSerializer(serializers.Serializer):
+    device_id = serializers.CharField(required=True, max_length=256)
+    start = serializers.DateTimeField(required=True)
+    end = serializers.DateTimeField(required=True)
+    # Not 'format', which is reserved by the REST framework for content negotiation
+    output = serializers.ChoiceField(required=False, choices=['json', 'ndjson'], default='json')
+
+    def validate(self, data):
+        if data['end'] <= data['start']:
+            raise serializers.ValidationError('end should be after start')
+        if DEVICE_MESSAGES_MAX_DAYS and (data['end'] - data['start']).total_seconds() > DEVICE_MESSAGES_MAX_DAYS * 86400:
+            raise serializers.ValidationError('Requested range is longer than %d days' % DEVICE_MESSAGES_MAX_DAYS)
+        return data
@@ -0,0 +1,31 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.db import transaction
+from oauth2_provider.models import AccessToken, Application
+
+from django_user_email_extension.models import User
+from nalkinscloud_api.authentication import invalidate_access_token
+from nalkinscloud_api.functions import invalidate_client_secret_hashes
+
+
+@receiver(post_save, sender=AccessToken, dispatch_uid='invalidate_access_token_on_save')
+@receiver(post_delete, sender=AccessToken, dispatch_uid='invalidate_access_token_on_delete')
+def invalidate_access_token_on_change(sender, instance, **kwargs):
+    # Revoking a token deletes it
+    invalidate_access_token(instance.token)
+
+
+@receiver(post_save, sender=User, dispatch_uid='invalidate_access_tokens_on_user_save')
+def invalidate_access_tokens_on_user_change(sender, instance, created, **kwargs):
+    # Cached tokens hold a copy of the user (is_active, password...), deleting a user deletes its tokens
+    if not created:
+        for token in AccessToken.objects.filter(user=instance).values_list('token', flat=True):
+            invalidate_access_token(token)
+
+
+@receiver(post_save, sender=Application, dispatch_uid='invalidate_client_secrets_on_save')
+@receiver(post_delete, sender=Application, dispatch_uid='invalidate_client_secrets_on_delete')
+def invalidate_client_secrets_on_application_change(sender, instance, **kwargs):
+    invalidate_client_secret_hashes()
+    # Secrets might be reloaded by another request before the change is committed
+    transaction.on_commit(invalidate_client_secret_hashes)
@@ -1,7 +1,17 @@
-
-from scheduler.celery import *
+from nalkinscloud_api import email_queue
+from scheduler.celery import app
 
 
 @app.task
 def add(x, y):
     return x + y
+
+
+@app.task(acks_late=True)
+def send_queued_emails():
+    """
+    Send due queued emails, an alternative to the 'send_emails' worker, for example from celery beat
+
+    :return: tuple of (sent count, failed count)
+    """
+    return email_queue.send_queued_emails()
@@ -0,0 +1,104 @@
+# In process SMTP server stand-in, used by tests instead of a real mail server,
+# Implements the subset of SMTP used by django's smtp backend without TLS or authentication
+import email
+import socketserver
+import threading
+import time
+
+
+class LocalSMTPHandler(socketserver.StreamRequestHandler):
+
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        server = self.server.smtp_server
+        server.on_connect()
+        self.reply('220 localhost SMTP stand-in')
+        sender, recipients = None, []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command, _, argument = line.decode('utf-8').strip().partition(' ')
+            command = command.upper()
+            if command in ('EHLO', 'HELO'):
+                self.reply('250 localhost')
+            elif command == 'MAIL':
+                sender, recipients = argument.split(':', 1)[1].strip(' <>'), []
+                self.reply('250 OK')
+            elif command == 'RCPT':
+                recipient = argument.split(':', 1)[1].strip(' <>')
+                if recipient in server.rejected_recipients:
+                    self.reply('550 Mailbox unavailable')
+                else:
+                    recipients.append(recipient)
+                    self.reply('250 OK')
+            elif command == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = bytearray()
+                while True:
+                    line = self.rfile.readline()
+                    if not line or line == b'.\r\n':
+                        break
+                    data.extend(line[1:] if line.startswith(b'..') else line)
+                server.on_message(sender, recipients, email.message_from_bytes(bytes(data)))
+                self.reply('250 OK')
+            elif command in ('RSET', 'NOOP'):
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+
+class LocalSMTPServer(object):
+    """
+    Usage:
+        server = LocalSMTPServer()
+        server.start()  # Listens on 127.0.0.1:server.port
+        ...
+        server.messages  # List of (sender, recipients, email.message.Message) tuples
+        server.stop()
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, rejected_recipients=()):
+        self.host = host
+        self.port = port
+        self.rejected_recipients = set(rejected_recipients)
+        self.messages = []
+        self.connections_count = 0
+        self._lock = threading.Condition()
+        self._server = None
+
+    def start(self):
+        self._server = socketserver.ThreadingTCPServer((self.host, self.port), LocalSMTPHandler)
+        self._server.daemon_threads = True
+        self._server.smtp_server = self
+        self.port = self._server.server_address[1]
+        threading.Thread(target=self._server.serve_forever, name='local-smtp-server', daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def on_connect(self):
+        with self._lock:
+            self.connections_count += 1
+
+    def on_message(self, sender, recipients, message):
+        with self._lock:
+            self.messages.append((sender, recipients, message))
+            self._lock.notify_all()
+
+    def wait_for_messages(self, count, timeout=5):
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            while len(self.messages) < count:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._lock.wait(remaining)
+            return True
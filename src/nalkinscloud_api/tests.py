@@ -1,7 +1,36 @@
 
-from django.test import TestCase
+from django.core.mail import get_connection
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.management import call_command
+from django.db import DatabaseError, connection
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from nalkinscloud_api.email_queue import queue_email, send_queued_emails
 from nalkinscloud_api.functions import *
+from nalkinscloud_api.logging_filter import LogSamplingMiddleware, SamplingFilter
+from nalkinscloud_api.logging_handlers import GELFBatchTCPHandler, QueueListenerHandler
+from nalkinscloud_api.models import OutboundEmail
+from nalkinscloud_api.scheduler import create_scheduler, create_wheel_scheduler, execute_scheduled_jobs, \
+    get_scheduler, job_defaults, remove_job_by_id, return_days_from_dict, schedule_new_job
+from nalkinscloud_api.testing import LocalSMTPServer
+from nalkinscloud_django.profiling import ProfilingMiddleware
+from nalkinscloud_django.settings import EMAIL_QUEUE_MAX_ATTEMPTS, PROJECT_NAME
+from django_user_email_extension.models import User
+from scheduler.models import ScheduledJob
+from scheduler.schedulers import JobStoreScheduler
+from scheduler.timing_wheel import get_weekdays_mask, get_weekly_schedule
 import datetime
+import io
+import json
+import logging
+import os
+import socket
+import tempfile
+import threading
+import time
+import types
 
 
 class TestAPIFunctions(TestCase):
@@ -35,6 +64,27 @@ class TestAPIFunctions(TestCase):
             'message': ['array_value']
         })
 
+    def test_stream_json_response(self):
+        def get_values(fail):
+            yield {'value': 1}
+            if fail:
+                raise DatabaseError('connection lost')
+            yield {'value': 2}
+
+        self.assertEqual(json.loads(''.join(stream_json_response('success', get_values(False)))),
+                         {'status': 'success', 'message': [{'value': 1}, {'value': 2}]})
+        self.assertEqual([json.loads(line) for line in stream_json_response('success', get_values(False), 'ndjson')],
+                         [{'value': 1}, {'value': 2}])
+
+        with self.assertLogs(logging.getLogger(PROJECT_NAME), logging.ERROR):
+            self.assertEqual(json.loads(''.join(stream_json_response('success', get_values(True),
+                                                                     error_message='Failed'))),
+                             {'status': 'failed', 'error': 'Failed', 'message': [{'value': 1}]})
+        with self.assertLogs(logging.getLogger(PROJECT_NAME), logging.ERROR):
+            self.assertEqual([json.loads(line) for line in stream_json_response('success', get_values(True), 'ndjson',
+                                                                                error_message='Failed')],
+                             [{'value': 1}, {'status': 'failed', 'message': 'Failed'}])
+
     def test_get_utc_datetime(self):
         date_time = datetime.datetime.strptime('2019-01-01 12:01:01', '%Y-%m-%d %H:%M:%S')
         none_type = None
@@ -57,3 +107,260 @@ class TestAPIFunctions(TestCase):
     def test_is_client_secret_exists(self):
         self.assertTrue(is_client_secret_exists(client_secret=self.oauth_client_secret))
         self.assertFalse(is_client_secret_exists(client_secret='some_other_client_secret'))
+
+    def test_is_client_secret_exists_cached(self):
+        is_client_secret_exists(client_secret=self.oauth_client_secret)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(is_client_secret_exists(client_secret=self.oauth_client_secret))
+            self.assertFalse(is_client_secret_exists(client_secret='some_other_client_secret'))
+        self.assertEqual(len(queries), 0, "Should check secrets without queries")
+
+        self.oauth_client.client_secret = 'some_new_client_secret'
+        self.oauth_client.save()
+        self.assertTrue(is_client_secret_exists(client_secret='some_new_client_secret'))
+        self.assertFalse(is_client_secret_exists(client_secret=self.oauth_client_secret))
+
+        self.oauth_client.delete()
+        self.assertFalse(is_client_secret_exists(client_secret='some_new_client_secret'))
+
+
+class TestEmailQueue(TestCase):
+    def setUp(self):
+        self.smtp_server = LocalSMTPServer(rejected_recipients=['rejected@nalkins.cloud']).start()
+
+    def tearDown(self):
+        self.smtp_server.stop()
+
+    def get_connection(self):
+        return get_connection('django.core.mail.backends.smtp.EmailBackend', host=self.smtp_server.host,
+                              port=self.smtp_server.port, username='', password='', use_tls=False)
+
+    def test_send_queued_emails(self):
+        for index in range(3):
+            queue_email('subject %d' % index, 'body', 'user_%d@nalkins.cloud' % index, from_email='from@nalkins.cloud')
+
+        self.assertEqual(send_queued_emails(connection=self.get_connection()), (3, 0))
+        self.assertEqual(self.smtp_server.connections_count, 1, "Should send the batch over one connection")
+        self.assertEqual([(recipients, message['Subject']) for sender, recipients, message in self.smtp_server.messages],
+                         [(['user_%d@nalkins.cloud' % index], 'subject %d' % index) for index in range(3)])
+        self.assertFalse(OutboundEmail.objects.exclude(status=OutboundEmail.STATUS_SENT).exists())
+        self.assertEqual(send_queued_emails(connection=self.get_connection()), (0, 0), "Should not send emails twice")
+
+    def test_retry_backoff(self):
+        queue_email('subject', 'body', 'rejected@nalkins.cloud')
+        queue_email('subject', 'body', 'user@nalkins.cloud')
+
+        self.assertEqual(send_queued_emails(connection=self.get_connection()), (1, 1))
+        email = OutboundEmail.objects.get(to_email='rejected@nalkins.cloud')
+        self.assertEqual((email.status, email.attempts), (OutboundEmail.STATUS_PENDING, 1))
+        self.assertGreater(email.next_attempt_at, timezone.now(), "Should wait before retrying")
+        self.assertIn('550', email.last_error)
+        self.assertEqual(send_queued_emails(connection=self.get_connection()), (0, 0))
+
+        for attempt in range(2, EMAIL_QUEUE_MAX_ATTEMPTS + 1):
+            OutboundEmail.objects.filter(id=email.id).update(next_attempt_at=timezone.now())
+            self.assertEqual(send_queued_emails(connection=self.get_connection()), (0, 1))
+        self.assertEqual(OutboundEmail.objects.get(id=email.id).status, OutboundEmail.STATUS_FAILED)
+
+    def test_mail_server_down(self):
+        queue_email('subject', 'body', 'user@nalkins.cloud')
+        connection = self.get_connection()
+        self.smtp_server.stop()
+
+        self.assertEqual(send_queued_emails(connection=connection), (0, 1))
+        self.assertEqual(OutboundEmail.objects.get().status, OutboundEmail.STATUS_PENDING)
+
+    def test_send_emails_command(self):
+        queue_email('subject', 'body', 'user@nalkins.cloud')
+        stdout = io.StringIO()
+        call_command('send_emails', '--once', stdout=stdout)
+        self.assertEqual(stdout.getvalue().strip(), 'Sent 1 emails, 0 failed')
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append((self.format(record), threading.current_thread()))
+
+
+class TestLogging(TestCase):
+    def setUp(self):
+        self.target = ListHandler()
+        self.handler = QueueListenerHandler([self.target], queue_size=10)
+        self.logger = logging.getLogger('nalkinscloud-api.tests.logging')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.DEBUG)
+        self.logger.addHandler(self.handler)
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+        self.handler.close()
+
+    def test_queue_handler(self):
+        self.logger.info('message %s of %d', 'number', 1)
+        try:
+            1 / 0
+        except ZeroDivisionError:
+            self.logger.exception('failed')
+        self.handler.flush()
+
+        self.assertEqual(len(self.target.records), 2)
+        self.assertEqual(self.target.records[0][0], 'message number of 1')
+        self.assertTrue(self.target.records[1][0].startswith('failed\nTraceback'))
+        self.assertNotEqual(self.target.records[0][1], threading.current_thread(), "Should be handled by the listener")
+
+    def test_queue_full(self):
+        self.handler.stop()
+        for i in range(15):
+            self.logger.info('message %d', i)
+        self.assertEqual(self.handler.dropped_count, 5, "Should drop records instead of blocking")
+        self.handler.start()
+        self.handler.flush()
+        self.assertEqual(len(self.target.records), 10)
+
+    def test_sampling(self):
+        self.handler.addFilter(SamplingFilter())
+
+        def view(request):
+            self.logger.info('sampled out')
+            self.logger.warning('kept')
+
+        LogSamplingMiddleware(view, rate=0)(None)
+        self.logger.info('outside request')
+        LogSamplingMiddleware(view, rate=1)(None)
+        self.handler.flush()
+        self.assertEqual([message for message, thread in self.target.records],
+                         ['kept', 'outside request', 'sampled out', 'kept'])
+
+    def test_gelf_batch(self):
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        gelf_handler = GELFBatchTCPHandler('127.0.0.1', server.getsockname()[1])
+        handler = QueueListenerHandler([gelf_handler])
+        self.logger.addHandler(handler)
+        try:
+            handler.stop()  # Queue all records, so they are sent as a single batch
+            for i in range(3):
+                self.logger.info('message %d', i)
+            handler.start()
+            handler.flush()
+
+            client, address = server.accept()
+            client.settimeout(5)
+            data = b''
+            while data.count(b'\x00') < 3:
+                data += client.recv(65536)
+            client.close()
+        finally:
+            self.logger.removeHandler(handler)
+            handler.close()
+            gelf_handler.close()
+            server.close()
+        frames = [json.loads(frame.decode('utf-8')) for frame in data.split(b'\x00') if frame]
+        self.assertEqual([frame['short_message'] for frame in frames], ['message 0', 'message 1', 'message 2'])
+
+
+class TestProfiling(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    @staticmethod
+    def slow_view(request):
+        User.objects.filter(email='user@nalkins.cloud').exists()
+        deadline = time.perf_counter() + 0.05
+        while time.perf_counter() < deadline:
+            pass
+        return HttpResponse()
+
+    def get_middleware(self, get_response, **kwargs):
+        kwargs = dict(dict(enabled=True, threshold=0.03, sample_rate=0, interval=0.002,
+                           directory=self.directory, max_files=2), **kwargs)
+        return ProfilingMiddleware(get_response, **kwargs)
+
+    def test_slow_request(self):
+        middleware = self.get_middleware(self.slow_view)
+        middleware(RequestFactory().get('/slow/'))
+        self.get_middleware(lambda request: HttpResponse())(RequestFactory().get('/fast/'))
+
+        file_names = sorted(os.listdir(self.directory))
+        self.assertEqual(len(file_names), 2, "Should only profile the slow request")
+        with open(os.path.join(self.directory, file_names[1])) as profile_file:
+            profile = json.load(profile_file)
+        self.assertEqual((profile['path'], profile['queries_count']), ('/slow/', 1))
+        self.assertIn('users', profile['queries'][0]['sql'])
+        self.assertTrue(any('slow_view' in stack for stack in profile['stacks']))
+        with open(os.path.join(self.directory, file_names[0])) as folded_file:
+            self.assertRegex(folded_file.readline(), r'^\S.*;.* \d+$')
+
+        for i in range(2):
+            middleware(RequestFactory().get('/slow/'))
+        self.assertEqual(len(os.listdir(self.directory)), 4, "Should keep the newest 2 profiles")
+
+        stdout = io.StringIO()
+        call_command('profile_summary', '--dir', self.directory, stdout=stdout)
+        summary = stdout.getvalue()
+        self.assertIn('GET <unresolved>: 2 profiles', summary)
+        self.assertIn('slow_view', summary)
+        self.assertIn('WHERE "users"."email" = ?', summary)
+
+    def test_disabled(self):
+        with self.assertRaises(MiddlewareNotUsed):
+            self.get_middleware(self.slow_view, enabled=False)
+
+
+class TestScheduler(TestCase):
+    def test_schedule_new_job(self):
+        run_date = timezone.now() + datetime.timedelta(days=1)
+        job_id = schedule_new_job('scheduler_test_device', 'scheduler_test_device/switch', False, {}, True,
+                                  False, run_date, None)
+
+        # Written to the job store only, run by the 'run_scheduler' process
+        self.assertIsInstance(get_scheduler(), JobStoreScheduler)
+        self.assertEqual(ScheduledJob.objects.get(id=job_id).next_run_time, run_date.timestamp())
+        remove_job_by_id(job_id)
+        self.assertFalse(ScheduledJob.objects.filter(id=job_id).exists())
+
+    def test_create_scheduler(self):
+        runner = create_scheduler(thread_pool_size=2, process_pool_size=1)
+        self.assertFalse(runner.running)
+        self.assertEqual(runner._job_defaults['misfire_grace_time'], job_defaults['misfire_grace_time'])
+
+    def test_schedule_repeated_job(self):
+        start_date = datetime.datetime(2030, 1, 1, 8, 30, 15, tzinfo=datetime.timezone.utc)
+        days = {'sunday': True, 'monday': False, 'tuesday': True, 'wednesday': False, 'thursday': False,
+                'friday': False, 'saturday': False}
+        job_id = schedule_new_job('scheduler_test_device', 'scheduler_test_device/switch', True, days, True,
+                                  False, start_date, None)
+
+        # Runs on the selected days at the time of the start date
+        job = get_scheduler().get_job(job_id)
+        self.assertEqual(job.next_run_time, start_date)
+        self.assertEqual(get_weekly_schedule(job.trigger), (get_weekdays_mask([1, 6]), 8 * 3600 + 30 * 60 + 15))
+        remove_job_by_id(job_id)
+
+    def test_return_days_from_dict(self):
+        self.assertEqual(return_days_from_dict({'Sunday': True, 'Monday': True, 'Tuesday': False}), '0,6')
+        self.assertEqual(return_days_from_dict({'thursday': True, 'friday': False}), '3')
+        self.assertEqual(return_days_from_dict({'monday': False}), '*')
+
+    def test_execute_scheduled_jobs(self):
+        calls = []
+
+        def failing_job():
+            raise ValueError('failed')
+
+        jobs = [types.SimpleNamespace(id='failing_job', func=failing_job, args=(), kwargs={}),
+                types.SimpleNamespace(id='job', func=calls.append, args=('payload',), kwargs={})]
+        with self.assertLogs(logging.getLogger(PROJECT_NAME), logging.ERROR):
+            execute_scheduled_jobs(jobs)
+        self.assertEqual(calls, ['payload'], "Should run the remaining jobs of the batch")
+
+    def test_create_wheel_scheduler(self):
+        runner = create_wheel_scheduler(thread_pool_size=2)
+        self.assertFalse(runner.is_lease_holder)
+        self.assertEqual(runner.lease_renew_interval, job_defaults['misfire_grace_time'] / 2)
+        runner.executor.shutdown()
@@ -23,11 +23,21 @@ urlpatterns = [
     url(r'^register/', views_api.RegistrationView.as_view(), name='register'),
     url(r'^health_check/', views_api.HealthCheckView.as_view(), name='health_check'),  # Auth require
     url(r'^device_activation/', views_api.DeviceActivationView.as_view(), name='device_activation'),  # Auth require
+    url(r'^device_activation_bulk/', views_api.BulkDeviceActivationView.as_view(),
+        name='device_activation_bulk'),  # Auth require
     url(r'^device_list/', views_api.DeviceListView.as_view(), name='device_list'),  # Auth require
+    url(r'^device_list_page/', views_api.DeviceListPageView.as_view(), name='device_list_page'),  # Auth require
+    url(r'^device_rollups/', views_api.DeviceRollupsView.as_view(), name='device_rollups'),  # Auth require
+    url(r'^device_messages/', views_api.DeviceMessagesView.as_view(), name='device_messages'),  # Auth require
+    url(r'^devices_state/', views_api.DevicesStateView.as_view(), name='devices_state'),  # Auth require
+    url(r'^device_share/', views_api.DeviceShareView.as_view(), name='device_share'),  # Auth require
+    url(r'^device_unshare/', views_api.DeviceUnshareView.as_view(), name='device_unshare'),  # Auth require
+    url(r'^device_members/', views_api.DeviceMembersView.as_view(), name='device_members'),  # Auth require
     url(r'^forgot_password/', views_api.ForgotPasswordView.as_view(), name='forgot_password'),
     url(r'^get_device_pass/', views_api.GetDevicePassView.as_view(), name='get_device_pass'),  # Auth require
     url(r'^get_scheduled_job/', views_api.GetScheduledJobView.as_view(), name='get_scheduled_job'),  # Auth require
     url(r'^remove_device/', views_api.RemoveDeviceView.as_view(), name='remove_device'),  # Auth require
+    url(r'^remove_device_bulk/', views_api.BulkRemoveDeviceView.as_view(), name='remove_device_bulk'),  # Auth require
     url(r'^reset_password/', views_api.ResetPasswordView.as_view(), name='reset_password'),  # Auth require
     url(r'^set_scheduled_job/', views_api.SetScheduledJobView.as_view(), name='set_scheduled_job'),  # Auth require
     url(r'^del_scheduled_job/', views_api.DelScheduledJobView.as_view(), name='del_scheduled_job'),  # Auth require
@@ -8,7 +8,7 @@ from django.contrib.auth import logout, authenticate, login
 
 from django_user_email_extension.models import verify_record
 
-from nalkinscloud_mosquitto.functions import get_customers_devices
+from nalkinscloud_mosquitto.functions import get_customers_device_list
 from nalkinscloud_django.settings import BASE_DIR, PROJECT_NAME, VERSION, HOSTNAME, ENVIRONMENT,\
     MQTT_BROKER_HOST, MQTT_BROKER_PORT
 
@@ -28,8 +28,8 @@ context = {
 
 # Render main index page
 def index(request):
-    default_logger.info("index request at: " + str(datetime.datetime.now()))
-    default_logger.info(request)
+    default_logger.info("index request")
+    default_logger.info("%s", request)
 
     return render(
         request,
@@ -41,22 +41,22 @@ def index(request):
 
 def verify_account(request, uuid):
 
-    default_logger.info("verify_account request at: " + str(datetime.datetime.now()))
-    default_logger.info(request)
+    default_logger.info("verify_account request")
+    default_logger.info("%s", request)
 
     try:
         if verify_record(uuid_value=uuid):
             return redirect('/verify_account_successful/')
     except Exception as e:
-        default_logger.info(e)
+        default_logger.info("%s", e)
         pass
 
     return redirect('/verify_account_failed/')
 
 
 def verify_account_successful(request):
-    default_logger.info("verify_account_successful request at: " + str(datetime.datetime.now()))
-    default_logger.info(request)
+    default_logger.info("verify_account_successful request")
+    default_logger.info("%s", request)
 
     return render(
         request,
@@ -67,8 +67,8 @@ def verify_account_successful(request):
 
 
 def verify_account_failed(request):
-    default_logger.info("verify_account_failed request at: " + str(datetime.datetime.now()))
-    default_logger.info(request)
+    default_logger.info("verify_account_failed request")
+    default_logger.info("%s", request)
 
     return render(
         request,
@@ -79,15 +79,15 @@ def verify_account_failed(request):
 
 
 def logout_process(request):
-    default_logger.info("logout_process request at: " + str(datetime.datetime.now()) + " by user: " + str(request.user))
+    default_logger.info("logout_process request by user: %s", request.user)
 
     logout(request)
     return HttpResponseRedirect('/')
 
 
 def login_page(request):
-    default_logger.info("login_page request at: " + str(datetime.datetime.now()))
-    default_logger.info(request)
+    default_logger.info("login_page request")
+    default_logger.info("%s", request)
 
     if request.user.is_authenticated:
         return HttpResponseRedirect('/')
@@ -101,8 +101,8 @@ def login_page(request):
 
 
 def login_process(request):
-    default_logger.info("login_process request at: " + str(datetime.datetime.now()))
-    default_logger.info(str(request))
+    default_logger.info("login_process request")
+    default_logger.info("%s", request)
 
     temp_context = context.copy()
 
@@ -113,13 +113,13 @@ def login_process(request):
 
         user = authenticate(request, email=email, password=password)
         if user is not None:
-            default_logger.info("user: " + str(user) + " Authenticated, moving on")
+            default_logger.info("user: %s Authenticated, moving on", user)
             if user.is_active:
-                default_logger.error("user: " + str(user) + " is active, perform login")
+                default_logger.error("user: %s is active, perform login", user)
                 login(request, user)
                 return HttpResponseRedirect('/')
             else:
-                default_logger.error("user: " + str(user) + " is not active, stop login, show error context")
+                default_logger.error("user: %s is not active, stop login, show error context", user)
                 temp_context.update({'error': 'User is not active, please make sure your email was verified'})
         else:
             default_logger.error("email could not be authenticated, stop login, show error context")
@@ -138,30 +138,19 @@ def login_process(request):
 
 @login_required
 def devices_view(request):
-    default_logger.info("devices_view request at: " + str(datetime.datetime.now()))
+    default_logger.info("devices_view request")
     temp_context = context.copy()
     temp_context.update({'broker_host': MQTT_BROKER_HOST, 'broker_port': MQTT_BROKER_PORT})
 
-    device_list = get_customers_devices(request.user)
+    device_list = get_customers_device_list(request.user)
 
     if not device_list:
         default_logger.info('no devices found')
     else:
-        default_logger.info("user: " + str(request.user.email) + " devices found: " + str(device_list))
+        default_logger.info("user: %s devices found: %s", request.user.email, device_list)
+        temp_context.update({'device_list': device_list})
 
-        json_array = []
-        # Build Json array from the 'device_list' response from the DB
-        for device in device_list:
-            device_id = str(device.device_id)
-            device_name = str(device.device_name)
-            device_type = str(device.device_id.type)
-
-            tmp_json = {"device_id": device_id, "device_name": device_name, "device_type": device_type}
-
-            json_array.append(tmp_json)  # Append current details (device) to the array
-        temp_context.update({'device_list': json_array})
-
-    print('current context: ' + str(temp_context))
+    default_logger.debug("current context: %s", temp_context)
     return render(
         request,
         BASE_DIR + '/templates/devices.html',
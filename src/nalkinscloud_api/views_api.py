@@ -1,10 +1,15 @@
 import logging
 from ipware.ip import get_real_ip
 
-from nalkinscloud_django.settings import PROJECT_NAME, FRONTEND_DOMAIN, EMAIL_HOST_USER
+from nalkinscloud_django.settings import PROJECT_NAME, FRONTEND_DOMAIN, EMAIL_HOST_USER, DEVICE_MESSAGES_CHUNK_SIZE
 from nalkinscloud_api.scheduler import schedule_new_job, remove_job_by_id
 from nalkinscloud_mosquitto.functions import *
+from nalkinscloud_mosquitto.rollups import get_rollup_series
+from nalkinscloud_mosquitto.partitions import get_messages
 from nalkinscloud_api.functions import *
+from nalkinscloud_api.pagination import CustomerDeviceCursorPagination
+from nalkinscloud_api.email_queue import queue_email
+from nalkinscloud_api.forms import QueuedPasswordResetForm
 from django_user_email_extension.models import *
 
 # Import serializers
@@ -16,7 +21,7 @@ from rest_framework import status
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.views import APIView
 
-from django.contrib.auth.forms import PasswordResetForm
+from django.http import StreamingHttpResponse
 from django.urls import reverse
 
 # Define logger
@@ -28,12 +33,11 @@ class HealthCheckView(APIView):
 
     @staticmethod
     def post(request):
-        logger.info("HealthCheckView request at: " + str(datetime.datetime.now()))
+        logger.info("HealthCheckView request")
 
-        # Get token from request
-        token = request.auth
-        email = str(token.user)
-        logger.info("request from user: " + email)
+        # Get user from request
+        email = request.user.email
+        logger.info("request from user: %s", email)
 
         message = 'success'
 
@@ -53,10 +57,10 @@ class RegistrationView(APIView):
         if not serializer.is_valid():
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-        logger.info("New Registration request at: " + str(datetime.datetime.now()))
+        logger.info("New Registration request")
 
         data = serializer.data
-        logger.info("Request Parameters: " + str(data))
+        logger.info("Request Parameters: %s", data)
 
         ip = get_real_ip(request)
         if ip is not None:
@@ -108,9 +112,8 @@ class RegistrationView(APIView):
                            FRONTEND_DOMAIN + '%s' % reverse('nalkinscloud_api:verify_account',
                                                             kwargs={'uuid': str(new_user.get_uuid_of_email())})
 
-                    new_user.send_verification_email(subject=subject,
-                                                     body=body,
-                                                     from_mail=EMAIL_HOST_USER)
+                    # Sent by the email queue worker, SMTP latency or outages do not fail the registration
+                    queue_email(subject, body, new_user.email, from_email=EMAIL_HOST_USER)
                     message = 'success'
                     value = 'Registered!'
                     response_code = status.HTTP_201_CREATED
@@ -128,10 +131,10 @@ class DeviceActivationView(APIView):
         if not serializer.is_valid():
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
         else:
-            logger.info("New DeviceActivation request at: " + str(datetime.datetime.now()))
+            logger.info("New DeviceActivation request")
 
             data = serializer.data
-            logger.info("Request Parameters: " + str(data))
+            logger.info("Request Parameters: %s", data)
 
             device_id_string = data['device_id']
             device_name = data['device_name']
@@ -142,14 +145,13 @@ class DeviceActivationView(APIView):
                 response_code = status.HTTP_204_NO_CONTENT
                 logger.error("Device does not exists")
             else:
-                # Get token from request
-                token = request.auth
-                email = token.user
-                user = User.objects.get(email=email)
+                # Get user from request
+                user = request.user
+                email = user.email
                 user_device = Device.objects.get(device_id=email)
                 device = Device.objects.get(device_id=device_id_string)
 
-                logger.info("Current logged in user: " + str(email) + " ID is: " + str(user))
+                logger.info("Current logged in user: %s ID is: %s", email, user)
 
                 # Check if the activated device is new (never got activated)
                 # or the original username is activating his device again
@@ -189,46 +191,84 @@ class DeviceActivationView(APIView):
             return Response(build_json_response(message, value), status=response_code)
 
 
+class BulkDeviceActivationView(APIView):
+    permission_classes = (IsAuthenticated,)
+
+    @staticmethod
+    def post(request):
+        serializer = BulkDeviceActivationSerializer(data=request.data)
+
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        logger.info("New BulkDeviceActivation request from user: %s devices count: %s",
+                    request.user, len(serializer.validated_data['devices']))
+
+        # On duplicate device ids the last device name is used
+        devices = {device['device_id']: device['device_name'] for device in serializer.validated_data['devices']}
+        results = activate_devices(request.user, devices)
+
+        value = [build_bulk_item_response(device_id, results[device_id]) for device_id in devices]
+        return Response(build_json_response('success', value), status=status.HTTP_200_OK)
+
+
 class DeviceListView(APIView):
     permission_classes = (IsAuthenticated,)
 
     @staticmethod
     def post(request):
         # Print request to log file
-        logger.info("New DeviceList request at: " + str(datetime.datetime.now()))
+        logger.info("New DeviceList request")
 
-        token = request.auth
-        email = token.user
-        user_id = token.user_id
-        logger.info("request from user: " + str(email))
+        email = request.user.email
+        user_id = request.user.pk
+        logger.info("request from user: %s", email)
 
-        device_list = get_customers_devices(user_id)  # Get list of devices from the DB
+        device_list = get_customers_device_list(user_id)  # Get list of devices (cached)
         if not device_list:
             message = 'failed'
             value = 'no devices found'
             response_code = status.HTTP_204_NO_CONTENT
             logger.info('No devices found')
         else:
-            logger.info("User: " + str(email) + " Devices found: " + str(device_list))
-
-            json_array = []
-            # Build Json array from the 'device_list' response from the DB
-            for device in device_list:
-                device_id = str(device.device_id)
-                device_name = str(device.device_name)
-                device_type = str(device.device_id.type)
-
-                tmp_json = {"device_id": device_id, "device_name": device_name, "device_type": device_type}
+            logger.info("User: %s Devices found: %s", email, device_list)
 
-                json_array.append(tmp_json)  # Append current details (device) to the array
-                logger.info(json_array)
             response_code = status.HTTP_200_OK
             message = 'success'
-            value = json_array  # Set the final json array to 'value'
+            value = device_list  # Each device is a dict of device_id, device_name and device_type
 
         return Response(build_json_response(message, value), status=response_code)
 
 
+class DeviceListPageView(APIView):
+    permission_classes = (IsAuthenticated,)
+
+    @staticmethod
+    def get(request):
+        serializer = DeviceListPageSerializer(data=request.query_params)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        data = serializer.validated_data
+        logger.info("New DeviceListPage request from user: %s params: %s", request.user, data)
+
+        devices = get_customers_devices_values(request.user,
+                                               device_type=data.get('device_type'),
+                                               device_model=data.get('device_model'),
+                                               fields=data.get('fields'))
+
+        paginator = CustomerDeviceCursorPagination()
+        page = paginator.paginate_queryset(devices, request)
+        value = {
+            'next': paginator.get_next_link(),
+            'previous': paginator.get_previous_link(),
+            'results': page,
+        }
+        for device in page:
+            del device['id']  # Only fetched as the pagination key (links are already built)
+        return Response(build_json_response('success', value), status=status.HTTP_200_OK)
+
+
 class ForgotPasswordView(APIView):
     permission_classes = ()
 
@@ -239,10 +279,10 @@ class ForgotPasswordView(APIView):
         if not serializer.is_valid():
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
         else:
-            logger.info("New ForgotPassword request at: " + str(datetime.datetime.now()))
+            logger.info("New ForgotPassword request")
 
             data = serializer.data
-            logger.info("Request Parameters: " + str(data))
+            logger.info("Request Parameters: %s", data)
 
             client_secret = data['client_secret']
 
@@ -266,7 +306,7 @@ class ForgotPasswordView(APIView):
                     logger.error("Error, email does not exist")
                 else:
                     # If all passed OK
-                    form = PasswordResetForm(data)
+                    form = QueuedPasswordResetForm(data)
                     if not form.is_valid():
                         message = 'failed'
                         value = 'Form is not valid'
@@ -275,7 +315,7 @@ class ForgotPasswordView(APIView):
                     else:
                         logger.info("Forgot password form is valid")
                         form.save(request=request)
-                        logger.info("Success, Email sent to: " + data['email'])
+                        logger.info("Success, Email queued to: %s", data['email'])
                         message = 'success'
                         value = 'Forgot Password Process completed'
                         response_code = status.HTTP_200_OK
@@ -283,6 +323,67 @@ class ForgotPasswordView(APIView):
             return Response(build_json_response(message, value), status=response_code)
 
 
+class DeviceRollupsView(APIView):
+    permission_classes = (IsAuthenticated,)
+
+    @staticmethod
+    def get(request):
+        serializer = DeviceRollupsSerializer(data=request.query_params)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        data = serializer.validated_data
+        logger.info("New DeviceRollups request from user: %s params: %s", request.user, data)
+
+        if not is_device_owned_by_user(data['device_id'], request.user):
+            logger.error("User is not the device owner")
+            return Response(build_json_response('failed', 'You cannot access this device'),
+                            status=status.HTTP_409_CONFLICT)
+
+        value = get_rollup_series(data['device_id'], data['topic'], data['resolution'], data['start'], data['end'])
+        return Response(build_json_response('success', value), status=status.HTTP_200_OK)
+
+
+class DeviceMessagesView(APIView):
+    permission_classes = (IsAuthenticated,)
+
+    @staticmethod
+    def get(request):
+        serializer = DeviceMessagesSerializer(data=request.query_params)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        data = serializer.validated_data
+        logger.info("New DeviceMessages request from user: %s params: %s", request.user, data)
+
+        # Ownership is checked once, messages are then read without joining devices
+        device_type = get_owned_device_type(data['device_id'], request.user)
+        if device_type is None:
+            logger.error("User is not the device owner")
+            return Response(build_json_response('failed', 'You cannot access this device'),
+                            status=status.HTTP_409_CONFLICT)
+
+        messages = ({'topic': message['topic'], 'message': message['message'], 'qos': message['qos'],
+                     'date_created': message['date_created']}
+                    for message in get_messages(data['start'], data['end'], device_id=data['device_id'],
+                                                device_type=device_type, chunk_size=DEVICE_MESSAGES_CHUNK_SIZE))
+        # A failure while reading messages ends the body with a 'failed' status (the 200 status code is already sent)
+        response = stream_json_response('success', messages, data['output'], error_message='Failed to read messages')
+        if data['output'] == 'ndjson':
+            return StreamingHttpResponse(response, content_type='application/x-ndjson')
+        return StreamingHttpResponse(response, content_type='application/json')
+
+
+class DevicesStateView(APIView):
+    permission_classes = (IsAuthenticated,)
+
+    @staticmethod
+    def get(request):
+        logger.info("New DevicesState request from user: %s", request.user)
+        return Response(build_json_response('success', get_customers_devices_state(request.user)),
+                        status=status.HTTP_200_OK)
+
+
 class GetDevicePassView(APIView):
     permission_classes = (IsAuthenticated,)
 
@@ -293,29 +394,27 @@ class GetDevicePassView(APIView):
         if not serializer.is_valid():
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
         else:
-            logger.info("New GetDevicePass request at: " + str(datetime.datetime.now()))
+            logger.info("New GetDevicePass request")
 
             data = serializer.data
-            logger.info("Request Parameters: " + str(data))
+            logger.info("Request Parameters: %s", data)
 
             device_id = data['device_id']
 
             if not is_device_id_exists(device_id):
                 message = 'failed'
                 value = 'Device does not exists'
-                logger.info("Device " + device_id + "does not exists")
+                logger.info("Device %s does not exists", device_id)
                 response_code = status.HTTP_204_NO_CONTENT
             else:
-                # Get token from request
-                token = request.auth
-                email = token.user
-                user = User.objects.get(email=email)
+                # Get user from request
+                user = request.user
+                email = user.email
 
-                logger.info("Current logged in user: " + str(email) + " ID is: " + str(user))
+                logger.info("Current logged in user: %s ID is: %s", email, user)
 
-                # Check if the activated device is new (never got activated)
-                # or the original user is activating his device again
-                if not is_device_owned_by_user(device_id, user):
+                # Only owners may reset the device password (members of a shared device may not)
+                if get_device_role(device_id, user) != CustomerDevice.ROLE_OWNER:
                     message = 'failed'
                     value = 'User is not the owner'
                     logger.info("User is not the owner")
@@ -349,11 +448,10 @@ class GetScheduledJobView(APIView):
     @staticmethod
     def post(request):
         # Print request to log file
-        logger.info("New GetScheduledJob request at: " + str(datetime.datetime.now()))
+        logger.info("New GetScheduledJob request")
 
-        token = request.auth
-        email = token.user
-        user_id = token.user_id
+        email = request.user.email
+        user_id = request.user.pk
 
         # TODO Write 'get scheduled jobs logic
         # If all passed OK return job id (value)
@@ -379,20 +477,19 @@ class RemoveDeviceView(APIView):
         if not serializer.is_valid():
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
         else:
-            logger.info("New RemoveDevice request at: " + str(datetime.datetime.now()))
+            logger.info("New RemoveDevice request")
 
             data = serializer.data
-            logger.info("Request Parameters: " + str(data))
+            logger.info("Request Parameters: %s", data)
 
             device_id_string = data['device_id']
 
-            # Get token from request
-            token = request.auth
-            email = token.user
-            user = User.objects.get(email=email)
+            # Get user from request
+            user = request.user
+            email = user.email
             device = Device.objects.get(device_id=device_id_string)
 
-            logger.info("Current logged in user: " + str(email) + " ID is: " + str(user))
+            logger.info("Current logged in user: %s ID is: %s", email, user)
 
             if not is_device_owned_by_user(device, user):
                 message = 'failed'
@@ -400,20 +497,9 @@ class RemoveDeviceView(APIView):
                 logger.error("User is not the device owner")
                 response_code = status.HTTP_409_CONFLICT
             else:
-                remove_from_customer_devices(user, device)
-
-                remove_from_access_list(email, device_id_string + '%')
-                remove_from_access_list(device.device_id, device_id_string + '%')
-
-                # Update device pass with some random pass
-                new_password = generate_random_8_char_string()
-
-                # Do hash on the new password
-                hashed_pass = hash_pbkdf2_sha256_password(new_password)
-
-                # update the hashed pass into the DB,
-                # send device ID, hashed pass and the device name that the user choose
-                update_device_pass(device, hashed_pass)
+                # A shared device is only left, unless the user is its last owner,
+                # then the device is removed from all of its members and its password is reset
+                remove_devices(user, [device_id_string])
 
                 message = "success"
                 value = "Device Removed from account"
@@ -422,6 +508,110 @@ class RemoveDeviceView(APIView):
             return Response(build_json_response(message, value), status=response_code)
 
 
+class BulkRemoveDeviceView(APIView):
+    permission_classes = (IsAuthenticated,)
+
+    @staticmethod
+    def post(request):
+        serializer = BulkDeviceIdsSerializer(data=request.data)
+
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        logger.info("New BulkRemoveDevice request from user: %s devices count: %s",
+                    request.user, len(serializer.validated_data['device_ids']))
+
+        device_ids = list(dict.fromkeys(serializer.validated_data['device_ids']))  # Remove duplicates, keep order
+        results = remove_devices(request.user, device_ids)
+
+        value = [build_bulk_item_response(device_id, results[device_id]) for device_id in device_ids]
+        return Response(build_json_response('success', value), status=status.HTTP_200_OK)
+
+
+class DeviceShareView(APIView):
+    permission_classes = (IsAuthenticated,)
+
+    @staticmethod
+    def post(request):
+        serializer = DeviceShareSerializer(data=request.data)
+
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        data = serializer.validated_data
+        logger.info("New DeviceShare request from user: %s params: %s", request.user, data)
+
+        device_id = data['device_id']
+        if get_device_role(device_id, request.user) != CustomerDevice.ROLE_OWNER:
+            logger.error("User is not a device owner")
+            return Response(build_json_response('failed', 'You cannot share this device'),
+                            status=status.HTTP_409_CONFLICT)
+
+        # Users are devices as well (registered with their email as device id), their access list is checked
+        member = User.objects.filter(email=data['email'], is_active=True).first()
+        if member is None or not is_device_id_exists(member.email):
+            logger.error("User does not exists")
+            return Response(build_json_response('failed', 'User does not exists'),
+                            status=status.HTTP_204_NO_CONTENT)
+
+        device_name = CustomerDevice.objects.filter(user_id=request.user, device_id=device_id)\
+            .values_list('device_name', flat=True).first()
+        is_shared, value = share_device(device_id, member, data['role'], device_name)
+        if not is_shared:
+            logger.error(value)
+            return Response(build_json_response('failed', value), status=status.HTTP_409_CONFLICT)
+        return Response(build_json_response('success', value), status=status.HTTP_200_OK)
+
+
+class DeviceUnshareView(APIView):
+    permission_classes = (IsAuthenticated,)
+
+    @staticmethod
+    def post(request):
+        serializer = DeviceMemberSerializer(data=request.data)
+
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        data = serializer.validated_data
+        logger.info("New DeviceUnshare request from user: %s params: %s", request.user, data)
+
+        if get_device_role(data['device_id'], request.user) != CustomerDevice.ROLE_OWNER:
+            logger.error("User is not a device owner")
+            return Response(build_json_response('failed', 'You cannot unshare this device'),
+                            status=status.HTTP_409_CONFLICT)
+
+        member = User.objects.filter(email=data['email']).first()
+        if member is None:
+            is_unshared, value = False, 'User is not a member of the device'
+        else:
+            is_unshared, value = unshare_device(data['device_id'], member)
+        if not is_unshared:
+            logger.error(value)
+            return Response(build_json_response('failed', value), status=status.HTTP_409_CONFLICT)
+        return Response(build_json_response('success', value), status=status.HTTP_200_OK)
+
+
+class DeviceMembersView(APIView):
+    permission_classes = (IsAuthenticated,)
+
+    @staticmethod
+    def post(request):
+        serializer = DeviceIdOnlySerializer(data=request.data)
+
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        device_id = serializer.validated_data['device_id']
+        logger.info("New DeviceMembers request from user: %s device: %s", request.user, device_id)
+
+        if get_device_role(device_id, request.user) is None:
+            logger.error("User is not a device member")
+            return Response(build_json_response('failed', 'You cannot view this device'),
+                            status=status.HTTP_409_CONFLICT)
+        return Response(build_json_response('success', get_device_members(device_id)), status=status.HTTP_200_OK)
+
+
 class ResetPasswordView(APIView):
     permission_classes = (IsAuthenticated,)
 
@@ -432,19 +622,19 @@ class ResetPasswordView(APIView):
         if not serializer.is_valid():
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
         else:
-            logger.info("New ResetPassword request at: " + str(datetime.datetime.now()))
+            logger.info("New ResetPassword request")
 
             data = serializer.data
-            logger.info("Request Parameters: " + str(data))
+            logger.info("Request Parameters: %s", data)
 
             current_password = data['current_password']
             new_password = data['new_password']
 
-            # Get token from request
-            token = request.auth
-            email = token.user
-            user_object = User.objects.get(email=email)
-            logger.info("Current logged in user name: " + str(email) + " ID is: " + str(user_object))
+            # Get user from request, read again since request.user may be built from the (up to
+            # OAUTH2_TOKEN_CACHE_TTL seconds old) cached values of the access token
+            user_object = User.objects.get(pk=request.user.pk)
+            email = user_object.email
+            logger.info("Current logged in user name: %s ID is: %s", email, user_object)
 
             if not user_object.check_password(current_password):
                 message = 'failed'
@@ -453,7 +643,7 @@ class ResetPasswordView(APIView):
                 response_code = status.HTTP_422_UNPROCESSABLE_ENTITY
             else:
                 user_object.set_password(new_password)
-                user_object.save()
+                user_object.save(update_fields=['password'])
                 message = 'success'
                 value = 'Password have been changed'
                 logger.info("New password successfully set")
@@ -467,30 +657,30 @@ class SetScheduledJobView(APIView):
 
     @staticmethod
     def post(request):
-        logger.info("New SetScheduledJob request at: " + str(datetime.datetime.now()))
+        logger.info("New SetScheduledJob request")
 
         serializer = SetScheduledJobSerializer(data=request.data)
 
         if not serializer.is_valid():
-            logger.info(serializer.errors)
+            logger.info("%s", serializer.errors)
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
         else:
             data = serializer.data
-            logger.info("Request Parameters: " + str(data))
+            logger.info("Request Parameters: %s", data)
 
             device_id = data['app_params']['device_id']
 
-            # Get token from request
-            token = request.auth
-            email = token.user
-            user_id = token.user_id
+            # Get user from request
+            email = request.user.email
+            user_id = request.user.pk
 
-            logger.info("Current logged in user name: " + str(email) + " ID is: " + str(user_id))
+            logger.info("Current logged in user name: %s ID is: %s", email, user_id)
 
-            if not is_device_owned_by_user(device_id, user_id):
+            # Scheduled jobs publish to the device, viewers of a shared device may not set them
+            if get_device_role(device_id, user_id) not in (CustomerDevice.ROLE_OWNER, CustomerDevice.ROLE_OPERATOR):
                 message = 'failed'
                 value = 'You cannot set new job for this device'
-                logger.error("User %s is not owner of device %s" % (user_id, device_id))
+                logger.error("User %s is not owner of device %s", user_id, device_id)
             else:
                 # This 'local_start_date' time, in this format:
                 # datetime.datetime(2017, 5, 24, 11, 45, tzinfo=datetime.timezone(datetime.timedelta(0, 10800)))
@@ -556,21 +746,20 @@ class DelScheduledJobView(APIView):
         if not serializer.is_valid():
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
         else:
-            logger.info("New DelScheduledJob request at: " + str(datetime.datetime.now()))
+            logger.info("New DelScheduledJob request")
 
             data = serializer.data
-            logger.info("Request Parameters: " + str(data))
+            logger.info("Request Parameters: %s", data)
 
-            # Get token from request
-            token = request.auth
-            email = token.user
-            user_id = token.user_id
+            # Get user from request
+            email = request.user.email
+            user_id = request.user.pk
 
-            logger.info("Current logged in user name: " + str(email) + " ID is: " + str(user_id))
+            logger.info("Current logged in user name: %s ID is: %s", email, user_id)
 
             # Get the job id that needs to be removed
             job_id = data['job_id']
-            logger.info("job_id: " + job_id)
+            logger.info("job_id: %s", job_id)
 
             # Start remove function from 'scheduler'
             remove_job_by_id(job_id)
@@ -588,17 +777,16 @@ class UpdateMQTTUserPassView(APIView):
 
     @staticmethod
     def post(request):
-        logger.info("New UpdateMQTTUserPass request at: " + str(datetime.datetime.now()))
+        logger.info("New UpdateMQTTUserPass request")
 
-        # Get token from request
-        token = request.auth
-        email = token.user
-        user_id = token.user_id
+        # Get user from request
+        email = request.user.email
+        user_id = request.user.pk
 
-        logger.info("Current logged in user: " + str(email) + " ID is: " + str(user_id))
+        logger.info("Current logged in user: %s ID is: %s", email, user_id)
 
-        # If all passed OK, update customer "device" pass
-        if update_device_pass(email, token):
+        # If all passed OK, update customer "device" pass (the user device, its password is the access token)
+        if update_device_pass(email, str(request.auth)):
             # Return user name
             message = 'success'
             value = str(email)
@@ -616,9 +804,9 @@ class SetScheduledJobView2(APIView):
 
     @staticmethod
     def post(request):
-        logger.info("New SetScheduledJob request at: " + str(datetime.datetime.now()))
+        logger.info("New SetScheduledJob request")
 
-        logger.info("Request Parameters: " + str(request.data))
+        logger.info("Request Parameters: %s", request.data)
 
         return Response("SDF", status=status.HTTP_200_OK)
 
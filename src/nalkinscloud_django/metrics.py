@@ -0,0 +1,123 @@
+import time
+
+from django.db import connection
+from django.http import HttpResponse, HttpResponseForbidden
+from django.utils.crypto import constant_time_compare
+from prometheus_client import CollectorRegistry, Counter, Histogram, REGISTRY, CONTENT_TYPE_LATEST, \
+    generate_latest, multiprocess
+
+from nalkinscloud_django.networks import parse_networks, is_direct_request_from
+from nalkinscloud_django.settings import METRICS_MULTIPROC_DIR, METRICS_TOKEN, METRICS_ALLOWED_NETWORKS
+
+# With PROMETHEUS_MULTIPROC_DIR set (see entrypoint.sh) every gunicorn worker writes its values to files
+# in that directory, and /metrics/ aggregates the files of all workers
+request_duration = Histogram('http_request_duration_seconds', 'Requests latency', ['view', 'method'])
+responses = Counter('http_responses_total', 'Responses by status code', ['view', 'method', 'status'])
+request_db_queries = Histogram('http_request_db_queries', 'DB queries per request', ['view'],
+                               buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200, 500))
+request_db_duration = Histogram('http_request_db_duration_seconds', 'DB time per request', ['view'])
+
+scheduler_job_lag = Histogram('scheduler_job_lag_seconds', 'Delay between a job run time and its submission',
+                              buckets=(.01, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300))
+scheduler_jobs_missed = Counter('scheduler_jobs_missed_total', 'Job runs skipped since past their grace time')
+
+mqtt_auth_cache_requests = Counter('mqtt_auth_cache_requests_total', 'MQTT auth caches lookups', ['cache', 'result'])
+# Bound once, so cache lookups only pay for an increment
+credentials_cache_hit = mqtt_auth_cache_requests.labels('credentials', 'hit')
+credentials_cache_miss = mqtt_auth_cache_requests.labels('credentials', 'miss')
+acl_cache_hit = mqtt_auth_cache_requests.labels('acl', 'hit')
+acl_cache_miss = mqtt_auth_cache_requests.labels('acl', 'miss')
+
+# Requests of unknown urls share a single label value, so scanners can not blow up the series count
+UNRESOLVED_VIEW = '<unresolved>'
+
+
+class QueryCounter(object):
+    """
+    connection.execute_wrapper counting queries and their total duration
+    """
+    __slots__ = ('count', 'duration')
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.duration += time.perf_counter() - start
+
+
+class MetricsMiddleware(object):
+    """
+    Observe latency, status code and DB queries of every request, labeled by the resolved view name,
+    labeled metrics are looked up once per distinct labels and kept, so a request costs a few dict lookups
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self._children = {}
+
+    def __call__(self, request):
+        queries = QueryCounter()
+        start = time.perf_counter()
+        with connection.execute_wrapper(queries):
+            response = self.get_response(request)
+        duration = time.perf_counter() - start
+
+        resolver_match = getattr(request, 'resolver_match', None)
+        view = resolver_match.view_name if resolver_match is not None else UNRESOLVED_VIEW
+        key = (view, request.method, response.status_code)
+        children = self._children.get(key)
+        if children is None:
+            children = self._children[key] = (request_duration.labels(view, request.method),
+                                              responses.labels(view, request.method, str(response.status_code)),
+                                              request_db_queries.labels(view),
+                                              request_db_duration.labels(view))
+        children[0].observe(duration)
+        children[1].inc()
+        children[2].observe(queries.count)
+        children[3].observe(queries.duration)
+        return response
+
+
+def observe_scheduler_event(event):
+    """
+    APScheduler listener of EVENT_JOB_SUBMITTED and EVENT_JOB_MISSED events
+
+    :param event: JobSubmissionEvent or JobExecutionEvent
+    """
+    run_times = getattr(event, 'scheduled_run_times', None)
+    if run_times is None:
+        scheduler_jobs_missed.inc()
+        return
+    now = time.time()
+    for run_time in run_times:
+        scheduler_job_lag.observe(max(now - run_time.timestamp(), 0))
+
+
+def get_metrics_registry():
+    if METRICS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+
+metrics_allowed_networks = parse_networks(METRICS_ALLOWED_NETWORKS)
+
+
+def metrics_view(request):
+    """
+    Prometheus text exposition of all metrics, requires 'Authorization: Bearer <METRICS_TOKEN>' if a token is set,
+    without a token only requests made directly from METRICS_ALLOWED_NETWORKS are served
+    """
+    if METRICS_TOKEN:
+        if not constant_time_compare(request.META.get('HTTP_AUTHORIZATION', ''), 'Bearer ' + METRICS_TOKEN):
+            return HttpResponseForbidden()
+    elif not is_direct_request_from(request, metrics_allowed_networks):
+        return HttpResponseForbidden()
+    return HttpResponse(generate_latest(get_metrics_registry()), content_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,28 @@
+import ipaddress
+
+
+def parse_networks(value):
+    """
+    :param value: string, comma separated networks (for example '127.0.0.0/8,::1/128')
+    :return: list of ipaddress networks
+    """
+    return [ipaddress.ip_network(network.strip()) for network in value.split(',') if network.strip()]
+
+
+def is_direct_request_from(request, networks):
+    """
+    Return True if request was made directly from an address of networks,
+    requests relayed by a reverse proxy (carrying X-Forwarded-For / X-Real-IP) are refused,
+    since behind the proxy every request comes from the (private) proxy address
+
+    :param request: django HttpRequest (or rest framework Request)
+    :param networks: list of ipaddress networks
+    :return: boolean
+    """
+    if 'HTTP_X_FORWARDED_FOR' in request.META or 'HTTP_X_REAL_IP' in request.META:
+        return False
+    try:
+        address = ipaddress.ip_address(request.META.get('REMOTE_ADDR', ''))
+    except ValueError:
+        return False
+    return any(address in network for network in networks)
@@ -0,0 +1,194 @@
+import datetime
+import json
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+
+from collections import Counter
+
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+
+from nalkinscloud_django.metrics import UNRESOLVED_VIEW
+from nalkinscloud_django.settings import PROJECT_NAME, PROFILING_ENABLED, PROFILING_THRESHOLD, \
+    PROFILING_SAMPLE_RATE, PROFILING_INTERVAL, PROFILING_DIR, PROFILING_MAX_FILES, PROFILING_MAX_QUERIES
+
+# Define logger
+logger = logging.getLogger(PROJECT_NAME)
+
+# Code object -> frame name
+frame_names = {}
+
+
+def get_frame_name(code):
+    """
+    :param code: code object
+    :return: string, 'function (file:first line)', module paths are relative to their sys.path entry
+    """
+    name = frame_names.get(code)
+    if name is None:
+        filename = code.co_filename
+        for path in sorted(sys.path, key=len, reverse=True):
+            if path and filename.startswith(path + os.sep):
+                filename = filename[len(path) + 1:]
+                break
+        name = frame_names[code] = '%s (%s:%d)' % (code.co_name, filename, code.co_firstlineno)
+    return name
+
+
+def get_folded_stack(frame):
+    """
+    :param frame: innermost frame of a thread
+    :return: string, frames names from the outermost separated by ';' (flamegraph folded format)
+    """
+    names = []
+    while frame is not None:
+        names.append(get_frame_name(frame.f_code))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class StackSampler(object):
+    """
+    Record the stacks of registered threads every 'interval' seconds, from a single background thread,
+    so a profiled request only pays for registering its thread
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._stacks = {}  # Thread ident -> Counter of folded stacks
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def start(self, ident):
+        with self._lock:
+            if self._pid != os.getpid():  # Not started yet, or started by the parent of a forked process
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+                self._thread.start()
+            self._stacks[ident] = Counter()
+
+    def stop(self, ident):
+        """
+        :return: Counter of folded stack -> samples count
+        """
+        with self._lock:
+            return self._stacks.pop(ident, Counter())
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._stacks:
+                    continue
+                frames = sys._current_frames()
+                for ident, stacks in self._stacks.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        stacks[get_folded_stack(frame)] += 1
+
+
+class QueryRecorder(object):
+    """
+    connection.execute_wrapper keeping the first 'max_queries' queries sql and duration
+    """
+
+    def __init__(self, max_queries):
+        self.max_queries = max_queries
+        self.queries = []
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            if len(self.queries) < self.max_queries:
+                self.queries.append({'sql': sql, 'duration': time.perf_counter() - start})
+
+
+class ProfilingMiddleware(object):
+    """
+    Profile requests slower than 'threshold' seconds, and 'sample_rate' (0 to 1) of all requests,
+    the stacks of profiled requests are sampled every 'interval' seconds and their queries recorded,
+    each profile is written to 'directory' as '<name>.json' (request, queries and stacks)
+    and '<name>.folded' (flamegraph folded stacks), only the newest 'max_files' profiles are kept
+
+    Not used unless PROFILING_ENABLED, see the profile_summary command
+    """
+
+    def __init__(self, get_response, enabled=PROFILING_ENABLED, threshold=PROFILING_THRESHOLD,
+                 sample_rate=PROFILING_SAMPLE_RATE, interval=PROFILING_INTERVAL, directory=PROFILING_DIR,
+                 max_files=PROFILING_MAX_FILES, max_queries=PROFILING_MAX_QUERIES):
+        if not enabled:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.directory = directory
+        self.max_files = max_files
+        self.max_queries = max_queries
+        self.sampler = StackSampler(interval)
+        os.makedirs(directory, exist_ok=True)
+
+    def __call__(self, request):
+        ident = threading.get_ident()
+        queries = QueryRecorder(self.max_queries)
+        sampled = self.sample_rate > 0 and random.random() < self.sample_rate
+        self.sampler.start(ident)
+        start = time.perf_counter()
+        try:
+            with connection.execute_wrapper(queries):
+                response = self.get_response(request)
+        finally:
+            duration = time.perf_counter() - start
+            stacks = self.sampler.stop(ident)
+
+        if sampled or duration >= self.threshold:
+            try:
+                self.write_profile(request, response, duration, queries, stacks)
+            except Exception:
+                logger.exception('Failed writing profile of %s', request.path)
+        return response
+
+    def write_profile(self, request, response, duration, queries, stacks):
+        resolver_match = getattr(request, 'resolver_match', None)
+        view = resolver_match.view_name if resolver_match is not None else UNRESOLVED_VIEW
+        now = datetime.datetime.utcnow()
+        name = '%s-%s-%dms' % (now.strftime('%Y%m%dT%H%M%S%f'), re.sub(r'[^\w.-]+', '_', view), duration * 1000)
+        path = os.path.join(self.directory, name)
+
+        with open(path + '.folded', 'w') as folded_file:
+            for stack, count in stacks.most_common():
+                folded_file.write('%s %d\n' % (stack, count))
+        with open(path + '.json', 'w') as json_file:
+            json.dump({
+                'view': view,
+                'method': request.method,
+                'path': request.path,
+                'status': response.status_code,
+                'date': now.isoformat(),
+                'duration': duration,
+                'queries_count': queries.count,
+                'queries': queries.queries,
+                'stacks': dict(stacks),
+            }, json_file)
+        logger.info('Profiled %s %s (%d ms, %d queries) to %s',
+                    request.method, request.path, duration * 1000, queries.count, path)
+        self.rotate()
+
+    def rotate(self):
+        profiles = sorted(file_name[:-len('.json')] for file_name in os.listdir(self.directory)
+                          if file_name.endswith('.json'))
+        for name in profiles[:max(len(profiles) - self.max_files, 0)]:
+            for extension in ('.json', '.folded'):
+                try:
+                    os.remove(os.path.join(self.directory, name + extension))
+                except FileNotFoundError:
+                    pass
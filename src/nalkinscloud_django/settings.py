@@ -17,6 +17,91 @@ EXTRA_ALLOWED_HOSTS = os.environ.get('allowed_hosts', '').split(',')
 # MQTT Broker
 MQTT_BROKER_HOST = os.environ.get('mqtt_broker_host', '127.0.0.1')
 MQTT_BROKER_PORT = int(os.environ.get('mqtt_broker_port', 9001))
+MQTT_BROKER_TRANSPORT = os.environ.get('mqtt_broker_transport', 'websockets')  # 'tcp' or 'websockets'
+
+# Scheduled jobs publisher, should be a 'service' device marked as super user
+MQTT_PUBLISHER_USERNAME = os.environ.get('mqtt_publisher_username')
+MQTT_PUBLISHER_PASSWORD = os.environ.get('mqtt_publisher_password')
+MQTT_PUBLISHER_POOL_SIZE = int(os.environ.get('mqtt_publisher_pool_size', 2))
+MQTT_PUBLISHER_QOS = int(os.environ.get('mqtt_publisher_qos', 1))
+MQTT_PUBLISHER_TIMEOUT = int(os.environ.get('mqtt_publisher_timeout', 10))  # In seconds
+MQTT_PUBLISHER_BATCH_WINDOW = float(os.environ.get('mqtt_publisher_batch_window', 0.2))  # In seconds
+
+# Messages ingestion (manage.py ingest_messages), should be a 'service' device marked as super user
+MQTT_INGEST_USERNAME = os.environ.get('mqtt_ingest_username')
+MQTT_INGEST_PASSWORD = os.environ.get('mqtt_ingest_password')
+MQTT_INGEST_TOPIC = os.environ.get('mqtt_ingest_topic', '#')
+MQTT_INGEST_QOS = int(os.environ.get('mqtt_ingest_qos', 0))
+MQTT_INGEST_BATCH_SIZE = int(os.environ.get('mqtt_ingest_batch_size', 2000))
+MQTT_INGEST_FLUSH_INTERVAL = float(os.environ.get('mqtt_ingest_flush_interval', 1))  # In seconds
+MQTT_INGEST_QUEUE_SIZE = int(os.environ.get('mqtt_ingest_queue_size', 100000))
+# Messages are stored in a table per device type and period ('day' or 'month'),
+# expired tables are dropped by 'manage.py compact_messages' (per device type MessageRetentionPolicy overrides)
+MESSAGES_PARTITION_PERIOD = os.environ.get('messages_partition_period', 'day')
+MESSAGES_RETENTION_DAYS = int(os.environ.get('messages_retention_days', 90))  # 0 keeps messages forever
+# Partitions of the next periods are created ahead by compact_messages
+MESSAGES_PRECREATE_PERIODS = int(os.environ.get('messages_precreate_periods', 2))
+# Numeric messages of these device types are aggregated (min/max/avg/count) per minute, hour and day
+MESSAGE_ROLLUP_DEVICE_TYPES = os.environ.get('message_rollup_device_types', 'dht,magnet,switch,distillery').split(',')
+MESSAGE_ROLLUP_MAX_POINTS = int(os.environ.get('message_rollup_max_points', 10000))  # Per device_rollups/ request
+# Raw messages are streamed by device_messages/, rows are read in chunks of this size
+DEVICE_MESSAGES_CHUNK_SIZE = int(os.environ.get('device_messages_chunk_size', 2000))
+DEVICE_MESSAGES_MAX_DAYS = int(os.environ.get('device_messages_max_days', 31))  # Per request, 0 for no limit
+# Last message of each device topic, 'memory://' keeps them in the ingesting process only (web processes return
+# devices without state and log a warning), a redis url ('redis://host:6379/0') shares them with the web processes
+LAST_VALUE_STORE_URL = os.environ.get('last_value_store_url', 'memory://')
+
+# MQTT broker HTTP auth backend, verified device credentials are cached in memory,
+# keyed on the stored password hash, so password changes apply to all processes at once
+MQTT_AUTH_CACHE_TTL = int(os.environ.get('mqtt_auth_cache_ttl', 300))  # In seconds
+MQTT_AUTH_CACHE_SIZE = int(os.environ.get('mqtt_auth_cache_size', 10000))
+# Comma separated networks the broker calls the auth endpoints from, requests relayed by a proxy are refused
+MQTT_AUTH_ALLOWED_NETWORKS = os.environ.get('mqtt_auth_allowed_networks',
+                                            '127.0.0.0/8,::1/128,10.0.0.0/8,172.16.0.0/12,192.168.0.0/16')
+# Validated OAuth2 access tokens of API requests are cached in memory,
+# revoked tokens may still be accepted by other processes for up to the ttl
+OAUTH2_TOKEN_CACHE_TTL = int(os.environ.get('oauth2_token_cache_ttl', 60))  # In seconds
+OAUTH2_TOKEN_CACHE_SIZE = int(os.environ.get('oauth2_token_cache_size', 10000))
+# Hashes of OAuth2 applications client secrets (registration, forgot password) are reloaded after
+CLIENT_SECRET_CACHE_TTL = int(os.environ.get('client_secret_cache_ttl', 300))  # In seconds
+
+# Prometheus metrics served on /metrics/, values of all gunicorn workers are aggregated through
+# files in PROMETHEUS_MULTIPROC_DIR (read by prometheus_client itself, must be empty on start)
+METRICS_MULTIPROC_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+METRICS_TOKEN = os.environ.get('metrics_token')  # If set, scrapes must send 'Authorization: Bearer <token>'
+# Without a token, comma separated networks scrapes are allowed from, requests relayed by a proxy are refused
+METRICS_ALLOWED_NETWORKS = os.environ.get('metrics_allowed_networks',
+                                          '127.0.0.0/8,::1/128,10.0.0.0/8,172.16.0.0/12,192.168.0.0/16')
+# Profiles of slow (or sampled) requests are written to PROFILING_DIR, summarized by 'manage.py profile_summary'
+PROFILING_ENABLED = os.environ.get('profiling_enabled', 'False') == 'True'
+PROFILING_THRESHOLD = float(os.environ.get('profiling_threshold', 0.5))  # In seconds
+PROFILING_SAMPLE_RATE = float(os.environ.get('profiling_sample_rate', 0))  # Share of requests profiled (0 to 1)
+PROFILING_INTERVAL = float(os.environ.get('profiling_interval', 0.005))  # In seconds, between stack samples
+PROFILING_DIR = os.environ.get('profiling_dir', '/tmp/nalkinscloud-profiles')
+PROFILING_MAX_FILES = int(os.environ.get('profiling_max_files', 500))  # Oldest profiles are removed
+PROFILING_MAX_QUERIES = int(os.environ.get('profiling_max_queries', 1000))  # Recorded per request
+# Compiled access list (topic trie) per device, changes made by other processes (revoked rules included)
+# apply to this process once its trie expires, after at most MQTT_ACL_CACHE_TTL
+MQTT_ACL_CACHE_TTL = int(os.environ.get('mqtt_acl_cache_ttl', 30))  # In seconds
+MQTT_ACL_CACHE_SIZE = int(os.environ.get('mqtt_acl_cache_size', 10000))
+
+# Django cache, the default in memory cache is per process, invalidations (of device lists) only reach
+# the process making the change, set a shared backend (for example
+# 'django.core.cache.backends.memcached.MemcachedCache' and 'memcached:11211') so they reach all processes
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get('cache_backend', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('cache_location', ''),
+    }
+}
+# Users device lists are cached (django cache) until one of their devices change,
+# with a per process cache other processes serve a changed list for up to the ttl
+DEVICE_LIST_CACHE_TTL = int(os.environ.get('device_list_cache_ttl', 10))  # In seconds
+# Cursor paginated device listing (device_list_page/) page sizes
+DEVICE_LIST_PAGE_SIZE = int(os.environ.get('device_list_page_size', 50))
+DEVICE_LIST_MAX_PAGE_SIZE = int(os.environ.get('device_list_max_page_size', 500))
+# Max number of devices in a single bulk activation/removal request
+DEVICE_BULK_MAX_SIZE = int(os.environ.get('device_bulk_max_size', 500))
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -57,6 +142,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so latency covers all other middlewares
+    'nalkinscloud_django.metrics.MetricsMiddleware',
+    'nalkinscloud_api.logging_filter.LogSamplingMiddleware',
+    'nalkinscloud_django.profiling.ProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -148,7 +237,7 @@ USE_TZ = True
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'oauth2_provider.contrib.rest_framework.OAuth2Authentication',
+        'nalkinscloud_api.authentication.CachedOAuth2Authentication',
     ),
     'DEFAULT_PERMISSION_CLASSES': (
         'rest_framework.permissions.IsAuthenticated',
@@ -236,20 +325,63 @@ EMAIL_HOST_PASSWORD = os.environ.get('email_password')
 
 DJANGO_EMAIL_VERIFIER_EXPIRE_TIME = 24  # In Hours
 
+# Outbound emails are queued in the database and sent by the 'send_emails' worker
+EMAIL_QUEUE_BATCH_SIZE = int(os.environ.get('email_queue_batch_size', 50))  # Emails per SMTP connection
+EMAIL_QUEUE_POLL_INTERVAL = float(os.environ.get('email_queue_poll_interval', 2))  # In seconds
+EMAIL_QUEUE_MAX_ATTEMPTS = int(os.environ.get('email_queue_max_attempts', 8))
+EMAIL_QUEUE_RETRY_DELAY = int(os.environ.get('email_queue_retry_delay', 30))  # In seconds, doubled on each attempt
+EMAIL_QUEUE_MAX_RETRY_DELAY = int(os.environ.get('email_queue_max_retry_delay', 3600))  # In seconds
+EMAIL_QUEUE_LEASE_TIME = int(os.environ.get('email_queue_lease_time', 300))  # In seconds, per claimed batch
+
 # REDIS related settings
-REDIS_HOST = 'localhost'
-REDIS_PORT = '6379'
+REDIS_HOST = os.environ.get('redis_host', 'localhost')
+REDIS_PORT = os.environ.get('redis_port', '6379')
 BROKER_URL = 'redis://' + REDIS_HOST + ':' + REDIS_PORT + '/0'
 BROKER_TRANSPORT_OPTIONS = {'visibility_timeout': 3600}
 
-CELERY_REDIS_URL = 'redis://' + REDIS_HOST + ':' + REDIS_PORT
-CELERY_RESULT_BACKEND = 'redis://' + REDIS_HOST + ':' + REDIS_PORT + '/0'
+######################
+# CELERY SETTINGS
+######################
+# Background tasks (see scheduler/celery.py), in 'dev' tasks run inline unless celery_task_always_eager=False,
+# with in memory broker and results so no redis is needed
+CELERY_TASK_ALWAYS_EAGER = os.environ.get('celery_task_always_eager', str(ENVIRONMENT == 'dev')) == 'True'
+CELERY_TASK_EAGER_PROPAGATES = True
+CELERY_BROKER_URL = os.environ.get('celery_broker_url', 'memory://' if CELERY_TASK_ALWAYS_EAGER else BROKER_URL)
+CELERY_BROKER_TRANSPORT_OPTIONS = BROKER_TRANSPORT_OPTIONS
+CELERY_RESULT_BACKEND = os.environ.get('celery_result_backend', 'cache+memory://' if CELERY_TASK_ALWAYS_EAGER
+                                       else 'redis://' + REDIS_HOST + ':' + REDIS_PORT + '/0')
 CELERY_ACCEPT_CONTENT = ['application/json']
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_TIMEZONE = 'Asia/Jerusalem'
+CELERY_TASK_IGNORE_RESULT = True
+# Latency sensitive tasks run on the 'default' queue, slow tasks on their own workers so they can not starve them
+CELERY_TASK_DEFAULT_QUEUE = 'default'
+CELERY_TASK_ROUTES = {
+    'nalkinscloud_api.tasks.send_queued_emails': {'queue': 'slow'},
+    'nalkinscloud_mosquitto.tasks.create_devices': {'queue': 'slow'},
+    'nalkinscloud_mosquitto.tasks.rebuild_access_lists': {'queue': 'slow'},
+    'nalkinscloud_mosquitto.tasks.rebuild_rollups': {'queue': 'slow'},
+}
+# Slow tasks are acknowledged once done (acks_late=True on each task, re-delivered if a worker dies),
+# workers fetch one task at a time so a long task does not hold others back
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
 CELERY_BEAT_SCHEDULE = {}
 
+######################
+# SCHEDULER SETTINGS
+######################
+# Jobs are stored in the django DB, only the process holding the scheduler lease runs due jobs
+SCHEDULER_LEASE_TTL = int(os.environ.get('scheduler_lease_ttl', 30))  # In seconds
+SCHEDULER_LEASE_RENEW_INTERVAL = int(os.environ.get('scheduler_lease_renew_interval', 10))  # In seconds
+SCHEDULER_DUE_JOBS_BATCH_SIZE = int(os.environ.get('scheduler_due_jobs_batch_size', 500))
+# Executors of the 'run_scheduler' process, web processes only add jobs to the DB
+SCHEDULER_THREAD_POOL_SIZE = int(os.environ.get('scheduler_thread_pool_size', 20))
+SCHEDULER_PROCESS_POOL_SIZE = int(os.environ.get('scheduler_process_pool_size', 5))
+# 'apscheduler' runs due jobs with APScheduler, 'wheel' from an in memory timing wheel (scheduler.timing_wheel)
+SCHEDULER_ENGINE = os.environ.get('scheduler_engine', 'apscheduler')
+SCHEDULER_WHEEL_TICK = float(os.environ.get('scheduler_wheel_tick', 1))  # In seconds
+
 ######################
 # LOGGING SETTINGS
 ######################
@@ -257,7 +389,15 @@ LOG_LEVEL = os.environ.get('log_level', 'INFO')
 
 GRAYLOG_ENABLED = os.environ.get('graylog_enabled', False) == 'True'
 GRAYLOG_HOST = os.environ.get('graylog_host', 'localhost')
-GRAYLOG_PORT = os.environ.get('graylog_port', 12201)
+GRAYLOG_PORT = int(os.environ.get('graylog_port', 12201))
+# 'udp' sends a datagram per record, 'tcp' sends the records waiting in the logging queue together
+GRAYLOG_TRANSPORT = os.environ.get('graylog_transport', 'udp')
+
+# Records are put on a queue and sent by a background thread, records are dropped while the queue is full
+LOG_QUEUE_SIZE = int(os.environ.get('log_queue_size', 10000))
+LOG_BATCH_SIZE = int(os.environ.get('log_batch_size', 100))
+# Share of requests (0 to 1) keeping their DEBUG and INFO records, WARNING and above are always kept
+LOG_SAMPLE_RATE = float(os.environ.get('log_sample_rate', 1))
 
 if GRAYLOG_ENABLED:
     HANDLERS = ['gelf']
@@ -274,10 +414,14 @@ LOGGING = {
                 'environment': ENVIRONMENT,
             },
         },
+        'sampling': {
+            '()': 'nalkinscloud_api.logging_filter.SamplingFilter',
+        },
     },
     'handlers': {
         'gelf': {
-            'class': 'graypy.GELFUDPHandler',
+            'class': 'nalkinscloud_api.logging_handlers.GELFBatchTCPHandler' if GRAYLOG_TRANSPORT == 'tcp'
+            else 'graypy.GELFUDPHandler',
             'host': GRAYLOG_HOST,
             'port': GRAYLOG_PORT,
             'filters': ['fields']
@@ -286,15 +430,23 @@ LOGGING = {
             'level': LOG_LEVEL,
             'class': 'logging.StreamHandler',
         },
+        # Handlers are configured by name order, 'queue' targets must be named before it
+        'queue': {
+            'class': 'nalkinscloud_api.logging_handlers.QueueListenerHandler',
+            'targets': ['cfg://handlers.' + handler for handler in HANDLERS],
+            'queue_size': LOG_QUEUE_SIZE,
+            'batch_size': LOG_BATCH_SIZE,
+            'filters': ['sampling'],
+        },
     },
 
     'loggers': {
         PROJECT_NAME: {
-            'handlers': HANDLERS,
+            'handlers': ['queue'],
             'level': LOG_LEVEL,
         },
         'django.request': {
-            'handlers': HANDLERS,
+            'handlers': ['queue'],
             'level': 'WARNING',
             'propagate': False,
         },
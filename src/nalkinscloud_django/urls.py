@@ -2,8 +2,11 @@ from django.contrib import admin
 from django.conf.urls import include, url
 from django.urls import path
 
+from nalkinscloud_django.metrics import metrics_view
+
 urlpatterns = [
     url(r'^', include('nalkinscloud_api.urls')),
+    url(r'^', include('nalkinscloud_mosquitto.urls')),
 
     # OAUTH URLS
     url(r'^', include('oauth2_provider.urls', namespace='oauth2_provider')),
@@ -13,4 +16,6 @@ urlpatterns = [
     url('', include('social_django.urls', namespace='social')),
 
     path('nalkinsadmin/', admin.site.urls),
+
+    path('metrics/', metrics_view, name='metrics'),
 ]
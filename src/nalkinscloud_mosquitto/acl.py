@@ -0,0 +1,216 @@
+import threading
+
+from nalkinscloud_mosquitto.cache import TTLCache
+from nalkinscloud_mosquitto.models import AccessList
+from nalkinscloud_django.metrics import acl_cache_hit, acl_cache_miss
+from nalkinscloud_django.settings import MQTT_ACL_CACHE_TTL, MQTT_ACL_CACHE_SIZE
+
+# Access modes as sent by the broker (mosquitto-go-auth) on ACL checks
+MQTT_ACCESS_READ = 1
+MQTT_ACCESS_WRITE = 2
+MQTT_ACCESS_READWRITE = 3
+MQTT_ACCESS_SUBSCRIBE = 4
+
+
+def get_required_rw(access):
+    """
+    Return the minimal AccessList.rw value that grants input access,
+    rw of 1 allows reading (and subscribing), 2 allows reading and writing
+
+    :param access: int, one of MQTT_ACCESS_* values
+    :return: int
+    """
+    return 2 if access in (MQTT_ACCESS_WRITE, MQTT_ACCESS_READWRITE) else 1
+
+
+class TopicTrieNode(object):
+    __slots__ = ('children', 'rw')
+
+    def __init__(self):
+        self.children = {}
+        self.rw = 0  # rw of the topic filter ending at this node, 0 if none
+
+
+class TopicTrie(object):
+    """
+    Trie of MQTT topic filters (one level per node), that supports '+' and '#' wildcards,
+    Matching a topic costs O(topic depth) regardless of the number of filters stored
+    """
+
+    def __init__(self):
+        self.root = TopicTrieNode()
+
+    def insert(self, pattern, rw):
+        """
+        Add topic filter with its rw mode, overrides rw if filter already exists
+
+        :param pattern: string topic filter, for example 'device_id/#'
+        :param rw: int
+        :return: None
+        """
+        node = self.root
+        for level in pattern.split('/'):
+            child = node.children.get(level)
+            if child is None:
+                child = TopicTrieNode()
+                node.children[level] = child
+            node = child
+        node.rw = rw
+
+    def remove(self, pattern):
+        """
+        Remove topic filter, and prune nodes that are left with no filters
+
+        :param pattern: string topic filter
+        :return: None
+        """
+        path = [self.root]
+        levels = pattern.split('/')
+        for level in levels:
+            child = path[-1].children.get(level)
+            if child is None:
+                return
+            path.append(child)
+        path[-1].rw = 0
+        for index in range(len(levels), 0, -1):
+            node = path[index]
+            if node.rw or node.children:
+                break
+            del path[index - 1].children[levels[index - 1]]
+
+    def max_rw(self, topic):
+        """
+        Return the highest rw of all filters matching topic, 0 if no filter matches,
+        Topic may be a subscription filter itself, then '+' matches only '+' or '#' filters and '#' only '#'
+        Wildcard filters never match a first level starting with '$' (MQTT spec, 4.7.2)
+
+        :param topic: string
+        :return: int
+        """
+        best = 0
+        nodes = [self.root]
+        levels = topic.split('/')
+        for index, level in enumerate(levels):
+            wildcards_allowed = index > 0 or not level.startswith('$')
+            next_nodes = []
+            for node in nodes:
+                children = node.children
+                if wildcards_allowed:
+                    multi_level = children.get('#')
+                    if multi_level is not None and multi_level.rw > best:
+                        best = multi_level.rw
+                    single_level = children.get('+')
+                    if single_level is not None and level != '#':
+                        next_nodes.append(single_level)
+                if level not in ('+', '#'):
+                    literal = children.get(level)
+                    if literal is not None:
+                        next_nodes.append(literal)
+            if not next_nodes or best == 2:
+                return best
+            nodes = next_nodes
+
+        for node in nodes:
+            if node.rw > best:
+                best = node.rw
+            # Filter 'a/#' also matches its parent level 'a'
+            multi_level = node.children.get('#')
+            if multi_level is not None and multi_level.rw > best:
+                best = multi_level.rw
+        return best
+
+
+class AclEngine(object):
+    """
+    Keep compiled TopicTrie per device, built from the device enabled AccessList records,
+    Tries are compiled lazily on first check and kept up to date by AccessList signals (see signals.py),
+    signals only reach the current process, changes made by other processes (for example a revoked rule)
+    are seen once the trie expires, the TTL is the bound of that staleness
+
+    A trie is compiled outside the lock, changes of the device applied meanwhile drop the in flight compilation
+    (its token), so a trie read before a change is never cached after it
+    """
+
+    def __init__(self, max_size, ttl):
+        self._tries = TTLCache(max_size=max_size, ttl=ttl)
+        self._lock = threading.Lock()
+        self._compiling = {}  # device_id -> token of the latest compilation started, while compiling
+
+    @staticmethod
+    def compile(device_id):
+        """
+        Build a TopicTrie from all enabled AccessList records of a device
+
+        :param device_id: string
+        :return: TopicTrie
+        """
+        trie = TopicTrie()
+        for topic, rw in AccessList.objects.filter(device_id=device_id, is_enabled=True).values_list('topic', 'rw'):
+            trie.insert(topic, rw)
+        return trie
+
+    def get_trie(self, device_id):
+        trie = self._tries.get(device_id)
+        if trie is not None:
+            acl_cache_hit.inc()
+            return trie
+
+        acl_cache_miss.inc()
+        token = object()
+        with self._lock:
+            self._compiling[device_id] = token
+        try:
+            trie = self.compile(device_id)
+        finally:
+            with self._lock:
+                if self._compiling.get(device_id) is token:
+                    del self._compiling[device_id]
+                    # No change of the device since the compilation started
+                    if trie is not None:
+                        self._tries.set(device_id, trie)
+        return trie
+
+    def is_allowed(self, device_id, topic, access):
+        """
+        Return True if device has access on topic
+
+        :param device_id: string
+        :param topic: string
+        :param access: int, one of MQTT_ACCESS_* values
+        :return: boolean
+        """
+        return self.get_trie(device_id).max_rw(topic) >= get_required_rw(access)
+
+    def update_rule(self, device_id, topic, rw, is_enabled):
+        """
+        Apply a single AccessList change to an already compiled trie (not compiled tries are left alone)
+        """
+        with self._lock:
+            self._compiling.pop(device_id, None)
+            trie = self._tries.get(device_id)
+            if trie is None:
+                return
+            if is_enabled:
+                trie.insert(topic, rw)
+            else:
+                trie.remove(topic)
+
+    def remove_rule(self, device_id, topic):
+        with self._lock:
+            self._compiling.pop(device_id, None)
+            trie = self._tries.get(device_id)
+            if trie is not None:
+                trie.remove(topic)
+
+    def invalidate(self, device_id):
+        with self._lock:
+            self._compiling.pop(device_id, None)
+            self._tries.invalidate(device_id)
+
+    def clear(self):
+        with self._lock:
+            self._compiling.clear()
+            self._tries.clear()
+
+
+acl_engine = AclEngine(max_size=MQTT_ACL_CACHE_SIZE, ttl=MQTT_ACL_CACHE_TTL)
@@ -37,7 +37,7 @@ class CustomDevicesAdmin(UserAdmin):
 
 @admin.register(CustomerDevice)
 class CustomDevicesAdmin(admin.ModelAdmin):
-    list_display = ('user_id', 'device_id', 'device_name')
+    list_display = ('user_id', 'device_id', 'device_name', 'role')
     ordering = ('user_id',)
     pass
 
@@ -54,3 +54,16 @@ class CustomDevicesAdmin(admin.ModelAdmin):
     list_display = ('message_id', 'device', 'topic', 'message')
     ordering = ('device',)
     pass
+
+
+@admin.register(MessagePartition)
+class CustomDevicesAdmin(admin.ModelAdmin):
+    list_display = ('table_name', 'device_type', 'period_start', 'period_end')
+    ordering = ('-period_start',)
+    pass
+
+
+@admin.register(MessageRetentionPolicy)
+class CustomDevicesAdmin(admin.ModelAdmin):
+    list_display = ('device_type', 'retention_days')
+    pass
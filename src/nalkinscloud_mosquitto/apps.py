@@ -9,6 +9,10 @@ logger = logging.getLogger(PROJECT_NAME)
 class NalkinscloudMosquittoConfig(AppConfig):
     name = 'nalkinscloud_mosquitto'
 
+    def ready(self):
+        # Connect signal receivers
+        import nalkinscloud_mosquitto.signals
+
     # def ready(self):
     #     logger.info("####################################################\n"
     #                 "Nalkinscloud Mosquitto Application is up and running\n"
@@ -1,5 +1,29 @@
 
+import functools
+import operator
+
+from django.contrib.auth.hashers import check_password, make_password
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils.crypto import constant_time_compare, get_random_string, salted_hmac
+
+from nalkinscloud_mosquitto.acl import acl_engine, \
+    MQTT_ACCESS_READ, MQTT_ACCESS_WRITE, MQTT_ACCESS_READWRITE, MQTT_ACCESS_SUBSCRIBE
+from nalkinscloud_mosquitto.cache import TTLCache
+from nalkinscloud_mosquitto.last_values import last_value_store
 from nalkinscloud_mosquitto.models import *
+from nalkinscloud_django.metrics import credentials_cache_hit, credentials_cache_miss
+from nalkinscloud_django.settings import MQTT_AUTH_CACHE_TTL, MQTT_AUTH_CACHE_SIZE, DEVICE_LIST_CACHE_TTL
+
+# device_id -> (stored password hash, digest of the last password that passed 'check_password'),
+# entries of a previous password hash (changed by any process) no longer match
+device_credentials_cache = TTLCache(max_size=MQTT_AUTH_CACHE_SIZE, ttl=MQTT_AUTH_CACHE_TTL)
+
+
+# device_id -> device type (False for devices that do not exist) of the messages ingestors of this process,
+# entries are dropped once a device is saved or deleted in this process, other processes rely on the entries TTL
+known_devices_cache = TTLCache(max_size=100000, ttl=300)
 
 
 def update_device_pass(device_id, password):
@@ -31,6 +55,7 @@ def insert_into_access_list(device, topic):
     new_access_list, created = AccessList.objects.get_or_create(device=device, topic=topic)
     if created:  # We are adding a new device from a customer
         new_access_list.rw = 2
+        new_access_list.is_enabled = True
         new_access_list.save()
     else:  # Just update the access list
         new_access_list.save()
@@ -48,18 +73,38 @@ def is_device_id_exists(device_id):
 
 def is_device_owned_by_user(device, user):
     """
-    Returns True if input user, is one of the input device owner (record exists) else return False
+    Returns True if input user, is one of the input device owner (record exists) else return False,
+    checked with a single EXISTS query on the (user_id, device_id) unique index
 
-    :param device: Device instance
-    :param user: User instance
+    :param device: Device instance or device_id string
+    :param user: User instance or user primary key
     :return: boolean
     """
-    devices = CustomerDevice.objects.filter(device_id=device)  # For each device can be 0 or many owners
-    if devices.exists():  # If found a device then there might be a match
-        for device in devices:
-            if device.user_id == user:  # If user, and the device found math
-                return True
-    return False
+    return CustomerDevice.objects.filter(user_id=user, device_id=device).exists()
+
+
+def get_owned_device_ids(user, device_ids):
+    """
+    Return the devices of input device ids owned by user, with a single query
+
+    :param user: User instance or user primary key
+    :param device_ids: iterable of device_id strings
+    :return: set of device_id strings
+    """
+    return set(CustomerDevice.objects.filter(user_id=user, device_id__in=list(device_ids))
+               .values_list('device_id', flat=True))
+
+
+def get_owned_device_type(device_id, user):
+    """
+    Return the type of device if user is one of its owners, with a single query
+
+    :param device_id: string
+    :param user: User instance
+    :return: string, None if the device is not owned by user
+    """
+    return CustomerDevice.objects.filter(device_id=device_id, user_id=user)\
+        .values_list('device_id__type', flat=True).first()
 
 
 def device_has_any_owner(device):
@@ -69,10 +114,7 @@ def device_has_any_owner(device):
     :param device: Device instance
     :return: boolean
     """
-    devices = CustomerDevice.objects.filter(device_id=device)
-    if devices.exists():
-        return True
-    return False
+    return CustomerDevice.objects.filter(device_id=device).exists()
 
 
 def insert_into_customer_devices(user, device, device_name):
@@ -124,13 +166,360 @@ def remove_from_access_list(device_id, topic):
     return True
 
 
+def get_device_topic(device_id):
+    """
+    Return the topic a device (and its owners) may access, built from the device id
+
+    :param device_id: string
+    :return: string
+    """
+    return device_id + '/#'
+
+
+def activate_devices(user, devices):
+    """
+    Activate many devices for user with a constant number of queries,
+    Devices and their CustomerDevice records are locked (select_for_update) and ownership is checked in the
+    same transaction the new CustomerDevice and AccessList records are bulk created in, so concurrent activations
+    of a device are serialized, results are read back from the written CustomerDevice records,
+    Return a dict of device_id -> (is_activated, reason)
+
+    :param user: User instance
+    :param devices: dict of device_id -> device_name
+    :return: dict
+    """
+    results = {}
+    # Each user has a device (with its email as id) that is allowed to access all of its devices topics
+    user_device_id = user.email
+    with transaction.atomic():
+        existing_devices = set(Device.objects.select_for_update().filter(device_id__in=list(devices))
+                               .values_list('device_id', flat=True))
+        members = get_locked_devices_members(existing_devices)
+
+        new_devices = []
+        for device_id in devices:
+            if device_id not in existing_devices:
+                results[device_id] = (False, 'Device does not exists')
+            elif user.pk in members[device_id]:
+                results[device_id] = (True, 'device already activated')
+            elif members[device_id]:
+                results[device_id] = (False, 'Device already associated')
+            else:
+                new_devices.append(device_id)
+
+        if new_devices:
+            CustomerDevice.objects.bulk_create([CustomerDevice(user_id=user, device_id_id=device_id,
+                                                               device_name=devices[device_id])
+                                                for device_id in new_devices], ignore_conflicts=True)
+            topics = [get_device_topic(device_id) for device_id in new_devices]
+            AccessList.objects.bulk_create(
+                [AccessList(device_id=device_id, topic=topic, rw=2, is_enabled=True)
+                 for device_id, topic in zip(new_devices, topics)] +
+                [AccessList(device_id=user_device_id, topic=topic, rw=2, is_enabled=True) for topic in topics],
+                ignore_conflicts=True)
+            # Rules left by a previous activation are kept by ignore_conflicts, enable them again
+            written_rules = functools.reduce(operator.or_, [Q(device_id=device_id, topic=topic)
+                                                            for device_id, topic in zip(new_devices, topics)],
+                                             Q(device_id=user_device_id, topic__in=topics))
+            AccessList.objects.filter(written_rules).exclude(rw=2, is_enabled=True).update(rw=2, is_enabled=True)
+
+            activated = set(CustomerDevice.objects.filter(user_id=user, device_id__in=new_devices)
+                            .values_list('device_id', flat=True))
+            for device_id in new_devices:
+                results[device_id] = (True, 'Activation successfully completed') if device_id in activated \
+                    else (False, 'Device already associated')
+
+    if new_devices:
+        # bulk_create and update do not send post_save signals, so invalidate what signals.py would
+        invalidate_customers_device_list([user.pk])
+        for device_id in new_devices + [user_device_id]:
+            acl_engine.invalidate(device_id)
+    return results
+
+
+def remove_devices(user, device_ids):
+    """
+    Remove many devices from user with a constant number of queries,
+    A shared device is only left by user, unless user is its last owner, then the device is removed
+    from all of its members and gets an unusable password,
+    CustomerDevice and AccessList records are deleted in a single transaction,
+    Return a dict of device_id -> (is_removed, reason)
+
+    :param user: User instance
+    :param device_ids: list of device ids
+    :return: dict
+    """
+    owned_devices = get_owned_device_ids(user, device_ids)
+
+    if owned_devices:
+        with transaction.atomic():
+            members = get_locked_devices_members(owned_devices)
+            removed_devices = {device_id for device_id in owned_devices
+                               if members[device_id].get(user.pk) == CustomerDevice.ROLE_OWNER
+                               and get_owners_count(members[device_id]) == 1}
+            left_devices = owned_devices - removed_devices
+
+            CustomerDevice.objects.filter(Q(device_id__in=removed_devices) |
+                                          Q(user_id=user, device_id__in=left_devices)).delete()
+            # Access list records of the removed devices and of all of their members user devices
+            removed_members = {user_id for device_id in removed_devices for user_id in members[device_id]}
+            AccessList.objects.filter(Q(device_id__in=removed_devices | removed_members,
+                                        topic__in=[get_device_topic(device_id) for device_id in removed_devices]) |
+                                      Q(device_id=user.email,
+                                        topic__in=[get_device_topic(device_id) for device_id in left_devices]))\
+                .delete()
+            Device.objects.filter(device_id__in=removed_devices).update(password=make_password(None))
+
+        # update() does not send post_save signals, so drop cached credentials here
+        for device_id in removed_devices:
+            device_credentials_cache.invalidate(device_id)
+
+    return {device_id: (True, 'Device Removed from account') if device_id in owned_devices
+            else (False, 'You cannot remove this device')
+            for device_id in device_ids}
+
+
+def get_device_role(device_id, user):
+    """
+    Return the role of user on device, with a single query
+
+    :param device_id: string
+    :param user: User instance or user primary key
+    :return: string, one of CustomerDevice.ROLE_*, None if user is not a member of device
+    """
+    return CustomerDevice.objects.filter(device_id=device_id, user_id=user).values_list('role', flat=True).first()
+
+
+def get_device_members(device_id):
+    """
+    Return the members of device, by the order they were added
+
+    :param device_id: string
+    :return: list of dicts (email, role)
+    """
+    return [{'email': email, 'role': role} for email, role in
+            CustomerDevice.objects.filter(device_id=device_id).order_by('id').values_list('user_id', 'role')]
+
+
+def get_locked_devices_members(device_ids):
+    """
+    Return the members of devices, their CustomerDevice records are locked (select_for_update)
+    until the end of the current transaction, so concurrent membership changes of a device are serialized
+
+    :param device_ids: iterable of device_id strings
+    :return: dict of device_id -> dict of user primary key -> role
+    """
+    members = {device_id: {} for device_id in device_ids}
+    for device_id, user_id, role in CustomerDevice.objects.select_for_update()\
+            .filter(device_id__in=list(members)).values_list('device_id', 'user_id', 'role'):
+        members[device_id][user_id] = role
+    return members
+
+
+def get_owners_count(device_members):
+    """
+    :param device_members: dict of user primary key -> role
+    :return: int
+    """
+    return sum(1 for role in device_members.values() if role == CustomerDevice.ROLE_OWNER)
+
+
+def share_device(device_id, user, role, device_name):
+    """
+    Add user as a member of device with role, or change the role of a member,
+    The CustomerDevice record and the user device AccessList record of the device topic (with the rw of role)
+    are written in a single transaction, so the user device access list stays the effective ACL of user,
+    the broker checks it without looking at memberships,
+    Return a tuple of (is_shared, reason)
+
+    :param device_id: string
+    :param user: User instance, that has a user device (registered)
+    :param role: string, one of CustomerDevice.ROLE_*
+    :param device_name: string, name of the device for a new member
+    :return: tuple of (boolean, string)
+    """
+    with transaction.atomic():
+        members = get_locked_devices_members([device_id])[device_id]
+        current_role = members.get(user.pk)
+        if current_role == CustomerDevice.ROLE_OWNER and role != CustomerDevice.ROLE_OWNER \
+                and get_owners_count(members) == 1:
+            return False, 'Device must have an owner'
+
+        if current_role is None:
+            CustomerDevice.objects.create(user_id=user, device_id_id=device_id, device_name=device_name, role=role)
+        elif current_role != role:
+            customer_device = CustomerDevice.objects.get(user_id=user, device_id=device_id)
+            customer_device.role = role
+            customer_device.save()
+        AccessList.objects.update_or_create(device_id=user.email, topic=get_device_topic(device_id),
+                                            defaults={'rw': CustomerDevice.ROLE_RW[role], 'is_enabled': True})
+    return True, 'Device shared' if current_role is None else 'Role updated'
+
+
+def unshare_device(device_id, user):
+    """
+    Remove user from the members of device, with the user device AccessList record of the device topic,
+    in a single transaction, the last owner of a device cannot be removed,
+    Return a tuple of (is_unshared, reason)
+
+    :param device_id: string
+    :param user: User instance
+    :return: tuple of (boolean, string)
+    """
+    with transaction.atomic():
+        members = get_locked_devices_members([device_id])[device_id]
+        current_role = members.get(user.pk)
+        if current_role is None:
+            return False, 'User is not a member of the device'
+        if current_role == CustomerDevice.ROLE_OWNER and get_owners_count(members) == 1:
+            return False, 'Device must have an owner'
+
+        CustomerDevice.objects.filter(user_id=user, device_id=device_id).delete()
+        AccessList.objects.filter(device_id=user.email, topic=get_device_topic(device_id)).delete()
+    return True, 'Device unshared'
+
+
+def create_devices(device_ids, device_model, device_type, is_enabled=True):
+    """
+    Create many devices with a single INSERT, each with a random password hashed (the slow part) before,
+    the password is never returned, a device owner sets a new one through get_device_pass,
+    existing device ids (or created meanwhile by another process) are skipped
+
+    :param device_ids: list of strings
+    :param device_model: string
+    :param device_type: string
+    :param is_enabled: boolean
+    :return: list of created device ids
+    """
+    existing_devices = set(Device.objects.filter(device_id__in=device_ids).values_list('device_id', flat=True))
+    new_devices = {device_id: Device(device_id=device_id, password=make_password(get_random_string(16)),
+                                     model_id=device_model, type_id=device_type, is_enabled=is_enabled)
+                   for device_id in device_ids if device_id not in existing_devices}
+    Device.objects.bulk_create(new_devices.values(), ignore_conflicts=True)
+    # Rows skipped by ignore_conflicts hold another (salted) password hash than the one inserted
+    return [device_id for device_id, password in Device.objects.filter(device_id__in=list(new_devices))
+            .values_list('device_id', 'password') if password == new_devices[device_id].password]
+
+
+def rebuild_access_lists(user):
+    """
+    Restore the access list records of all devices of user (each device and the user device,
+    by the role of user, can access the device topic), records that are missing are created, existing records are left as they are
+
+    :param user: User instance or user id
+    :return: int number of records created
+    """
+    members = CustomerDevice.objects.filter(user_id=user).values_list('device_id', 'user_id__email', 'role')
+    access_lists = {}
+    for device_id, user_device_id, role in members:
+        topic = get_device_topic(device_id)
+        access_lists[(device_id, topic)] = AccessList(device_id=device_id, topic=topic, rw=2, is_enabled=True)
+        access_lists[(user_device_id, topic)] = AccessList(device_id=user_device_id, topic=topic,
+                                                           rw=CustomerDevice.ROLE_RW[role], is_enabled=True)
+    if not access_lists:
+        return 0
+
+    existing = set(AccessList.objects.filter(device_id__in={key[0] for key in access_lists},
+                                             topic__in={key[1] for key in access_lists})
+                   .values_list('device_id', 'topic'))
+    missing = [access_list for key, access_list in access_lists.items() if key not in existing]
+    AccessList.objects.bulk_create(missing, ignore_conflicts=True)
+
+    # bulk_create does not send post_save signals
+    for device_id in {access_list.device_id for access_list in missing}:
+        acl_engine.invalidate(device_id)
+    return len(missing)
+
+
 def get_customers_devices(user):
     """
-    Return a list of CustomerDevices instances, that have the User instance in their PK
+    Return a list of CustomerDevices instances, that have the User instance in their PK,
+    Device and its DeviceType are fetched in the same query
     :param user: User instance
     :return: list of CustomerDevice instances
     """
-    return CustomerDevice.objects.filter(user_id=user)
+    return CustomerDevice.objects.filter(user_id=user).select_related('device_id__type')
+
+
+def get_customers_device_list_cache_key(user_id):
+    return 'customer_device_list:%s' % user_id
+
+
+def get_customers_device_list(user):
+    """
+    Return list of dicts (device_id, device_name, device_type, role) of all devices of user,
+    The list is built with a single query and cached until one of the users devices change (see signals.py)
+
+    :param user: User instance or user id
+    :return: list of dicts
+    """
+    cache_key = get_customers_device_list_cache_key(getattr(user, 'pk', user))
+    device_list = cache.get(cache_key)
+    if device_list is None:
+        device_list = [{'device_id': device_id, 'device_name': device_name, 'device_type': device_type,
+                        'role': role}
+                       for device_id, device_name, device_type, role in
+                       CustomerDevice.objects.filter(user_id=user)
+                       .order_by('id').values_list('device_id', 'device_name', 'device_id__type', 'role')]
+        cache.set(cache_key, device_list, DEVICE_LIST_CACHE_TTL)
+    return device_list
+
+
+def get_customers_devices_state(user):
+    """
+    Return the devices of user (as get_customers_device_list) each with a 'state' dict of topic -> last message,
+    read from the last value store, so no messages are queried, the state is empty if the store can not be read
+
+    :param user: User instance or user id
+    :return: list of dicts
+    """
+    device_list = get_customers_device_list(user)
+    states = last_value_store.get_many_or_empty(device['device_id'] for device in device_list)
+    return [dict(device, state=states[device['device_id']]) for device in device_list]
+
+
+# Fields that can be selected from a device listing, mapped to their CustomerDevice lookups
+CUSTOMER_DEVICE_FIELDS = {
+    'device_id': 'device_id',
+    'device_name': 'device_name',
+    'device_type': 'device_id__type',
+    'device_model': 'device_id__model',
+    'date_created': 'date_created',
+    'role': 'role',
+}
+
+
+def get_customers_devices_values(user, device_type=None, device_model=None, fields=None):
+    """
+    Return a lazy values queryset of devices of user, ordered by CustomerDevice id,
+    Only the selected fields (and 'id', used as a pagination key) are fetched
+
+    :param user: User instance or user id
+    :param device_type: string, optional device type filter
+    :param device_model: string, optional device model filter
+    :param fields: list of CUSTOMER_DEVICE_FIELDS keys, all fields if None
+    :return: QuerySet of dicts
+    """
+    queryset = CustomerDevice.objects.filter(user_id=user)
+    if device_type:
+        queryset = queryset.filter(device_id__type=device_type)
+    if device_model:
+        queryset = queryset.filter(device_id__model=device_model)
+
+    selected = {field: F(CUSTOMER_DEVICE_FIELDS[field]) for field in (fields or CUSTOMER_DEVICE_FIELDS)
+                if field != CUSTOMER_DEVICE_FIELDS[field]}
+    plain = [field for field in (fields or CUSTOMER_DEVICE_FIELDS) if field not in selected]
+    return queryset.order_by('id').values('id', *plain, **selected)
+
+
+def invalidate_customers_device_list(user_ids):
+    """
+    Remove cached device lists of input users
+
+    :param user_ids: list of user ids
+    :return: None
+    """
+    cache.delete_many([get_customers_device_list_cache_key(user_id) for user_id in user_ids])
 
 
 def insert_new_client_to_devices(email, password, ip):
@@ -165,3 +554,88 @@ def get_device_name_by_id(device):
     :return: string
     """
     return CustomerDevice.objects.get(device_id=device).device_name
+
+
+def get_password_digest(password):
+    """
+    Return keyed digest of input password, used to compare passwords against the credentials cache
+    without keeping plain text passwords in memory
+
+    :param password: string
+    :return: string
+    """
+    return salted_hmac('nalkinscloud_mosquitto.device_credentials', password).hexdigest()
+
+
+def authenticate_device(device_id, password):
+    """
+    Return True if an enabled Device with 'device_id' exists and password is correct, else return False,
+    successful authentications are cached so repeated connects skip the password hashing,
+    the stored password hash is read on every call (a primary key lookup), a cached entry only matches
+    the hash it was verified against, so a password changed or a device disabled by any process
+    is seen right away
+
+    :param device_id: string
+    :param password: string
+    :return: boolean
+    """
+    encoded = Device.objects.filter(device_id=device_id, is_enabled=True).values_list('password', flat=True).first()
+    if encoded is None:
+        return False
+
+    digest = get_password_digest(password)
+    cached = device_credentials_cache.get(device_id)
+    if cached is not None and cached[0] == encoded and constant_time_compare(cached[1], digest):
+        credentials_cache_hit.inc()
+        return True
+    credentials_cache_miss.inc()
+
+    if not check_password(password, encoded):
+        return False
+
+    device_credentials_cache.set(device_id, (encoded, digest))
+    return True
+
+
+def is_device_superuser(device_id):
+    """
+    Return True if an enabled Device with 'device_id' exists and marked as super user
+
+    :param device_id: string
+    :return: boolean
+    """
+    return Device.objects.filter(device_id=device_id, is_enabled=True, super=True).exists()
+
+
+def topic_matches_pattern(pattern, topic):
+    """
+    Return True if topic matches an MQTT topic filter (pattern), supporting '+' and '#' wildcards
+
+    :param pattern: string, for example 'device_id/#'
+    :param topic: string, for example 'device_id/temperature'
+    :return: boolean
+    """
+    pattern_levels = pattern.split('/')
+    topic_levels = topic.split('/')
+    for index, level in enumerate(pattern_levels):
+        if level == '#':
+            return True
+        if index >= len(topic_levels):
+            return False
+        if level != '+' and level != topic_levels[index]:
+            return False
+    return len(pattern_levels) == len(topic_levels)
+
+
+def is_topic_allowed(device_id, topic, access):
+    """
+    Return True if one of the enabled AccessList records of device allows 'access' on topic,
+    AccessList.rw of 1 allows reading (and subscribing), 2 allows reading and writing,
+    Records are matched using the devices compiled topic trie (see acl.py)
+
+    :param device_id: string
+    :param topic: string
+    :param access: int, one of MQTT_ACCESS_* values
+    :return: boolean
+    """
+    return acl_engine.is_allowed(device_id, topic, access)
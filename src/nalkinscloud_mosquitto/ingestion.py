@@ -0,0 +1,306 @@
+import logging
+import queue
+import threading
+import time
+from collections import namedtuple
+
+import paho.mqtt.client as mqtt
+from django.db import DatabaseError, close_old_connections
+from django.utils import timezone
+
+from nalkinscloud_mosquitto.functions import known_devices_cache
+from nalkinscloud_mosquitto.models import Device, Message
+from nalkinscloud_mosquitto.partitions import insert_messages, clear_partitions_cache
+from nalkinscloud_mosquitto.signals import messages_ingested
+from nalkinscloud_django.settings import PROJECT_NAME
+
+# Define logger
+logger = logging.getLogger(PROJECT_NAME)
+
+ReceivedMessage = namedtuple('ReceivedMessage', ['topic', 'payload', 'qos', 'received_at'])
+# A message as written by the ingestor (and sent with the 'messages_ingested' signal)
+IngestedMessage = namedtuple('IngestedMessage', ['device_id', 'topic', 'message', 'qos', 'date_created'])
+
+MESSAGE_MAX_LENGTH = Message._meta.get_field('message').max_length
+
+
+def get_topic_device_id(topic):
+    """
+    Return the device id a topic belongs to, devices publish under their own topic ('<device_id>/...')
+
+    :param topic: string
+    :return: string
+    """
+    return topic.split('/', 1)[0]
+
+
+class MessageIngestor(object):
+    """
+    Buffer received messages in a bounded queue and write them to the messages partitions from a single writer thread,
+    using one transaction per batch, a batch is flushed once it has 'batch_size' messages
+    or 'flush_interval' seconds passed since its first message
+
+    Once the queue is full (database writes fall behind) 'put' blocks up to 'put_timeout' (forever if None),
+    blocking the MQTT network thread pushes the backpressure back to the broker,
+    messages that could not be queued in time are dropped and counted
+
+    :param int batch_size: max messages per batch
+    :param float flush_interval: max seconds a message waits in a partial batch
+    :param int max_queue_size: max messages waiting to be written
+    :param float put_timeout: seconds to wait for queue space, None to wait forever
+    :param int max_retries: number of times a failed batch INSERT is retried
+    :param int known_devices_ttl: seconds to remember the type of an existing device
+    :param int unknown_devices_ttl: seconds to remember that a device does not exist, kept short since devices
+        registered by other processes (the API) are only seen once the entry expires
+    """
+
+    def __init__(self, batch_size=2000, flush_interval=1.0, max_queue_size=100000, put_timeout=None,
+                 max_retries=3, known_devices_ttl=300, unknown_devices_ttl=10):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.max_retries = max_retries
+        self.known_devices_ttl = known_devices_ttl
+        self.unknown_devices_ttl = unknown_devices_ttl
+        self.received_count = 0
+        self.dropped_count = 0
+        self.written_count = 0
+        self.rejected_count = 0
+        self.failed_count = 0
+        self.flush_count = 0
+        self.last_flush_duration = 0
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='messages-ingestor', daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        """
+        Stop ingesting, returns once all queued messages are written
+        (by the calling thread if the writer thread was never started)
+        """
+        with self._lock:
+            if self._thread is not None:
+                self._queue.put(None)
+                self._thread.join()
+                self._thread = None
+                return
+
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+            if len(batch) == self.batch_size:
+                self.flush(batch)
+                batch = []
+        if batch:
+            self.flush(batch)
+
+    def put(self, topic, payload, qos=0):
+        """
+        Queue a received message, should be called from a single thread (the MQTT network thread)
+
+        :param topic: string
+        :param payload: bytes
+        :param qos: int
+        :return: boolean, False if the message was dropped
+        """
+        self.received_count += 1
+        try:
+            self._queue.put(ReceivedMessage(topic, payload, qos, timezone.now()), timeout=self.put_timeout)
+            return True
+        except queue.Full:
+            self.dropped_count += 1
+            return False
+
+    def stats(self):
+        return {
+            'received': self.received_count,
+            'written': self.written_count,
+            'dropped': self.dropped_count,
+            'rejected': self.rejected_count,
+            'failed': self.failed_count,
+            'flushes': self.flush_count,
+            'queued': self._queue.qsize(),
+            'last_flush_ms': round(self.last_flush_duration * 1000, 1),
+        }
+
+    def _collect_batch(self):
+        """
+        Return a tuple of (batch, is_stopping)
+        """
+        try:
+            message = self._queue.get(timeout=self.flush_interval)
+        except queue.Empty:
+            return [], False
+        if message is None:
+            return [], True
+        batch = [message]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            try:
+                # Drain what is already queued without waiting, only wait when the queue is empty
+                message = self._queue.get_nowait()
+            except queue.Empty:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    message = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            if message is None:
+                return batch, True
+            batch.append(message)
+        return batch, False
+
+    def _run(self):
+        while True:
+            batch, is_stopping = self._collect_batch()
+            if batch:
+                self.flush(batch)
+            if is_stopping:
+                close_old_connections()
+                return
+
+    def get_devices_types(self, device_ids):
+        """
+        Return the types of the existing devices of device_ids, unknown ids are looked up with a single query
+
+        :param device_ids: set of strings
+        :return: dict of device_id -> device type
+        """
+        devices_types = {}
+        missing_devices = set()
+        for device_id in device_ids:
+            device_type = known_devices_cache.get(device_id)
+            if device_type is None:
+                missing_devices.add(device_id)
+            elif device_type:  # False for devices that do not exist
+                devices_types[device_id] = device_type
+
+        if missing_devices:
+            found_devices = dict(Device.objects.filter(device_id__in=missing_devices)
+                                 .values_list('device_id', 'type'))
+            for device_id in missing_devices:
+                if device_id in found_devices:
+                    known_devices_cache.set(device_id, found_devices[device_id], ttl=self.known_devices_ttl)
+                else:
+                    known_devices_cache.set(device_id, False, ttl=self.unknown_devices_ttl)
+            devices_types.update(found_devices)
+        return devices_types
+
+    def flush(self, batch):
+        """
+        Write a batch of received messages in a single transaction,
+        messages of unknown devices are rejected, payloads are truncated to the column size
+
+        :param batch: list of ReceivedMessage
+        :return: None
+        """
+        start = time.monotonic()
+        close_old_connections()
+        try:
+            devices_types = self.get_devices_types({get_topic_device_id(received.topic) for received in batch})
+        except DatabaseError:
+            logger.exception('Failed resolving devices of %d messages', len(batch))
+            devices_types = {}
+            self.failed_count += len(batch)
+            batch = []
+
+        messages = []
+        for received in batch:
+            device_id = get_topic_device_id(received.topic)
+            if device_id not in devices_types:
+                self.rejected_count += 1
+                continue
+            messages.append(IngestedMessage(device_id, received.topic,
+                                            received.payload.decode('utf-8', 'replace')[:MESSAGE_MAX_LENGTH],
+                                            received.qos, received.received_at))
+
+        if messages:
+            for attempt in range(self.max_retries + 1):
+                try:
+                    insert_messages(messages, devices_types)
+                    break
+                except DatabaseError:
+                    logger.exception('Failed writing %d messages (attempt %d)', len(messages), attempt + 1)
+                    close_old_connections()
+                    clear_partitions_cache()  # A partition might have been dropped by 'compact_messages'
+                    if attempt < self.max_retries:
+                        time.sleep(min(2 ** attempt, 10))
+            else:
+                self.failed_count += len(messages)
+                messages = []
+
+        if messages:
+            self.written_count += len(messages)
+            # A failing receiver (for example rollups) must not stop the writer thread, messages are already stored
+            for receiver, response in messages_ingested.send_robust(sender=Message, messages=messages,
+                                                                    devices_types=devices_types):
+                if isinstance(response, Exception):
+                    logger.error('messages_ingested receiver %s failed: %r', receiver.__name__, response)
+
+        self.flush_count += 1
+        self.last_flush_duration = time.monotonic() - start
+
+
+class MQTTMessageSubscriber(object):
+    """
+    Subscribe to broker traffic and pass every received message to a MessageIngestor
+
+    :param MessageIngestor ingestor:
+    :param str host: broker host
+    :param int port: broker port
+    :param str topic: topic filter to subscribe to
+    :param int qos: subscription QoS
+    :param str transport: 'tcp' or 'websockets'
+    :param str username: optional broker username
+    :param str password: optional broker password
+    :param str client_id: broker client id
+    """
+
+    def __init__(self, ingestor, host, port, topic='#', qos=0, transport='tcp', username=None, password=None,
+                 client_id='', keepalive=60):
+        self.ingestor = ingestor
+        self.host = host
+        self.port = port
+        self.topic = topic
+        self.qos = qos
+        self.keepalive = keepalive
+        # A persistent session (clean_session=False) keeps QoS 1 messages queued by the broker while reconnecting
+        self.client = mqtt.Client(client_id=client_id, clean_session=not (client_id and qos), transport=transport)
+        if username:
+            self.client.username_pw_set(username, password)
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+        self.client.on_message = self._on_message
+
+    def start(self):
+        self.client.connect_async(self.host, self.port, keepalive=self.keepalive)
+        self.client.loop_start()
+
+    def stop(self):
+        self.client.disconnect()
+        self.client.loop_stop()
+
+    def _on_connect(self, client, userdata, flags, rc):
+        if rc == mqtt.CONNACK_ACCEPTED:
+            logger.info('Messages subscriber connected to %s:%s, subscribing to %s', self.host, self.port, self.topic)
+            client.subscribe(self.topic, qos=self.qos)  # Subscribe again on every reconnect
+        else:
+            logger.error('Messages subscriber connection refused: %s', mqtt.connack_string(rc))
+
+    def _on_disconnect(self, client, userdata, rc):
+        if rc != mqtt.MQTT_ERR_SUCCESS:
+            logger.warning('Messages subscriber disconnected unexpectedly (%s), reconnecting', mqtt.error_string(rc))
+
+    def _on_message(self, client, userdata, message):
+        self.ingestor.put(message.topic, message.payload, message.qos)
@@ -0,0 +1,175 @@
+import json
+import logging
+import threading
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.serializers.json import DjangoJSONEncoder
+
+from nalkinscloud_django.settings import PROJECT_NAME, LAST_VALUE_STORE_URL
+
+# Define logger
+logger = logging.getLogger(PROJECT_NAME)
+
+KEY_PREFIX = 'last_values:'
+
+
+class MemoryHashClient(object):
+    """
+    In process stand-in for the subset of the redis client used by LastValueStore (hashes and pipelines),
+    last values are then only visible to the process that ingests the messages
+    """
+
+    def __init__(self):
+        self._hashes = {}
+        self._lock = threading.Lock()
+
+    def hset(self, name, key=None, value=None, mapping=None):
+        items = dict(mapping or {})
+        if key is not None:
+            items[key] = value
+        with self._lock:
+            fields = self._hashes.setdefault(name, {})
+            added = len(set(items) - set(fields))
+            fields.update(items)
+        return added
+
+    def hgetall(self, name):
+        with self._lock:
+            return dict(self._hashes.get(name, {}))
+
+    def delete(self, *names):
+        with self._lock:
+            return len([name for name in names if self._hashes.pop(name, None) is not None])
+
+    def flushdb(self):
+        with self._lock:
+            self._hashes.clear()
+
+    def pipeline(self, transaction=True):
+        return MemoryHashPipeline(self)
+
+
+class MemoryHashPipeline(object):
+    def __init__(self, client):
+        self.client = client
+        self._commands = []
+
+    def hset(self, *args, **kwargs):
+        self._commands.append((self.client.hset, args, kwargs))
+        return self
+
+    def hgetall(self, *args, **kwargs):
+        self._commands.append((self.client.hgetall, args, kwargs))
+        return self
+
+    def execute(self):
+        commands, self._commands = self._commands, []
+        return [command(*args, **kwargs) for command, args, kwargs in commands]
+
+
+class LastValueStore(object):
+    """
+    Keep the last message of every device topic, stored as one hash per device (topic -> message),
+    so the state of n devices is read with n hash reads in a single round trip, without querying messages
+
+    :param client: redis client (or MemoryHashClient)
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self._encoder = DjangoJSONEncoder()
+        self._warnings = set()
+
+    @property
+    def is_shared(self):
+        """
+        False for an in process store, that web processes always read empty
+        """
+        return not isinstance(self.client, MemoryHashClient)
+
+    def update(self, messages):
+        """
+        Store the last value of each device topic of messages, messages are expected in the order they were received
+
+        :param messages: iterable of objects with device_id, topic, message and date_created
+        :return: None
+        """
+        devices = {}
+        for message in messages:
+            devices.setdefault(message.device_id, {})[message.topic] = self._encoder.encode(
+                {'message': message.message, 'date_created': message.date_created})
+        if not devices:
+            return
+        pipeline = self.client.pipeline(transaction=False)
+        for device_id, values in devices.items():
+            pipeline.hset(KEY_PREFIX + device_id, mapping=values)
+        pipeline.execute()
+
+    def get_many(self, device_ids):
+        """
+        Return the last values of devices
+
+        :param device_ids: list of strings
+        :return: dict of device_id -> dict of topic -> dict (message, date_created), {} for devices never heard from
+        """
+        device_ids = list(device_ids)
+        if not device_ids:
+            return {}
+        pipeline = self.client.pipeline(transaction=False)
+        for device_id in device_ids:
+            pipeline.hgetall(KEY_PREFIX + device_id)
+        return {device_id: {self._decode(topic): json.loads(self._decode(value)) for topic, value in values.items()}
+                for device_id, values in zip(device_ids, pipeline.execute())}
+
+    def get_many_or_empty(self, device_ids):
+        """
+        Return the last values of devices as get_many, {} for every device when the store can not be read
+        (an in process store read outside the ingesting process, or the redis server unreachable),
+        a warning is logged once per process for each cause
+
+        :param device_ids: list of strings
+        :return: dict of device_id -> dict of topic -> dict (message, date_created)
+        """
+        device_ids = list(device_ids)
+        if not self.is_shared:
+            self.warn_once("last_value_store_url is 'memory://', devices state is only known to the ingesting "
+                           "process, set a redis url shared with it")
+        try:
+            return self.get_many(device_ids)
+        except Exception:
+            # The redis client errors are not imported, redis is an optional dependency
+            self.warn_once('Last value store could not be read, devices are returned without state', exc_info=True)
+            return {device_id: {} for device_id in device_ids}
+
+    def warn_once(self, message, exc_info=False):
+        if message not in self._warnings:
+            self._warnings.add(message)
+            logger.warning(message, exc_info=exc_info)
+
+    def get(self, device_id):
+        return self.get_many([device_id])[device_id]
+
+    def delete(self, device_id):
+        self.client.delete(KEY_PREFIX + device_id)
+
+    @staticmethod
+    def _decode(value):
+        return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+def create_last_value_store(url=LAST_VALUE_STORE_URL):
+    """
+    :param url: 'memory://' for an in process store, or a redis url ('redis://host:6379/0', requires redis-py 3.5
+                or above for hset mapping)
+    :return: LastValueStore
+    """
+    if not url or url.startswith('memory://'):
+        return LastValueStore(MemoryHashClient())
+    try:
+        import redis
+    except ImportError:
+        raise ImproperlyConfigured('redis package is required for last value store %s' % url)
+    return LastValueStore(redis.Redis.from_url(url))
+
+
+last_value_store = create_last_value_store()
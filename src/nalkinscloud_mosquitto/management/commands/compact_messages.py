@@ -0,0 +1,39 @@
+import logging
+
+from django.core.management.base import BaseCommand
+
+from nalkinscloud_mosquitto.partitions import get_expired_partitions, drop_partition, create_upcoming_partitions, \
+    migrate_legacy_messages
+from nalkinscloud_django.settings import PROJECT_NAME
+
+# Define logger
+logger = logging.getLogger(PROJECT_NAME)
+
+
+class Command(BaseCommand):
+    help = 'Drop messages partitions that are older than the retention policy of their device type, ' \
+           'and create the partitions of the next periods'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only list the partitions that would be dropped')
+        parser.add_argument('--migrate-legacy', action='store_true',
+                            help="Move the messages of the 'messages' table (stored before partitioning) "
+                                 "to their partitions")
+
+    def handle(self, *args, **options):
+        if options['migrate_legacy'] and not options['dry_run']:
+            self.stdout.write('Moved %d messages to partitions' % migrate_legacy_messages())
+
+        expired_partitions = get_expired_partitions()
+        for partition in expired_partitions:
+            if options['dry_run']:
+                self.stdout.write('Would drop %s' % partition.table_name)
+            else:
+                drop_partition(partition)
+                self.stdout.write('Dropped %s' % partition.table_name)
+
+        created_partitions = [] if options['dry_run'] else create_upcoming_partitions()
+        for table_name in created_partitions:
+            self.stdout.write('Created %s' % table_name)
+        logger.info('Messages compaction done, %d expired partitions, %d partitions created%s',
+                    len(expired_partitions), len(created_partitions), ' (dry run)' if options['dry_run'] else '')
@@ -0,0 +1,65 @@
+import logging
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+
+from nalkinscloud_mosquitto.ingestion import MessageIngestor, MQTTMessageSubscriber
+from nalkinscloud_django.settings import PROJECT_NAME, HOSTNAME, MQTT_BROKER_HOST, MQTT_BROKER_PORT, \
+    MQTT_BROKER_TRANSPORT, MQTT_INGEST_USERNAME, MQTT_INGEST_PASSWORD, MQTT_INGEST_TOPIC, MQTT_INGEST_QOS, \
+    MQTT_INGEST_BATCH_SIZE, MQTT_INGEST_FLUSH_INTERVAL, MQTT_INGEST_QUEUE_SIZE
+
+# Define logger
+logger = logging.getLogger(PROJECT_NAME)
+
+
+class Command(BaseCommand):
+    help = 'Subscribe to the MQTT broker and store received messages in the messages table, using batched inserts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default=MQTT_BROKER_HOST)
+        parser.add_argument('--port', type=int, default=MQTT_BROKER_PORT)
+        parser.add_argument('--transport', default=MQTT_BROKER_TRANSPORT, choices=('tcp', 'websockets'))
+        parser.add_argument('--topic', default=MQTT_INGEST_TOPIC)
+        parser.add_argument('--qos', type=int, default=MQTT_INGEST_QOS, choices=(0, 1))
+        parser.add_argument('--batch-size', type=int, default=MQTT_INGEST_BATCH_SIZE)
+        parser.add_argument('--flush-interval', type=float, default=MQTT_INGEST_FLUSH_INTERVAL,
+                            help='Max seconds a received message waits before it is written')
+        parser.add_argument('--queue-size', type=int, default=MQTT_INGEST_QUEUE_SIZE,
+                            help='Max messages waiting to be written, once full the broker connection is throttled')
+        parser.add_argument('--put-timeout', type=float, default=None,
+                            help='Drop messages that could not be queued within this many seconds '
+                                 '(default: wait for queue space)')
+        parser.add_argument('--stats-interval', type=float, default=60,
+                            help='Seconds between ingestion metrics log lines')
+
+    def handle(self, *args, **options):
+        ingestor = MessageIngestor(batch_size=options['batch_size'],
+                                   flush_interval=options['flush_interval'],
+                                   max_queue_size=options['queue_size'],
+                                   put_timeout=options['put_timeout'])
+        subscriber = MQTTMessageSubscriber(ingestor,
+                                           host=options['host'],
+                                           port=options['port'],
+                                           topic=options['topic'],
+                                           qos=options['qos'],
+                                           transport=options['transport'],
+                                           username=MQTT_INGEST_USERNAME,
+                                           password=MQTT_INGEST_PASSWORD,
+                                           client_id='%s-ingest-messages' % HOSTNAME)
+
+        stop_event = threading.Event()
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+
+        ingestor.start()
+        subscriber.start()
+        logger.info('Ingesting messages of %s from %s:%s', options['topic'], options['host'], options['port'])
+        try:
+            while not stop_event.wait(options['stats_interval']):
+                logger.info('Messages ingestion stats: %s', ingestor.stats())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            subscriber.stop()
+            ingestor.stop()  # Writes all queued messages
+            logger.info('Messages ingestion stopped, stats: %s', ingestor.stats())
@@ -0,0 +1,29 @@
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from nalkinscloud_mosquitto.rollups import rebuild_rollups
+
+
+class Command(BaseCommand):
+    help = 'Recompute messages rollups of whole days from the raw messages, ' \
+           'rebuilding the current day while messages are ingested may count recent messages twice'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', required=True, help='First day to rebuild (YYYY-MM-DD, UTC)')
+        parser.add_argument('--end', help='Last day to rebuild (YYYY-MM-DD, UTC), default is today')
+        parser.add_argument('--device-id', help='Rebuild rollups of a single device')
+
+    def handle(self, *args, **options):
+        start = parse_date(options['start'])
+        end = parse_date(options['end']) if options['end'] else timezone.now().date()
+        if start is None or end is None or end < start:
+            raise CommandError('--start and --end should be dates (YYYY-MM-DD), end should not be before start')
+
+        count = rebuild_rollups(datetime.datetime(start.year, start.month, start.day, tzinfo=datetime.timezone.utc),
+                                datetime.datetime(end.year, end.month, end.day, tzinfo=datetime.timezone.utc)
+                                + datetime.timedelta(days=1),
+                                device_id=options['device_id'])
+        self.stdout.write('Rebuilt rollups from %d messages' % count)
@@ -0,0 +1,23 @@
+# Generated by Django 3.0.12 on 2026-10-18 10:20
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nalkinscloud_mosquitto', '0002_data_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='message',
+            name='date_created',
+            field=models.DateTimeField(blank=True, default=django.utils.timezone.now, verbose_name='Date Created'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['device', 'date_created'], name='messages_device_date_idx'),
+        ),
+    ]
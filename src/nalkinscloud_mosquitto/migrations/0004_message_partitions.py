@@ -0,0 +1,44 @@
+# Generated by Django 3.0.12 on 2026-10-18 10:29
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nalkinscloud_mosquitto', '0003_message_date_created_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageRetentionPolicy',
+            fields=[
+                ('device_type', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='nalkinscloud_mosquitto.DeviceType')),
+                ('retention_days', models.PositiveIntegerField(help_text='0 keeps messages forever', verbose_name='Retention Days')),
+                ('last_update_date', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'message_retention_policy',
+                'verbose_name_plural': 'message_retention_policies',
+                'db_table': 'message_retention_policies',
+            },
+        ),
+        migrations.CreateModel(
+            name='MessagePartition',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('table_name', models.CharField(max_length=64, unique=True, verbose_name='Table Name')),
+                ('period_start', models.DateTimeField(db_index=True, verbose_name='Period Start')),
+                ('period_end', models.DateTimeField(db_index=True, verbose_name='Period End')),
+                ('date_created', models.DateTimeField(auto_now_add=True, verbose_name='Date Created')),
+                ('device_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='nalkinscloud_mosquitto.DeviceType')),
+            ],
+            options={
+                'verbose_name': 'message_partition',
+                'verbose_name_plural': 'message_partitions',
+                'db_table': 'message_partitions',
+                'unique_together': {('device_type', 'period_start')},
+            },
+        ),
+    ]
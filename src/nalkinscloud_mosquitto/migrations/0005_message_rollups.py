@@ -0,0 +1,34 @@
+# Generated by Django 3.0.12 on 2026-10-18 10:31
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nalkinscloud_mosquitto', '0004_message_partitions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('topic', models.CharField(max_length=256, verbose_name='Message Topic')),
+                ('resolution', models.CharField(choices=[('1m', 'Minute'), ('1h', 'Hour'), ('1d', 'Day')], max_length=2, verbose_name='Resolution')),
+                ('bucket_start', models.DateTimeField(verbose_name='Bucket Start')),
+                ('count', models.PositiveIntegerField(default=0, verbose_name='Count')),
+                ('sum', models.FloatField(default=0, verbose_name='Sum')),
+                ('min', models.FloatField(verbose_name='Min')),
+                ('max', models.FloatField(verbose_name='Max')),
+                ('device', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='nalkinscloud_mosquitto.Device')),
+            ],
+            options={
+                'verbose_name': 'message_rollup',
+                'verbose_name_plural': 'message_rollups',
+                'db_table': 'message_rollups',
+                'unique_together': {('device', 'topic', 'resolution', 'bucket_start')},
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.12 on 2026-10-18 11:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nalkinscloud_mosquitto', '0005_message_rollups'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customerdevice',
+            name='role',
+            field=models.CharField(choices=[('owner', 'Owner'), ('operator', 'Operator'), ('viewer', 'Viewer')], default='owner', max_length=8, verbose_name='Role'),
+        ),
+    ]
@@ -1,5 +1,6 @@
 
 from django.db import models
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.contrib.auth.models import BaseUserManager, AbstractBaseUser
@@ -94,9 +95,28 @@ class Device(AbstractBaseUser):
 
 
 class CustomerDevice(models.Model):
+    """
+    A user (member) of a device, a device may be shared with many users, each with a role
+    """
+    ROLE_OWNER = 'owner'  # Reads and writes the device topics, may share and remove the device
+    ROLE_OPERATOR = 'operator'  # Reads and writes the device topics
+    ROLE_VIEWER = 'viewer'  # Only reads the device topics
+    ROLE_CHOICES = (
+        (ROLE_OWNER, _('Owner')),
+        (ROLE_OPERATOR, _('Operator')),
+        (ROLE_VIEWER, _('Viewer')),
+    )
+    # AccessList.rw granted to the members user device on the device topic
+    ROLE_RW = {
+        ROLE_OWNER: 2,
+        ROLE_OPERATOR: 2,
+        ROLE_VIEWER: 1,
+    }
+
     user_id = models.ForeignKey(User, on_delete=models.CASCADE)
     device_id = models.ForeignKey(Device, on_delete=models.CASCADE)
     device_name = models.CharField(_('Device Name'), max_length=32, null=False)
+    role = models.CharField(_('Role'), max_length=8, choices=ROLE_CHOICES, default=ROLE_OWNER)
     date_created = models.DateTimeField(_('Date Created'),  auto_now_add=True, blank=True)
 
     def __str__(self):
@@ -139,12 +159,86 @@ class Message(models.Model):
     topic = models.CharField(_('Message Topic'), max_length=256, null=False)
     message = models.CharField(_('Message Body'), max_length=256, null=False)
     qos = models.IntegerField(_('QOS'), validators=[MaxValueValidator(1), MinValueValidator(0)], null=False, default=1)
-    date_created = models.DateTimeField(_('Date Created'),  auto_now_add=True, blank=True)
+    # Set by the ingestor to the time the message was received, not the time its batch was written
+    date_created = models.DateTimeField(_('Date Created'), default=timezone.now, blank=True)
 
     def __str__(self):
         return 'Message of device: ' + self.device.device_id
 
     class Meta:
+        indexes = [
+            models.Index(fields=['device', 'date_created'], name='messages_device_date_idx'),
+        ]
         verbose_name = _('messages')
         verbose_name_plural = _('messages')
         db_table = 'messages'
+
+
+class MessagePartition(models.Model):
+    """
+    Registry of the per (device type, period) messages tables, managed by nalkinscloud_mosquitto.partitions
+    """
+    table_name = models.CharField(_('Table Name'), max_length=64, unique=True)
+    device_type = models.ForeignKey(DeviceType, on_delete=models.CASCADE)
+    period_start = models.DateTimeField(_('Period Start'), db_index=True)
+    period_end = models.DateTimeField(_('Period End'), db_index=True)
+    date_created = models.DateTimeField(_('Date Created'),  auto_now_add=True, blank=True)
+
+    def __str__(self):
+        return self.table_name
+
+    class Meta:
+        unique_together = (('device_type', 'period_start'),)
+        verbose_name = _('message_partition')
+        verbose_name_plural = _('message_partitions')
+        db_table = 'message_partitions'
+
+
+class MessageRetentionPolicy(models.Model):
+    """
+    Number of days messages of a device type are kept, device types without a policy use MESSAGES_RETENTION_DAYS
+    """
+    device_type = models.OneToOneField(DeviceType, on_delete=models.CASCADE, primary_key=True)
+    retention_days = models.PositiveIntegerField(_('Retention Days'), help_text=_('0 keeps messages forever'))
+    last_update_date = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return '%s: %d days' % (self.device_type, self.retention_days)
+
+    class Meta:
+        verbose_name = _('message_retention_policy')
+        verbose_name_plural = _('message_retention_policies')
+        db_table = 'message_retention_policies'
+
+
+class MessageRollup(models.Model):
+    """
+    Aggregates of numeric messages of a device topic over a time bucket, maintained by nalkinscloud_mosquitto.rollups
+    """
+    RESOLUTION_CHOICES = (
+        ('1m', _('Minute')),
+        ('1h', _('Hour')),
+        ('1d', _('Day')),
+    )
+
+    device = models.ForeignKey(Device, on_delete=models.CASCADE)
+    topic = models.CharField(_('Message Topic'), max_length=256, null=False)
+    resolution = models.CharField(_('Resolution'), max_length=2, choices=RESOLUTION_CHOICES)
+    bucket_start = models.DateTimeField(_('Bucket Start'))
+    count = models.PositiveIntegerField(_('Count'), default=0)
+    sum = models.FloatField(_('Sum'), default=0)
+    min = models.FloatField(_('Min'))
+    max = models.FloatField(_('Max'))
+
+    def __str__(self):
+        return '%s %s %s %s' % (self.device_id, self.topic, self.resolution, self.bucket_start)
+
+    class Meta:
+        unique_together = (('device', 'topic', 'resolution', 'bucket_start'),)
+        verbose_name = _('message_rollup')
+        verbose_name_plural = _('message_rollups')
+        db_table = 'message_rollups'
+
+    @property
+    def avg(self):
+        return self.sum / self.count if self.count else None
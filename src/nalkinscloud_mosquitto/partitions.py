@@ -0,0 +1,340 @@
+import datetime
+import logging
+import re
+import threading
+
+from django.apps.registry import Apps
+from django.db import DatabaseError, IntegrityError, connection, models, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from nalkinscloud_mosquitto.models import Device, Message, MessagePartition, MessageRetentionPolicy
+from nalkinscloud_django.settings import PROJECT_NAME, MESSAGES_PARTITION_PERIOD, MESSAGES_PRECREATE_PERIODS, \
+    MESSAGES_RETENTION_DAYS
+
+# Define logger
+logger = logging.getLogger(PROJECT_NAME)
+
+# Partition models are kept out of the project apps registry, so they are never part of migrations
+partition_apps = Apps()
+_partition_models = {}
+_partitions = {}  # (device_type, period_start) -> table name, of partitions known to exist
+_lock = threading.Lock()
+
+
+def get_period_start(date, period=MESSAGES_PARTITION_PERIOD):
+    """
+    Return the start (UTC) of the partition period that contains date
+
+    :param date: aware datetime
+    :param period: 'day' or 'month'
+    :return: aware datetime
+    """
+    date = date.astimezone(datetime.timezone.utc)
+    if period == 'month':
+        return datetime.datetime(date.year, date.month, 1, tzinfo=datetime.timezone.utc)
+    return datetime.datetime(date.year, date.month, date.day, tzinfo=datetime.timezone.utc)
+
+
+def get_period_end(period_start, period=MESSAGES_PARTITION_PERIOD):
+    if period == 'month':
+        return (period_start + datetime.timedelta(days=32)).replace(day=1)
+    return period_start + datetime.timedelta(days=1)
+
+
+def get_partition_table_name(device_type, period_start, period=MESSAGES_PARTITION_PERIOD):
+    """
+    Return the table name of a partition, for example 'messages_dht_20190417'
+
+    :param device_type: string
+    :param period_start: datetime
+    :param period: 'day' or 'month'
+    :return: string
+    """
+    return 'messages_%s_%s' % (re.sub(r'[^a-z0-9_]', '_', device_type.lower())[:32],
+                               period_start.strftime('%Y%m' if period == 'month' else '%Y%m%d'))
+
+
+def get_partition_model(table_name):
+    """
+    Return an (unmanaged) model class of a partition table, same columns as Message,
+    'device_id' is not a foreign key so expired partitions can be dropped without touching devices
+
+    :param table_name: string
+    :return: Model class
+    """
+    model = _partition_models.get(table_name)
+    if model is None:
+        meta = type('Meta', (), {
+            'apps': partition_apps,
+            'app_label': 'nalkinscloud_mosquitto',
+            'db_table': table_name,
+            'managed': False,
+            'index_together': (('device_id', 'date_created'),),
+        })
+        model = type(str('Partition_%s' % table_name), (models.Model,), {
+            '__module__': __name__,
+            'Meta': meta,
+            'message_id': models.BigAutoField(primary_key=True),
+            'device_id': models.CharField(max_length=32),
+            'topic': models.CharField(max_length=256),
+            'message': models.CharField(max_length=256),
+            'qos': models.IntegerField(default=1),
+            'date_created': models.DateTimeField(),
+        })
+        _partition_models[table_name] = model
+    return model
+
+
+def create_partition(device_type, period_start):
+    """
+    Create the table of a partition (and its registry record) unless it exists
+
+    :param device_type: string
+    :param period_start: datetime, start of the partition period
+    :return: string, table name
+    """
+    with _lock:
+        partition = MessagePartition.objects.filter(device_type_id=device_type, period_start=period_start).first()
+        if partition is None:
+            table_name = get_partition_table_name(device_type, period_start)
+            if table_name not in connection.introspection.table_names():
+                try:
+                    with connection.schema_editor() as schema_editor:
+                        schema_editor.create_model(get_partition_model(table_name))
+                    logger.info('Created messages partition %s', table_name)
+                except DatabaseError:
+                    # Another process created it first
+                    if table_name not in connection.introspection.table_names():
+                        raise
+            try:
+                with transaction.atomic():
+                    partition = MessagePartition.objects.create(table_name=table_name, device_type_id=device_type,
+                                                                period_start=period_start,
+                                                                period_end=get_period_end(period_start))
+            except IntegrityError:
+                partition = MessagePartition.objects.get(device_type_id=device_type, period_start=period_start)
+        _partitions[(device_type, period_start)] = partition.table_name
+        return partition.table_name
+
+
+def get_or_create_partition(device_type, date):
+    """
+    Return the table name of the partition messages of device_type received at date are stored in,
+    partitions are created ahead by create_upcoming_partitions (run by 'compact_messages'),
+    a missing partition (a new device type, or 'compact_messages' not run in time) is created on first use
+
+    :param device_type: string
+    :param date: aware datetime
+    :return: string
+    """
+    period_start = get_period_start(date)
+    table_name = _partitions.get((device_type, period_start))
+    if table_name is not None:
+        return table_name
+    return create_partition(device_type, period_start)
+
+
+def create_upcoming_partitions(periods=MESSAGES_PRECREATE_PERIODS, now=None):
+    """
+    Create the partitions of the current and the next periods of every device type that stored messages
+    in the current or the previous period, so the ingestor does not run DDL while it flushes messages
+
+    :param periods: int, number of periods after the current one
+    :param now: optional aware datetime
+    :return: list of table names created
+    """
+    period_start = get_period_start(now or timezone.now())
+    previous_period_start = get_period_start(period_start - datetime.timedelta(seconds=1))
+    device_types = MessagePartition.objects.filter(period_start__gte=previous_period_start)\
+        .values_list('device_type', flat=True).distinct()
+    existing_partitions = set(MessagePartition.objects.filter(period_start__gte=period_start)
+                              .values_list('device_type', 'period_start'))
+    created_partitions = []
+    for device_type in device_types:
+        upcoming_period_start = period_start
+        for _ in range(periods + 1):
+            if (device_type, upcoming_period_start) not in existing_partitions:
+                created_partitions.append(create_partition(device_type, upcoming_period_start))
+            upcoming_period_start = get_period_end(upcoming_period_start)
+    return created_partitions
+
+
+def clear_partitions_cache():
+    """
+    Forget known partitions, used once a partition may have been dropped by another process
+    """
+    _partitions.clear()
+
+
+def insert_messages(messages, device_types):
+    """
+    Insert messages into their partitions, a single executemany() of one prepared INSERT statement per partition,
+    avoids building a model instance and compiling SQL per message as bulk_create does
+    (mysqlclient rewrites an executemany INSERT into multi row INSERT statements)
+
+    :param messages: list of objects with device_id, topic, message, qos and date_created attributes
+    :param device_types: dict of device_id -> device type
+    :return: None
+    """
+    partitions = {}
+    for message in messages:
+        table_name = get_or_create_partition(device_types[message.device_id], message.date_created)
+        partitions.setdefault(table_name, []).append(message)
+
+    quote_name = connection.ops.quote_name
+    adapt_datetime = connection.ops.adapt_datetimefield_value
+    with transaction.atomic(), connection.cursor() as cursor:
+        for table_name, partition_messages in partitions.items():
+            cursor.executemany('INSERT INTO %s (%s, %s, %s, %s, %s) VALUES (%%s, %%s, %%s, %%s, %%s)'
+                               % tuple(quote_name(name) for name in (table_name, 'device_id', 'topic', 'message',
+                                                                     'qos', 'date_created')),
+                               [(message.device_id, message.topic, message.message, message.qos,
+                                 adapt_datetime(message.date_created)) for message in partition_messages])
+
+
+def migrate_legacy_messages(chunk_size=2000):
+    """
+    Move the messages of the 'messages' table (stored before partitioning) into their partitions,
+    chunk by chunk in message_id order, each chunk is inserted and deleted in one transaction
+    (moved messages get a new message_id in their partition)
+
+    :param chunk_size: int
+    :return: int, number of messages moved
+    """
+    moved_count = 0
+    while True:
+        messages = list(Message.objects.order_by('message_id')[:chunk_size])
+        if not messages:
+            return moved_count
+        device_types = dict(Device.objects.filter(device_id__in={message.device_id for message in messages})
+                            .values_list('device_id', 'type_id'))
+        # Partitions are created first, DDL can not run inside the transaction (sqlite, an implicit commit on MySQL)
+        for message in messages:
+            get_or_create_partition(device_types[message.device_id], message.date_created)
+        with transaction.atomic():
+            insert_messages(messages, device_types)
+            Message.objects.filter(message_id__gte=messages[0].message_id,
+                                   message_id__lte=messages[-1].message_id).delete()
+        moved_count += len(messages)
+        logger.info('Moved %d messages of the messages table to partitions', moved_count)
+
+
+def get_partitions(start, end, device_type=None):
+    """
+    Return partitions that may hold messages received between start and end
+
+    :param start: aware datetime
+    :param end: aware datetime
+    :param device_type: optional string
+    :return: QuerySet of MessagePartition, ordered by period
+    """
+    partitions = MessagePartition.objects.filter(period_start__lt=end, period_end__gt=start)
+    if device_type is not None:
+        partitions = partitions.filter(device_type_id=device_type)
+    return partitions.order_by('period_start', 'table_name')
+
+
+def iterate_keyset(queryset, chunk_size):
+    """
+    Iterate a queryset ordered by (date_created, message_id) with keyset pagination,
+    each chunk is a separate query that seeks past the last row of the previous chunk on the index,
+    so memory and query cost stay constant on any database backend (no server side cursor held open)
+
+    :param queryset: QuerySet of a messages table
+    :param chunk_size: int
+    :return: iterator of dicts
+    """
+    queryset = queryset.order_by('date_created', 'message_id')\
+        .values('message_id', 'device_id', 'topic', 'message', 'qos', 'date_created')
+    chunk = list(queryset[:chunk_size])
+    while chunk:
+        yield from chunk
+        if len(chunk) < chunk_size:
+            return
+        last = chunk[-1]
+        chunk = list(queryset.filter(Q(date_created__gt=last['date_created']) |
+                                     Q(date_created=last['date_created'], message_id__gt=last['message_id']))
+                     [:chunk_size])
+
+
+def get_messages(start, end, device_id=None, device_type=None, chunk_size=2000):
+    """
+    Return an iterator over messages received between start (inclusive) and end (exclusive),
+    only partitions of the requested period are queried (and the 'messages' table, of messages stored
+    before partitioning, until moved by 'compact_messages --migrate-legacy'),
+    rows are fetched in chunks of chunk_size
+
+    :param start: aware datetime
+    :param end: aware datetime
+    :param device_id: optional string, uses the (device_id, date_created) index of each partition
+    :param device_type: optional string, limits the partitions queried to this device type
+    :param chunk_size: int
+    :return: iterator of dicts (message_id, device_id, topic, message, qos, date_created)
+    """
+    querysets = [Message.objects.filter(device__type=device_type) if device_type is not None
+                 else Message.objects.all()]
+    querysets += [get_partition_model(partition.table_name).objects.all()
+                  for partition in get_partitions(start, end, device_type)]
+    for queryset in querysets:
+        queryset = queryset.filter(date_created__gte=start, date_created__lt=end)
+        if device_id is not None:
+            queryset = queryset.filter(device_id=device_id)
+        yield from iterate_keyset(queryset, chunk_size)
+
+
+def get_device_messages(device_id, start, end, device_type=None, chunk_size=2000):
+    """
+    Return an iterator over messages of device received between start (inclusive) and end (exclusive)
+
+    :param device_id: string
+    :param start: aware datetime
+    :param end: aware datetime
+    :param device_type: optional string, limits the partitions queried to this device type
+    :param chunk_size: int
+    :return: iterator of dicts (message_id, device_id, topic, message, qos, date_created)
+    """
+    return get_messages(start, end, device_id=device_id, device_type=device_type, chunk_size=chunk_size)
+
+
+def get_retention_days(device_type, policies=None):
+    """
+    :param device_type: string
+    :param policies: optional dict of device type -> retention days, to avoid a query per call
+    :return: int, 0 if messages are kept forever
+    """
+    if policies is None:
+        policies = dict(MessageRetentionPolicy.objects.values_list('device_type', 'retention_days'))
+    return policies.get(device_type, MESSAGES_RETENTION_DAYS)
+
+
+def get_expired_partitions(now=None):
+    """
+    Return partitions whose whole period is older than the retention of their device type
+
+    :param now: optional aware datetime
+    :return: list of MessagePartition
+    """
+    now = now or timezone.now()
+    policies = dict(MessageRetentionPolicy.objects.values_list('device_type', 'retention_days'))
+    expired_partitions = []
+    for partition in MessagePartition.objects.order_by('period_start'):
+        retention_days = get_retention_days(partition.device_type_id, policies)
+        if retention_days and partition.period_end <= now - datetime.timedelta(days=retention_days):
+            expired_partitions.append(partition)
+    return expired_partitions
+
+
+def drop_partition(partition):
+    """
+    Drop a partition table (a single DROP TABLE instead of deleting its rows) and its registry record
+
+    :param partition: MessagePartition
+    :return: None
+    """
+    if partition.table_name in connection.introspection.table_names():
+        with connection.schema_editor() as schema_editor:
+            schema_editor.delete_model(get_partition_model(partition.table_name))
+    partition.delete()
+    _partitions.pop((partition.device_type_id, partition.period_start), None)
+    logger.info('Dropped messages partition %s', partition.table_name)
@@ -0,0 +1,315 @@
+import itertools
+import logging
+import os
+import queue
+import threading
+import time
+from collections import namedtuple, OrderedDict
+
+import paho.mqtt.client as mqtt
+
+from nalkinscloud_django.settings import PROJECT_NAME, HOSTNAME
+
+# Define logger
+logger = logging.getLogger(PROJECT_NAME)
+
+PublishRequest = namedtuple('PublishRequest', ['topic', 'payload', 'job_id', 'submitted_at', 'attempts'],
+                            defaults=(0,))
+# 'is_sent' is False when the message was not handed to a connection, so it is safe to publish it again
+PublishResult = namedtuple('PublishResult', ['topic', 'job_id', 'is_published', 'latency', 'error', 'is_sent'],
+                           defaults=(True,))
+
+
+class MQTTClientPool(object):
+    """
+    Pool of long lived MQTT clients connected to the broker,
+    each client runs its own network thread (paho loop_start) that reconnects automatically,
+    QoS > 0 messages published while a client is disconnected stay queued by paho and are sent once reconnected,
+    publishes are tracked by the pool (client id, mid) until the on_publish callback acknowledges them
+
+    :param str host: broker host
+    :param int port: broker port
+    :param int size: number of clients (connections) in the pool
+    :param str transport: 'tcp' or 'websockets'
+    :param str username: optional broker username
+    :param str password: optional broker password
+    :param int qos: QoS used to publish messages
+    :param str client_id_prefix: prefix of client ids, process id and pool index are appended
+    """
+
+    # Max acknowledgements kept per client while their mid is not tracked (acknowledged before publish() returned,
+    # or late acknowledgements of publishes that timed out), the oldest are discarded
+    max_untracked_acks = 1000
+
+    def __init__(self, host, port, size=2, transport='tcp', username=None, password=None, qos=1,
+                 keepalive=60, client_id_prefix=HOSTNAME, reconnect_min_delay=1, reconnect_max_delay=30):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.transport = transport
+        self.username = username
+        self.password = password
+        self.qos = qos
+        self.keepalive = keepalive
+        self.client_id_prefix = client_id_prefix
+        self.reconnect_min_delay = reconnect_min_delay
+        self.reconnect_max_delay = reconnect_max_delay
+        self._clients = []
+        self._client_ids = {}  # Client -> client id
+        self._round_robin = None
+        self._lock = threading.Lock()
+        self._connected = threading.Condition()
+        # (client id, mid) -> Event set once published, and client id -> OrderedDict of the acknowledged mids
+        # that were not tracked yet, this lock is never held while calling paho, on_publish runs holding paho locks
+        self._pending = {}
+        self._acknowledged = {}
+        self._pending_lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._clients:
+                return
+            for index in range(self.size):
+                client_id = '%s-%d-%d' % (self.client_id_prefix, os.getpid(), index)
+                client = mqtt.Client(client_id=client_id, userdata=client_id, transport=self.transport)
+                if self.username:
+                    client.username_pw_set(self.username, self.password)
+                client.reconnect_delay_set(self.reconnect_min_delay, self.reconnect_max_delay)
+                client.on_connect = self._on_connect
+                client.on_disconnect = self._on_disconnect
+                client.on_publish = self._on_publish
+                client.connect_async(self.host, self.port, keepalive=self.keepalive)
+                client.loop_start()
+                self._clients.append(client)
+                self._client_ids[client] = client_id
+            self._round_robin = itertools.cycle(self._clients)
+
+    def stop(self):
+        with self._lock:
+            for client in self._clients:
+                client.disconnect()
+                client.loop_stop()
+            self._clients = []
+            self._client_ids = {}
+        with self._pending_lock:
+            self._pending.clear()
+            self._acknowledged.clear()
+
+    def _on_connect(self, client, userdata, flags, rc):
+        if rc == mqtt.CONNACK_ACCEPTED:
+            logger.info('MQTT client %s connected to %s:%s', userdata, self.host, self.port)
+        else:
+            logger.error('MQTT client %s connection refused: %s', userdata, mqtt.connack_string(rc))
+        with self._pending_lock:
+            # Acknowledgements of the previous connection are no longer awaited
+            self._acknowledged.pop(userdata, None)
+        with self._connected:
+            self._connected.notify_all()
+
+    def _on_disconnect(self, client, userdata, rc):
+        if rc != mqtt.MQTT_ERR_SUCCESS:
+            logger.warning('MQTT client %s disconnected unexpectedly (%s), reconnecting',
+                           userdata, mqtt.error_string(rc))
+
+    def _on_publish(self, client, userdata, mid):
+        with self._pending_lock:
+            event = self._pending.pop((userdata, mid), None)
+            if event is None:  # publish() did not return the mid yet, or its publish timed out
+                acknowledged = self._acknowledged.setdefault(userdata, OrderedDict())
+                acknowledged[mid] = True
+                if len(acknowledged) > self.max_untracked_acks:
+                    acknowledged.popitem(last=False)
+                return
+        event.set()
+
+    def _track_publish(self, client_id, mid):
+        """
+        :return: threading.Event set once the broker acknowledged the message (written to the socket for QoS 0)
+        """
+        event = threading.Event()
+        with self._pending_lock:
+            if self._acknowledged.get(client_id, {}).pop(mid, None):
+                event.set()
+            else:
+                self._pending[(client_id, mid)] = event
+        return event
+
+    def _untrack_publish(self, client_id, mid, event):
+        """
+        Stop waiting for the acknowledgement of a publish that timed out
+        """
+        with self._pending_lock:
+            if self._pending.get((client_id, mid)) is event:  # Not replaced by a publish that reused the mid
+                del self._pending[(client_id, mid)]
+
+    def get_client(self, timeout):
+        """
+        Return next connected client of the pool (round robin), wait up to timeout for one to (re)connect
+
+        :param timeout: float seconds
+        :return: paho.mqtt.client.Client, or None if no client is connected
+        """
+        self.start()
+        deadline = time.monotonic() + timeout
+        with self._connected:
+            while True:
+                for _ in range(self.size):
+                    client = next(self._round_robin)
+                    if client.is_connected():
+                        return client
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                # Connection callbacks notify, the timeout also covers a missed notification
+                self._connected.wait(min(remaining, 0.1))
+
+    def publish_batch(self, requests, timeout=10):
+        """
+        Publish all requests over a single pooled connection, wait until the broker acknowledged them,
+        a message that timed out may still be delivered later (paho keeps QoS > 0 messages queued)
+
+        :param requests: list of PublishRequest
+        :param timeout: float seconds, for the whole batch
+        :return: list of PublishResult, in the order of requests
+        """
+        deadline = time.monotonic() + timeout
+        client = self.get_client(timeout)
+        if client is None:
+            return [PublishResult(request.topic, request.job_id, False, None, 'Not connected to broker', False)
+                    for request in requests]
+
+        client_id = self._client_ids[client]
+        pending = []
+        for request in requests:
+            message_info = client.publish(request.topic, request.payload, qos=self.qos)
+            # The connection may drop after get_client, QoS > 0 messages are then queued (MQTT_ERR_NO_CONN)
+            if message_info.rc == mqtt.MQTT_ERR_SUCCESS or (message_info.rc == mqtt.MQTT_ERR_NO_CONN and self.qos):
+                pending.append((request, message_info.mid, self._track_publish(client_id, message_info.mid), None))
+            else:
+                pending.append((request, message_info.mid, None, mqtt.error_string(message_info.rc)))
+        results = []
+        for request, mid, event, error in pending:
+            if event is None:
+                results.append(PublishResult(request.topic, request.job_id, False, None, error, False))
+            elif event.wait(max(deadline - time.monotonic(), 0)):
+                latency = time.monotonic() - request.submitted_at
+                results.append(PublishResult(request.topic, request.job_id, True, latency, None))
+            else:
+                self._untrack_publish(client_id, mid, event)
+                results.append(PublishResult(request.topic, request.job_id, False, None, 'Publish timed out'))
+        return results
+
+
+class BatchPublisher(object):
+    """
+    Collect publish requests submitted from many threads (for example scheduled jobs that fire at the same second)
+    and publish them in batches, from a single background thread, over the pool connections
+
+    Messages that were not handed to a connection (no connected client within the timeout, publish refused)
+    are published again with a later batch, up to max_attempts, messages that were handed to a connection but
+    not acknowledged within the timeout are not (paho may still deliver them), they are reported as failed,
+    so a scheduled job message is delivered at most once by this publisher (at least once by paho once queued)
+
+    :param MQTTClientPool pool:
+    :param float batch_window: seconds to wait for more requests once the first request of a batch arrived
+    :param int max_batch_size: max number of requests per batch
+    :param float timeout: seconds to wait for the broker to acknowledge a batch
+    :param int max_attempts: publish attempts of a message not handed to a connection
+    """
+
+    def __init__(self, pool, batch_window=0.2, max_batch_size=1000, timeout=10, max_attempts=3):
+        self.pool = pool
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.published_count = 0
+        self.failed_count = 0
+        self.retried_count = 0
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self.pool.start()
+                self._thread = threading.Thread(target=self._run, name='mqtt-batch-publisher', daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            if self._thread is not None:
+                self._queue.put(None)
+                self._thread.join()
+                self._thread = None
+        self.pool.stop()
+
+    def submit(self, topic, payload, job_id=None):
+        """
+        Queue a message for publishing, returns immediately
+
+        :param topic: string
+        :param payload: string
+        :param job_id: optional string, id of the scheduled job that published the message, used on reporting
+        :return: None
+        """
+        self.start()
+        self._queue.put(PublishRequest(topic, payload, job_id, time.monotonic()))
+
+    def _collect_batch(self):
+        request = self._queue.get()
+        if request is None:
+            return None
+        batch = [request]
+        deadline = time.monotonic() + self.batch_window
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                request = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if request is None:
+                self._queue.put(None)  # Stop once current batch is published
+                break
+            batch.append(request)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            if batch is None:
+                return
+            try:
+                results = self.pool.publish_batch(batch, timeout=self.timeout)
+            except Exception as e:
+                logger.exception('Failed publishing batch of %d messages', len(batch))
+                results = [PublishResult(request.topic, request.job_id, False, None, str(e)) for request in batch]
+            self.report(self.retry(batch, results))
+
+    def retry(self, batch, results):
+        """
+        Queue again the requests not handed to a connection, that have attempts left
+
+        :return: list of PublishResult of the requests not queued again
+        """
+        final_results = []
+        for request, result in zip(batch, results):
+            if not result.is_published and not result.is_sent and request.attempts + 1 < self.max_attempts:
+                self.retried_count += 1
+                logger.warning('Job %s failed publishing to %s: %s, retrying', result.job_id, result.topic,
+                               result.error)
+                self._queue.put(request._replace(attempts=request.attempts + 1))
+            else:
+                final_results.append(result)
+        return final_results
+
+    def report(self, results):
+        for result in results:
+            if result.is_published:
+                self.published_count += 1
+                logger.info('Job %s published to %s, latency: %.1f ms',
+                            result.job_id, result.topic, result.latency * 1000)
+            else:
+                self.failed_count += 1
+                logger.error('Job %s failed publishing to %s: %s', result.job_id, result.topic, result.error)
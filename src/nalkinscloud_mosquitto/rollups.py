@@ -0,0 +1,207 @@
+import datetime
+import logging
+
+from django.db import IntegrityError, transaction
+
+from nalkinscloud_mosquitto.models import MessageRollup
+from nalkinscloud_mosquitto.partitions import get_messages
+from nalkinscloud_django.settings import PROJECT_NAME, MESSAGE_ROLLUP_DEVICE_TYPES
+
+# Define logger
+logger = logging.getLogger(PROJECT_NAME)
+
+# Resolution -> bucket size in seconds
+ROLLUP_RESOLUTIONS = {
+    '1m': 60,
+    '1h': 3600,
+    '1d': 86400,
+}
+
+# Non numeric payloads that devices (switch, magnet) publish as states
+STATE_VALUES = {
+    'on': 1.0, 'off': 0.0,
+    'true': 1.0, 'false': 0.0,
+    'open': 1.0, 'closed': 0.0,
+}
+
+
+def parse_value(payload):
+    """
+    Return the numeric value of a message payload, None if the payload is not numeric
+
+    :param payload: string
+    :return: float or None
+    """
+    payload = payload.strip()
+    try:
+        value = float(payload)
+    except ValueError:
+        return STATE_VALUES.get(payload.lower())
+    if value != value or value in (float('inf'), float('-inf')):  # NaN or infinity
+        return None
+    return value
+
+
+def get_bucket_start(date, resolution):
+    """
+    Return the start of the bucket of resolution that contains date
+
+    :param date: aware datetime
+    :param resolution: one of ROLLUP_RESOLUTIONS
+    :return: aware datetime (UTC)
+    """
+    seconds = ROLLUP_RESOLUTIONS[resolution]
+    timestamp = int(date.timestamp())
+    return datetime.datetime.fromtimestamp(timestamp - timestamp % seconds, tz=datetime.timezone.utc)
+
+
+def aggregate_messages(messages, aggregates=None):
+    """
+    Aggregate numeric messages in memory, per device, topic, resolution and bucket
+
+    :param messages: iterable of objects or dicts with device_id, topic, message and date_created
+    :param aggregates: optional dict to aggregate into
+    :return: dict of (device_id, topic, resolution, bucket_start) -> [count, sum, min, max]
+    """
+    aggregates = {} if aggregates is None else aggregates
+    for message in messages:
+        if isinstance(message, dict):
+            device_id, topic, payload, date = \
+                message['device_id'], message['topic'], message['message'], message['date_created']
+        else:
+            device_id, topic, payload, date = message.device_id, message.topic, message.message, message.date_created
+        value = parse_value(payload)
+        if value is None:
+            continue
+        for resolution in ROLLUP_RESOLUTIONS:
+            key = (device_id, topic, resolution, get_bucket_start(date, resolution))
+            aggregate = aggregates.get(key)
+            if aggregate is None:
+                aggregates[key] = [1, value, value, value]
+            else:
+                aggregate[0] += 1
+                aggregate[1] += value
+                aggregate[2] = min(aggregate[2], value)
+                aggregate[3] = max(aggregate[3], value)
+    return aggregates
+
+
+def apply_rollups(aggregates):
+    """
+    Merge in memory aggregates into the stored rollups, with one SELECT, one bulk UPDATE and one bulk INSERT
+
+    :param aggregates: dict as returned by aggregate_messages
+    :return: None
+    """
+    if not aggregates:
+        return
+    for attempt in range(2):
+        try:
+            with transaction.atomic():
+                _apply_rollups(aggregates)
+            return
+        except IntegrityError:
+            # A concurrent ingestor created some of the rollups first, merge into them
+            if attempt:
+                raise
+
+
+def _apply_rollups(aggregates):
+    # Select a superset of the rollups (any combination of the devices, topics and buckets), keep exact keys only
+    candidates = MessageRollup.objects.select_for_update().filter(
+        device_id__in={key[0] for key in aggregates},
+        topic__in={key[1] for key in aggregates},
+        bucket_start__in={key[3] for key in aggregates})
+    existing_rollups = {}
+    for rollup in candidates:
+        key = (rollup.device_id, rollup.topic, rollup.resolution, rollup.bucket_start)
+        if key in aggregates:
+            existing_rollups[key] = rollup
+
+    new_rollups = []
+    for key, (count, total, minimum, maximum) in aggregates.items():
+        rollup = existing_rollups.get(key)
+        if rollup is None:
+            device_id, topic, resolution, bucket_start = key
+            new_rollups.append(MessageRollup(device_id=device_id, topic=topic, resolution=resolution,
+                                             bucket_start=bucket_start, count=count, sum=total,
+                                             min=minimum, max=maximum))
+        else:
+            rollup.count += count
+            rollup.sum += total
+            rollup.min = min(rollup.min, minimum)
+            rollup.max = max(rollup.max, maximum)
+
+    if existing_rollups:
+        MessageRollup.objects.bulk_update(existing_rollups.values(), ['count', 'sum', 'min', 'max'])
+    if new_rollups:
+        MessageRollup.objects.bulk_create(new_rollups)
+
+
+def update_rollups(messages):
+    """
+    Add messages to their rollups, called for each batch of ingested messages
+
+    :param messages: iterable of objects or dicts with device_id, topic, message and date_created
+    :return: None
+    """
+    apply_rollups(aggregate_messages(messages))
+
+
+def rebuild_rollups(start, end, device_id=None, chunk_size=10000):
+    """
+    Recompute rollups of buckets between start and end (aligned to whole days) from the raw messages partitions
+    of MESSAGE_ROLLUP_DEVICE_TYPES (as ingestion does), a day at a time, each in its own transaction
+
+    :param start: aware datetime
+    :param end: aware datetime
+    :param device_id: optional string, rebuild rollups of a single device
+    :param chunk_size: number of messages aggregated in memory before they are written
+    :return: int number of messages aggregated
+    """
+    start = get_bucket_start(start, '1d')
+    end = get_bucket_start(end - datetime.timedelta(microseconds=1), '1d') + datetime.timedelta(days=1)
+
+    count = 0
+    window_start = start
+    while window_start < end:
+        window_end = window_start + datetime.timedelta(days=1)
+        # Rollups of a day are deleted and written again in one transaction, readers never see them missing
+        with transaction.atomic():
+            rollups = MessageRollup.objects.filter(bucket_start__gte=window_start, bucket_start__lt=window_end)
+            if device_id is not None:
+                rollups = rollups.filter(device_id=device_id)
+            rollups.delete()
+
+            chunk = []
+            # Only device types rolled up while ingesting (see signals.py), other partitions are not read
+            for device_type in MESSAGE_ROLLUP_DEVICE_TYPES:
+                for message in get_messages(window_start, window_end, device_id=device_id, device_type=device_type):
+                    chunk.append(message)
+                    if len(chunk) == chunk_size:
+                        update_rollups(chunk)
+                        count += len(chunk)
+                        chunk = []
+            update_rollups(chunk)
+            count += len(chunk)
+        window_start = window_end
+    logger.info('Rebuilt rollups between %s and %s from %d messages', start, end, count)
+    return count
+
+
+def get_rollup_series(device_id, topic, resolution, start, end):
+    """
+    Return the rollups of a device topic between start (inclusive) and end (exclusive), ordered by time
+
+    :param device_id: string
+    :param topic: string
+    :param resolution: one of ROLLUP_RESOLUTIONS
+    :param start: aware datetime
+    :param end: aware datetime
+    :return: list of dicts (bucket_start, count, min, max, avg)
+    """
+    return [{'bucket_start': bucket_start, 'count': count, 'min': minimum, 'max': maximum, 'avg': total / count}
+            for bucket_start, count, total, minimum, maximum in
+            MessageRollup.objects.filter(device_id=device_id, topic=topic, resolution=resolution,
+                                         bucket_start__gte=start, bucket_start__lt=end)
+            .order_by('bucket_start').values_list('bucket_start', 'count', 'sum', 'min', 'max')]
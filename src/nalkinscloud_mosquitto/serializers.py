@@ -0,0 +1,20 @@
+
+# REST API
+from rest_framework import serializers
+
+
+class MQTTUserSerializer(serializers.Serializer):
+    username = serializers.CharField(required=True, max_length=32)
+    password = serializers.CharField(required=True, max_length=256)
+    clientid = serializers.CharField(required=False, allow_blank=True, max_length=256)
+
+
+class MQTTSuperuserSerializer(serializers.Serializer):
+    username = serializers.CharField(required=True, max_length=32)
+
+
+class MQTTAclSerializer(serializers.Serializer):
+    username = serializers.CharField(required=True, max_length=32)
+    topic = serializers.CharField(required=True, max_length=256)
+    acc = serializers.IntegerField(required=True, min_value=1, max_value=4)
+    clientid = serializers.CharField(required=False, allow_blank=True, max_length=256)
@@ -0,0 +1,90 @@
+from django.db.models.signals import post_init, post_save, post_delete
+from django.dispatch import receiver, Signal
+
+from nalkinscloud_mosquitto.acl import acl_engine
+from nalkinscloud_mosquitto.functions import device_credentials_cache, known_devices_cache, \
+    invalidate_customers_device_list
+from nalkinscloud_mosquitto.last_values import last_value_store
+from nalkinscloud_mosquitto.models import Device, AccessList, CustomerDevice, Message
+from nalkinscloud_mosquitto.rollups import update_rollups
+from nalkinscloud_django.settings import MESSAGE_ROLLUP_DEVICE_TYPES
+
+# Sent by the messages ingestor after each written batch (bulk inserts do not send post_save),
+# with 'messages' as a list of ingestion.IngestedMessage and 'devices_types' as a dict of device_id -> device type
+messages_ingested = Signal()
+
+
+@receiver(post_save, sender=Device, dispatch_uid='invalidate_device_credentials_on_save')
+@receiver(post_delete, sender=Device, dispatch_uid='invalidate_device_credentials_on_delete')
+def invalidate_device_credentials(sender, instance, **kwargs):
+    """
+    Drop cached credentials of a device once it changes (password updated, device disabled or removed)
+    """
+    device_credentials_cache.invalidate(instance.device_id)
+
+
+@receiver(post_save, sender=Device, dispatch_uid='invalidate_known_device_on_save')
+@receiver(post_delete, sender=Device, dispatch_uid='invalidate_known_device_on_delete')
+def invalidate_known_device(sender, instance, **kwargs):
+    """
+    Drop the cached type of a device once it changes, so messages of a just registered device are not rejected
+    """
+    known_devices_cache.invalidate(instance.device_id)
+
+
+@receiver(post_init, sender=AccessList, dispatch_uid='remember_access_list_topic')
+def remember_access_list_topic(sender, instance, **kwargs):
+    # Keep the loaded topic, so an update that changes the topic can remove the old filter from the trie
+    instance._loaded_topic = instance.topic
+
+
+@receiver(post_save, sender=AccessList, dispatch_uid='update_acl_engine_on_save')
+def update_acl_engine_on_save(sender, instance, created, **kwargs):
+    if not created and instance._loaded_topic and instance._loaded_topic != instance.topic:
+        acl_engine.remove_rule(instance.device_id, instance._loaded_topic)
+    acl_engine.update_rule(instance.device_id, instance.topic, instance.rw, instance.is_enabled)
+    instance._loaded_topic = instance.topic
+
+
+@receiver(post_delete, sender=AccessList, dispatch_uid='update_acl_engine_on_delete')
+def update_acl_engine_on_delete(sender, instance, **kwargs):
+    acl_engine.remove_rule(instance.device_id, instance.topic)
+
+
+@receiver(post_save, sender=CustomerDevice, dispatch_uid='invalidate_device_list_on_customer_device_save')
+@receiver(post_delete, sender=CustomerDevice, dispatch_uid='invalidate_device_list_on_customer_device_delete')
+def invalidate_device_list_on_customer_device_change(sender, instance, **kwargs):
+    invalidate_customers_device_list([instance.user_id_id])
+
+
+@receiver(post_init, sender=Device, dispatch_uid='remember_device_type')
+def remember_device_type(sender, instance, **kwargs):
+    # Keep the loaded type (not loaded when deferred), the only Device field of the cached device lists
+    instance._loaded_type_id = instance.__dict__.get('type_id')
+
+
+@receiver(post_save, sender=Device, dispatch_uid='invalidate_device_list_on_device_save')
+def invalidate_device_list_on_device_change(sender, instance, created, **kwargs):
+    # A deleted device cascades to its CustomerDevice records, that invalidate the lists on their own,
+    # owners are only looked up when the type changed, not on every save (password, last login)
+    type_id = instance.__dict__.get('type_id')
+    if not created and type_id != instance._loaded_type_id:
+        invalidate_customers_device_list(CustomerDevice.objects.filter(device_id=instance)
+                                         .values_list('user_id', flat=True))
+    instance._loaded_type_id = type_id
+
+
+@receiver(messages_ingested, sender=Message, dispatch_uid='update_rollups_on_messages_ingested')
+def update_rollups_on_messages_ingested(sender, messages, devices_types, **kwargs):
+    update_rollups(message for message in messages
+                   if devices_types.get(message.device_id) in MESSAGE_ROLLUP_DEVICE_TYPES)
+
+
+@receiver(messages_ingested, sender=Message, dispatch_uid='update_last_values_on_messages_ingested')
+def update_last_values_on_messages_ingested(sender, messages, **kwargs):
+    last_value_store.update(messages)
+
+
+@receiver(post_delete, sender=Device, dispatch_uid='delete_last_values_on_device_delete')
+def delete_last_values_on_device_delete(sender, instance, **kwargs):
+    last_value_store.delete(instance.device_id)
@@ -0,0 +1,39 @@
+from django.utils.dateparse import parse_datetime
+
+from nalkinscloud_mosquitto import functions, rollups
+from scheduler.celery import app
+
+
+@app.task(acks_late=True)
+def create_devices(device_ids, device_model, device_type, is_enabled=True):
+    """
+    Create many devices, hashing their passwords takes ~100ms per device so this runs on the 'slow' queue,
+    passwords are generated by the worker, so they never pass through the broker or the result backend
+
+    :param device_ids: list of strings
+    :param device_model: string
+    :param device_type: string
+    :param is_enabled: boolean
+    :return: list of created device ids
+    """
+    return functions.create_devices(device_ids, device_model, device_type, is_enabled)
+
+
+@app.task(acks_late=True)
+def rebuild_access_lists(user_id):
+    """
+    :param user_id: int
+    :return: int number of access list records created
+    """
+    return functions.rebuild_access_lists(user_id)
+
+
+@app.task(acks_late=True)
+def rebuild_rollups(start, end, device_id=None):
+    """
+    :param start: ISO 8601 string
+    :param end: ISO 8601 string
+    :param device_id: optional string
+    :return: int number of messages aggregated
+    """
+    return rollups.rebuild_rollups(parse_datetime(start), parse_datetime(end), device_id=device_id)
@@ -0,0 +1,273 @@
+# In process MQTT broker stand-in, used by tests and benchmarks instead of a real mosquitto broker,
+# Implements the subset of MQTT 3.1.1 used by this project (TCP transport, no retained messages, no wills,
+# messages are forwarded to subscribers with QoS 0)
+import socket
+import struct
+import threading
+import time
+
+from nalkinscloud_mosquitto.functions import topic_matches_pattern
+
+CONNECT, CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP, SUBSCRIBE, SUBACK, \
+    UNSUBSCRIBE, UNSUBACK, PINGREQ, PINGRESP, DISCONNECT = range(1, 15)
+
+
+def encode_remaining_length(length):
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        if length:
+            byte |= 0x80
+        encoded.append(byte)
+        if not length:
+            return bytes(encoded)
+
+
+def encode_string(value):
+    if isinstance(value, str):
+        value = value.encode('utf-8')
+    return struct.pack('!H', len(value)) + value
+
+
+def build_packet(packet_type, flags, body):
+    return bytes([(packet_type << 4) | flags]) + encode_remaining_length(len(body)) + body
+
+
+class LocalMQTTClientConnection(object):
+
+    def __init__(self, broker, sock):
+        self.broker = broker
+        self.sock = sock
+        self.send_lock = threading.Lock()
+        self.subscriptions = set()
+        self.client_id = None
+        self.username = None
+
+    def send(self, data):
+        with self.send_lock:
+            self.sock.sendall(data)
+
+    def read_exactly(self, size):
+        data = bytearray()
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError('Connection closed')
+            data.extend(chunk)
+        return bytes(data)
+
+    def read_packet(self):
+        header = self.read_exactly(1)[0]
+        multiplier, length = 1, 0
+        while True:
+            byte = self.read_exactly(1)[0]
+            length += (byte & 0x7f) * multiplier
+            if not byte & 0x80:
+                break
+            multiplier *= 128
+        return header >> 4, header & 0x0f, self.read_exactly(length) if length else b''
+
+    def serve(self):
+        try:
+            while True:
+                packet_type, flags, body = self.read_packet()
+                if packet_type == DISCONNECT:
+                    break
+                self.handle_packet(packet_type, flags, body)
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.broker.remove_connection(self)
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+
+    def handle_packet(self, packet_type, flags, body):
+        if packet_type == CONNECT:
+            self.handle_connect(body)
+        elif packet_type == PUBLISH:
+            self.handle_publish(flags, body)
+        elif packet_type == PUBREL:
+            self.send(build_packet(PUBCOMP, 0, body[:2]))
+        elif packet_type == SUBSCRIBE:
+            self.handle_subscribe(body)
+        elif packet_type == UNSUBSCRIBE:
+            packet_id, position = body[:2], 2
+            while position < len(body):
+                length = struct.unpack('!H', body[position:position + 2])[0]
+                self.subscriptions.discard(body[position + 2:position + 2 + length].decode('utf-8'))
+                position += 2 + length
+            self.send(build_packet(UNSUBACK, 0, packet_id))
+        elif packet_type == PINGREQ:
+            self.send(build_packet(PINGRESP, 0, b''))
+
+    def handle_connect(self, body):
+        position = 2 + struct.unpack('!H', body[:2])[0]  # Skip protocol name
+        connect_flags = body[position + 1]
+        position += 4  # Protocol level, connect flags and keep alive
+        values = []
+        while position < len(body):
+            length = struct.unpack('!H', body[position:position + 2])[0]
+            values.append(body[position + 2:position + 2 + length])
+            position += 2 + length
+        self.client_id = values.pop(0).decode('utf-8')
+        if connect_flags & 0x04:  # Will flag, drop will topic and message
+            values = values[2:]
+        if connect_flags & 0x80:
+            self.username = values.pop(0).decode('utf-8')
+        self.send(build_packet(CONNACK, 0, b'\x00\x00'))
+
+    def handle_publish(self, flags, body):
+        qos = (flags >> 1) & 0x03
+        topic_length = struct.unpack('!H', body[:2])[0]
+        topic = body[2:2 + topic_length].decode('utf-8')
+        position = 2 + topic_length
+        packet_id = None
+        if qos:
+            packet_id = body[position:position + 2]
+            position += 2
+        self.broker.on_publish(self, topic, body[position:], qos)
+        if qos == 1:
+            self.send(build_packet(PUBACK, 0, packet_id))
+        elif qos == 2:
+            self.send(build_packet(PUBREC, 0, packet_id))
+
+    def handle_subscribe(self, body):
+        packet_id, position = body[:2], 2
+        granted = bytearray()
+        while position < len(body):
+            length = struct.unpack('!H', body[position:position + 2])[0]
+            self.subscriptions.add(body[position + 2:position + 2 + length].decode('utf-8'))
+            position += 3 + length  # Topic filter and requested QoS
+            granted.append(0)
+        self.send(build_packet(SUBACK, 0, packet_id + bytes(granted)))
+
+
+class LocalMQTTBroker(object):
+    """
+    Usage:
+        broker = LocalMQTTBroker()
+        broker.start()  # Listens on 127.0.0.1:broker.port
+        ...
+        broker.wait_for_messages(count=1)
+        broker.stop()
+    """
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.host = host
+        self.port = port
+        self.messages = []  # List of (topic, payload, qos) tuples, in the order received
+        self._connections = set()
+        self._lock = threading.Condition()
+        self._server_socket = None
+        self._thread = None
+
+    def start(self):
+        self._server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server_socket.bind((self.host, self.port))
+        self._server_socket.listen(128)
+        self.port = self._server_socket.getsockname()[1]
+        self._thread = threading.Thread(target=self._accept_connections, name='local-mqtt-broker', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        # Closing alone does not wake up a blocked accept(), which could still accept a connection afterwards
+        try:
+            self._server_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._server_socket.close()
+        self.disconnect_clients()
+
+    def _accept_connections(self):
+        while True:
+            try:
+                sock, address = self._server_socket.accept()
+            except OSError:  # Server socket closed
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connection = LocalMQTTClientConnection(self, sock)
+            with self._lock:
+                self._connections.add(connection)
+            threading.Thread(target=connection.serve, name='local-mqtt-connection', daemon=True).start()
+
+    def remove_connection(self, connection):
+        with self._lock:
+            self._connections.discard(connection)
+
+    def disconnect_clients(self):
+        """
+        Drop all client connections (simulates a broker restart / network failure)
+        """
+        with self._lock:
+            connections = list(self._connections)
+        for connection in connections:
+            try:
+                connection.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    @property
+    def connections_count(self):
+        with self._lock:
+            return len(self._connections)
+
+    def on_publish(self, sender, topic, payload, qos):
+        with self._lock:
+            self.messages.append((topic, payload, qos))
+            self._lock.notify_all()
+            subscribers = [connection for connection in self._connections
+                           if any(topic_matches_pattern(pattern, topic) for pattern in connection.subscriptions)]
+        packet = build_packet(PUBLISH, 0, encode_string(topic) + payload)
+        for connection in subscribers:
+            try:
+                connection.send(packet)
+            except OSError:
+                pass
+
+    def publish(self, topic, payload, qos=0):
+        """
+        Publish a message from the broker itself to all matching subscribers
+        """
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        self.on_publish(None, topic, payload, qos)
+
+    def wait_for_messages(self, count, timeout=5):
+        """
+        Block until at least 'count' messages received, return True if received before timeout
+        """
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            while len(self.messages) < count:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._lock.wait(remaining)
+            return True
+
+    def wait_for_connections(self, count, timeout=5):
+        deadline = time.monotonic() + timeout
+        while self.connections_count < count:
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def wait_for_subscriptions(self, count, timeout=5):
+        """
+        Block until at least 'count' connections subscribed to any topic, return True if subscribed before timeout
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                subscribed = sum(1 for connection in self._connections if connection.subscriptions)
+            if subscribed >= count:
+                return True
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(0.01)
@@ -1,9 +1,37 @@
-from django.test import TestCase
+from django.core.cache import cache
+from django.db import connection
+from django.core.management import call_command
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework.test import APITestCase
+from prometheus_client import REGISTRY
+import paho.mqtt.client as mqtt
+from nalkinscloud_mosquitto.acl import AclEngine, TopicTrie
 from nalkinscloud_mosquitto.functions import *
+from nalkinscloud_mosquitto.last_values import LastValueStore, MemoryHashClient, last_value_store
+from nalkinscloud_mosquitto.ingestion import MessageIngestor, MQTTMessageSubscriber, IngestedMessage
+from nalkinscloud_mosquitto.partitions import clear_partitions_cache, create_upcoming_partitions, drop_partition, \
+    get_device_messages, get_partition_table_name, get_partitions, get_period_end, get_period_start, insert_messages
+from nalkinscloud_mosquitto.rollups import aggregate_messages, get_bucket_start, get_rollup_series, parse_value, \
+    rebuild_rollups, update_rollups
+from nalkinscloud_mosquitto.publisher import MQTTClientPool, BatchPublisher, PublishRequest
+from nalkinscloud_mosquitto.signals import messages_ingested
+from nalkinscloud_mosquitto.testing import LocalMQTTBroker
+from nalkinscloud_django.settings import PROJECT_NAME
+import datetime
+import io
+import logging
+import time
 
 
 class TestBrokerFunctions(TestCase):
     def setUp(self):
+        device_credentials_cache.clear()
+        acl_engine.clear()
+        cache.clear()
+
         self.username = 'some_username'
         self.email = 'test@nalkins.cloud'
         self.password = 'nalkinscloud'
@@ -50,6 +78,25 @@ class TestBrokerFunctions(TestCase):
         # Add current user, current device
         CustomerDevice.objects.create(user_id=self.user, device_id=self.device)
 
+    def test_is_device_owned_by_user_shared_device(self):
+        for index in range(20):
+            CustomerDevice.objects.create(user_id=User.objects.create_user(email='owner_%d@nalkins.cloud' % index,
+                                                                           password=self.password),
+                                          device_id=self.device)
+        with self.assertNumQueries(1):
+            self.assertTrue(is_device_owned_by_user(self.device_id, self.user.pk))
+        not_owner = User.objects.create_user(email='not_owner@nalkins.cloud', password=self.password)
+        with self.assertNumQueries(1):
+            self.assertFalse(is_device_owned_by_user(self.device, not_owner))
+
+    def test_get_owned_device_ids(self):
+        other_device = Device.objects.create_device(device_id='other_device_id', password=self.device_password,
+                                                    model=DeviceModel.objects.get(model=self.device_model),
+                                                    type=DeviceType.objects.get(type=self.device_type))
+        with self.assertNumQueries(1):
+            self.assertEqual(get_owned_device_ids(self.user, [self.device_id, other_device.device_id, 'missing']),
+                             {self.device_id})
+
     def test_device_has_any_owner(self):
         self.assertTrue(device_has_any_owner(device=self.device))
 
@@ -107,6 +154,30 @@ class TestBrokerFunctions(TestCase):
             self.assertIn(customer_device.device_name, [self.device_name, customer_device.device_name],
                           "Should be equal to both device names of the user")
 
+    def test_get_customers_device_list(self):
+        expected_device = {'device_id': self.device_id, 'device_name': self.device_name,
+                           'device_type': self.device_type, 'role': CustomerDevice.ROLE_OWNER}
+        self.assertEqual(get_customers_device_list(self.user), [expected_device])
+        with self.assertNumQueries(0):
+            self.assertEqual(get_customers_device_list(self.user.pk), [expected_device], "Should be cached")
+
+        # Changing a CustomerDevice should invalidate the cached list
+        self.customer_device.device_name = 'new_device_name'
+        self.customer_device.save()
+        self.assertEqual(get_customers_device_list(self.user)[0]['device_name'], 'new_device_name')
+
+        # Saving a Device only looks its owners up when its type changed
+        with self.assertNumQueries(1):
+            self.device.save()
+
+        # Changing a Device type should invalidate the cached list of its owners
+        self.device.type = DeviceType.objects.get(type='dht')
+        self.device.save()
+        self.assertEqual(get_customers_device_list(self.user)[0]['device_type'], 'dht')
+
+        self.device.delete()
+        self.assertEqual(get_customers_device_list(self.user), [])
+
     def test_insert_new_client_to_devices(self):
         # Current devices of type 'user' should be 1
         self.assertEqual(Device.objects.filter(type=DeviceType.objects.get(type='user')).count(), 1,
@@ -123,3 +194,712 @@ class TestBrokerFunctions(TestCase):
 
     def test_get_device_name_by_id(self):
         self.assertEqual(get_device_name_by_id(self.device), self.device_name)
+
+    def test_authenticate_device(self):
+        self.assertFalse(authenticate_device(self.device_id, self.device_password),
+                         "Should return False since device is not enabled")
+        self.device.is_enabled = True
+        self.device.save()
+        self.assertTrue(authenticate_device(self.device_id, self.device_password))
+        self.assertFalse(authenticate_device(self.device_id, 'wrong_password'))
+        self.assertFalse(authenticate_device('non_existing_device_id', self.device_password))
+
+    def test_authenticate_device_cache_metrics(self):
+        def get_count(cache_name, result):
+            return REGISTRY.get_sample_value('mqtt_auth_cache_requests_total',
+                                             {'cache': cache_name, 'result': result}) or 0
+
+        self.device.is_enabled = True
+        self.device.save()
+        hits, misses = get_count('credentials', 'hit'), get_count('credentials', 'miss')
+        authenticate_device(self.device_id, self.device_password)
+        authenticate_device(self.device_id, self.device_password)
+        self.assertEqual(get_count('credentials', 'hit'), hits + 1)
+        self.assertEqual(get_count('credentials', 'miss'), misses + 1)
+
+        hits, misses = get_count('acl', 'hit'), get_count('acl', 'miss')
+        acl_engine.is_allowed(self.device_id, 'some/topic', MQTT_ACCESS_READ)
+        acl_engine.is_allowed(self.device_id, 'some/topic', MQTT_ACCESS_READ)
+        self.assertEqual(get_count('acl', 'hit'), hits + 1)
+        self.assertEqual(get_count('acl', 'miss'), misses + 1)
+
+    def test_authenticate_device_cache(self):
+        self.device.is_enabled = True
+        self.device.save()
+        self.assertTrue(authenticate_device(self.device_id, self.device_password))
+        with self.assertNumQueries(1):
+            self.assertTrue(authenticate_device(self.device_id, self.device_password),
+                            "Should be served from cache, after reading the stored password hash")
+
+        # Changing the password must invalidate the cached credentials
+        update_device_pass(self.device_id, 'new_password')
+        self.assertFalse(authenticate_device(self.device_id, self.device_password))
+        self.assertTrue(authenticate_device(self.device_id, 'new_password'))
+
+        # Also when changed by another process (no signal reaches this process cache)
+        Device.objects.filter(device_id=self.device_id).update(password=make_password('other_password'))
+        self.assertFalse(authenticate_device(self.device_id, 'new_password'))
+        self.assertTrue(authenticate_device(self.device_id, 'other_password'))
+        Device.objects.filter(device_id=self.device_id).update(is_enabled=False)
+        self.assertFalse(authenticate_device(self.device_id, 'other_password'))
+        Device.objects.filter(device_id=self.device_id).update(is_enabled=True)
+
+        # Disabling the device must invalidate the cached credentials
+        self.device.refresh_from_db()
+        self.device.is_enabled = False
+        self.device.save()
+        self.assertFalse(authenticate_device(self.device_id, 'new_password'))
+
+    def test_topic_matches_pattern(self):
+        self.assertTrue(topic_matches_pattern('some/#', 'some/important/topic'))
+        self.assertTrue(topic_matches_pattern('some/#', 'some'))
+        self.assertTrue(topic_matches_pattern('some/+/topic', 'some/important/topic'))
+        self.assertTrue(topic_matches_pattern('some/important/topic', 'some/important/topic'))
+        self.assertFalse(topic_matches_pattern('some/+', 'some/important/topic'))
+        self.assertFalse(topic_matches_pattern('other/#', 'some/important/topic'))
+        self.assertFalse(topic_matches_pattern('some/important/topic/more', 'some/important/topic'))
+
+    def test_is_topic_allowed(self):
+        AccessList.objects.create(device=self.device, topic='some/#', rw=1, is_enabled=True)
+        self.assertTrue(is_topic_allowed(self.device_id, self.topic, MQTT_ACCESS_READ))
+        self.assertTrue(is_topic_allowed(self.device_id, self.topic, MQTT_ACCESS_SUBSCRIBE))
+        self.assertFalse(is_topic_allowed(self.device_id, self.topic, MQTT_ACCESS_WRITE),
+                         "Should return False since access list is read only")
+        self.assertFalse(is_topic_allowed(self.device_id, 'other/topic', MQTT_ACCESS_READ))
+
+        AccessList.objects.create(device=self.device, topic='other/#', rw=2, is_enabled=False)
+        self.assertFalse(is_topic_allowed(self.device_id, 'other/topic', MQTT_ACCESS_READ),
+                         "Should return False since access list is disabled")
+
+    def test_is_topic_allowed_incremental_update(self):
+        acl = AccessList.objects.create(device=self.device, topic='some/#', rw=2, is_enabled=True)
+        self.assertTrue(is_topic_allowed(self.device_id, self.topic, MQTT_ACCESS_WRITE))
+
+        # Compiled trie should be updated by signals, without recompiling it from the DB
+        acl.rw = 1
+        acl.save()
+        with self.assertNumQueries(0):
+            self.assertFalse(is_topic_allowed(self.device_id, self.topic, MQTT_ACCESS_WRITE))
+            self.assertTrue(is_topic_allowed(self.device_id, self.topic, MQTT_ACCESS_READ))
+
+        acl.topic = 'other/#'
+        acl.save()
+        with self.assertNumQueries(0):
+            self.assertFalse(is_topic_allowed(self.device_id, self.topic, MQTT_ACCESS_READ))
+            self.assertTrue(is_topic_allowed(self.device_id, 'other/topic', MQTT_ACCESS_READ))
+
+        remove_from_access_list(device_id=self.device_id, topic='other/#')
+        self.assertFalse(is_topic_allowed(self.device_id, 'other/topic', MQTT_ACCESS_READ))
+
+    def test_acl_engine_change_during_compile(self):
+        acl = AccessList.objects.create(device=self.device, topic='some/#', rw=2, is_enabled=True)
+
+        class RacingAclEngine(AclEngine):
+            # A rule is revoked (by a signal) after the rules were read, before the trie is cached
+            @staticmethod
+            def compile(device_id):
+                trie = AclEngine.compile(device_id)
+                AccessList.objects.filter(pk=acl.pk).update(is_enabled=False)
+                engine.update_rule(device_id, acl.topic, acl.rw, False)
+                return trie
+
+        engine = RacingAclEngine(max_size=10, ttl=60)
+        self.assertTrue(engine.is_allowed(self.device_id, self.topic, MQTT_ACCESS_WRITE),
+                        "Should use the trie it compiled for the current check")
+        self.assertIsNone(engine._tries.get(self.device_id), "Should not cache a trie compiled before a change")
+
+    def create_member(self, email):
+        member = User.objects.create_user(email=email, password=self.password)
+        Device.objects.create_device(device_id=email, password=self.device_password,
+                                     model=DeviceModel.objects.get(model='application'),
+                                     type=DeviceType.objects.get(type='user'))
+        return member
+
+    def test_share_device(self):
+        member = self.create_member('member@nalkins.cloud')
+        topic = get_device_topic(self.device_id)
+        status_topic = self.device_id + '/status'
+
+        self.assertEqual(share_device(self.device_id, member, CustomerDevice.ROLE_VIEWER, self.device_name),
+                         (True, 'Device shared'))
+        self.assertEqual(get_device_role(self.device_id, member), CustomerDevice.ROLE_VIEWER)
+        self.assertEqual(AccessList.objects.get(device_id=member.email, topic=topic).rw, 1)
+        self.assertTrue(is_topic_allowed(member.email, status_topic, MQTT_ACCESS_READ))
+        self.assertFalse(is_topic_allowed(member.email, status_topic, MQTT_ACCESS_WRITE))
+
+        # The compiled trie of the member is updated, the broker check needs no query
+        self.assertEqual(share_device(self.device_id, member, CustomerDevice.ROLE_OPERATOR, self.device_name),
+                         (True, 'Role updated'))
+        with self.assertNumQueries(0):
+            self.assertTrue(is_topic_allowed(member.email, status_topic, MQTT_ACCESS_WRITE))
+        self.assertEqual(get_device_members(self.device_id),
+                         [{'email': self.email, 'role': CustomerDevice.ROLE_OWNER},
+                          {'email': member.email, 'role': CustomerDevice.ROLE_OPERATOR}])
+
+        self.assertEqual(share_device(self.device_id, self.user, CustomerDevice.ROLE_VIEWER, self.device_name),
+                         (False, 'Device must have an owner'))
+        self.assertEqual(unshare_device(self.device_id, self.user), (False, 'Device must have an owner'))
+        self.assertEqual(get_device_role(self.device_id, self.user), CustomerDevice.ROLE_OWNER)
+
+        self.assertEqual(unshare_device(self.device_id, member), (True, 'Device unshared'))
+        self.assertEqual(unshare_device(self.device_id, member), (False, 'User is not a member of the device'))
+        self.assertFalse(AccessList.objects.filter(device_id=member.email, topic=topic).exists())
+        self.assertFalse(is_topic_allowed(member.email, status_topic, MQTT_ACCESS_READ))
+
+    def test_remove_devices_shared(self):
+        member = self.create_member('member@nalkins.cloud')
+        AccessList.objects.create(device_id=self.email, topic=get_device_topic(self.device_id), rw=2, is_enabled=True)
+        share_device(self.device_id, member, CustomerDevice.ROLE_VIEWER, self.device_name)
+
+        # A member leaves a shared device, the device and its other members are left alone
+        self.assertEqual(remove_devices(member, [self.device_id]),
+                         {self.device_id: (True, 'Device Removed from account')})
+        self.assertFalse(is_device_owned_by_user(self.device_id, member))
+        self.assertFalse(is_topic_allowed(member.email, self.device_id + '/status', MQTT_ACCESS_READ))
+        self.assertTrue(is_topic_allowed(self.email, self.device_id + '/status', MQTT_ACCESS_WRITE))
+        self.assertTrue(Device.objects.get(device_id=self.device_id).check_password(self.device_password))
+
+        # The last owner removes the device from all of its members
+        share_device(self.device_id, member, CustomerDevice.ROLE_VIEWER, self.device_name)
+        remove_devices(self.user, [self.device_id])
+        self.assertFalse(CustomerDevice.objects.filter(device_id=self.device_id).exists())
+        self.assertFalse(AccessList.objects.filter(topic=get_device_topic(self.device_id)).exists())
+        self.assertFalse(Device.objects.get(device_id=self.device_id).has_usable_password())
+
+
+    def test_activate_devices(self):
+        member = self.create_member('member@nalkins.cloud')
+        for device_id in ('new_device_id', 'disabled_device_id'):
+            Device.objects.create_device(device_id=device_id, password=self.device_password,
+                                         model=DeviceModel.objects.get(model=self.device_model),
+                                         type=DeviceType.objects.get(type=self.device_type))
+        # A rule left disabled by a previous activation
+        disabled_topic = get_device_topic('disabled_device_id')
+        AccessList.objects.create(device_id='disabled_device_id', topic=disabled_topic, rw=1, is_enabled=False)
+
+        self.assertEqual(activate_devices(member, {'new_device_id': 'new', 'disabled_device_id': 'disabled',
+                                                   self.device_id: 'taken', 'missing_device_id': 'missing'}),
+                         {'new_device_id': (True, 'Activation successfully completed'),
+                          'disabled_device_id': (True, 'Activation successfully completed'),
+                          self.device_id: (False, 'Device already associated'),
+                          'missing_device_id': (False, 'Device does not exists')})
+        self.assertEqual(get_device_role('new_device_id', member), CustomerDevice.ROLE_OWNER)
+        self.assertTrue(AccessList.objects.get(device_id='disabled_device_id', topic=disabled_topic).is_enabled)
+        self.assertTrue(is_topic_allowed('disabled_device_id', 'disabled_device_id/status', MQTT_ACCESS_WRITE))
+        self.assertTrue(is_topic_allowed(member.email, 'disabled_device_id/status', MQTT_ACCESS_WRITE))
+
+        # The device was activated by another user first, nothing is written for the second one
+        self.assertEqual(activate_devices(self.user, {'new_device_id': 'new'}),
+                         {'new_device_id': (False, 'Device already associated')})
+        self.assertEqual(activate_devices(member, {'new_device_id': 'new'}),
+                         {'new_device_id': (True, 'device already activated')})
+        self.assertFalse(CustomerDevice.objects.filter(user_id=self.user, device_id='new_device_id').exists())
+
+class TestTopicTrie(TestCase):
+    def setUp(self):
+        self.trie = TopicTrie()
+        self.trie.insert('device/#', 1)
+        self.trie.insert('device/+/switch', 2)
+        self.trie.insert('user/device/temperature', 2)
+        self.trie.insert('#', 0)
+
+    def test_max_rw(self):
+        self.assertEqual(self.trie.max_rw('device'), 1, "'device/#' should match its parent level")
+        self.assertEqual(self.trie.max_rw('device/temperature'), 1)
+        self.assertEqual(self.trie.max_rw('device/kitchen/switch'), 2)
+        self.assertEqual(self.trie.max_rw('user/device/temperature'), 2)
+        self.assertEqual(self.trie.max_rw('user/device/humidity'), 0)
+        self.assertEqual(self.trie.max_rw('user/device'), 0)
+
+    def test_max_rw_subscription_filters(self):
+        self.assertEqual(self.trie.max_rw('device/+/switch'), 2)
+        self.assertEqual(self.trie.max_rw('device/#'), 1)
+        self.assertEqual(self.trie.max_rw('user/#'), 0, "Should return 0, no filter covers all 'user' topics")
+
+    def test_max_rw_dollar_topics(self):
+        self.trie.insert('#', 2)
+        self.trie.insert('+/status', 2)
+        self.assertEqual(self.trie.max_rw('$SYS/status'), 0, "Wildcards should not match '$' topics")
+        self.trie.insert('$SYS/#', 1)
+        self.assertEqual(self.trie.max_rw('$SYS/status'), 1)
+
+    def test_remove(self):
+        self.trie.remove('device/+/switch')
+        self.assertEqual(self.trie.max_rw('device/kitchen/switch'), 1)
+        self.trie.remove('device/#')
+        self.assertEqual(self.trie.max_rw('device/kitchen/switch'), 0)
+        self.assertNotIn('device', self.trie.root.children, "Empty nodes should be pruned")
+        self.trie.remove('non/existing/filter')
+
+
+class TestMQTTAuthViews(APITestCase):
+    def setUp(self):
+        device_credentials_cache.clear()
+        acl_engine.clear()
+
+        self.device_id = 'auth_test_device_id'
+        self.device_password = 'nalkinscloud'
+        self.device = Device.objects.create_device(device_id=self.device_id, password=self.device_password,
+                                                   model=DeviceModel.objects.get(model='esp8266'),
+                                                   type=DeviceType.objects.get(type='dht'),
+                                                   is_enabled=True)
+        AccessList.objects.create(device=self.device, topic=self.device_id + '/#', rw=2, is_enabled=True)
+
+        self.user_url = reverse('nalkinscloud_mosquitto:mqtt_auth_user')
+        self.superuser_url = reverse('nalkinscloud_mosquitto:mqtt_auth_superuser')
+        self.acl_url = reverse('nalkinscloud_mosquitto:mqtt_auth_acl')
+
+    def test_user_view(self):
+        post_body = {'username': self.device_id, 'password': self.device_password, 'clientid': 'some_client'}
+        response = self.client.post(self.user_url, data=post_body, format='json')
+        self.assertEqual(200, response.status_code, "Should return 200, credentials are valid")
+
+        post_body['password'] = 'wrong_password'
+        response = self.client.post(self.user_url, data=post_body)
+        self.assertEqual(403, response.status_code, "Should return 403, password is wrong")
+
+        response = self.client.post(self.user_url)
+        self.assertEqual(400, response.status_code, "Should return 400, since missing data")
+
+    def test_superuser_view(self):
+        response = self.client.post(self.superuser_url, data={'username': self.device_id})
+        self.assertEqual(403, response.status_code, "Should return 403, device is not a super user")
+
+        self.device.super = True
+        self.device.save()
+        response = self.client.post(self.superuser_url, data={'username': self.device_id})
+        self.assertEqual(200, response.status_code, "Should return 200, device is a super user")
+
+    def test_acl_view(self):
+        post_body = {'username': self.device_id, 'topic': self.device_id + '/switch', 'acc': MQTT_ACCESS_WRITE}
+        response = self.client.post(self.acl_url, data=post_body, format='json')
+        self.assertEqual(200, response.status_code, "Should return 200, topic is allowed")
+
+        post_body['topic'] = 'some_other_device/switch'
+        response = self.client.post(self.acl_url, data=post_body, format='json')
+        self.assertEqual(403, response.status_code, "Should return 403, topic is not allowed")
+
+    def test_only_broker_requests_allowed(self):
+        post_body = {'username': self.device_id, 'password': self.device_password, 'clientid': 'some_client'}
+        response = self.client.post(self.user_url, data=post_body, REMOTE_ADDR='10.1.2.3')
+        self.assertEqual(200, response.status_code, "Should return 200, called from a private network")
+        for url in (self.user_url, self.superuser_url, self.acl_url):
+            response = self.client.post(url, data=post_body, REMOTE_ADDR='8.8.8.8')
+            self.assertEqual(403, response.status_code, "Should return 403, called from a public address")
+        response = self.client.post(self.user_url, data=post_body, HTTP_X_FORWARDED_FOR='8.8.8.8')
+        self.assertEqual(403, response.status_code, "Should return 403, relayed by a reverse proxy")
+
+
+class TestMQTTPublisher(TestCase):
+    def setUp(self):
+        self.broker = LocalMQTTBroker().start()
+        self.pool = MQTTClientPool(host=self.broker.host, port=self.broker.port, size=2, transport='tcp',
+                                   reconnect_min_delay=0.1, reconnect_max_delay=0.5)
+
+    def tearDown(self):
+        self.pool.stop()
+        self.broker.stop()
+
+    def test_publish_batch(self):
+        requests = [PublishRequest('device_%d/switch' % index, '1', 'job_%d' % index, time.monotonic())
+                    for index in range(10)]
+        results = self.pool.publish_batch(requests, timeout=5)
+        self.assertTrue(all(result.is_published for result in results))
+        self.assertTrue(all(result.latency >= 0 for result in results))
+        self.assertEqual([result.job_id for result in results], ['job_%d' % index for index in range(10)])
+        self.assertTrue(self.broker.wait_for_messages(10))
+        self.assertEqual(self.broker.messages[0], ('device_0/switch', b'1', 1))
+
+    def test_publish_batch_reconnects(self):
+        self.pool.publish_batch([PublishRequest('device/switch', '1', None, time.monotonic())], timeout=5)
+        self.broker.disconnect_clients()
+        results = self.pool.publish_batch([PublishRequest('device/switch', '0', None, time.monotonic())], timeout=5)
+        self.assertTrue(results[0].is_published, "Should reconnect and publish")
+        self.assertTrue(self.broker.wait_for_messages(2))
+
+    def test_publish_batch_broker_down(self):
+        self.broker.stop()
+        self.pool.reconnect_min_delay = 5
+        results = self.pool.publish_batch([PublishRequest('device/switch', '1', 'job_id', time.monotonic())],
+                                          timeout=0.5)
+        self.assertFalse(results[0].is_published)
+        self.assertIsNotNone(results[0].error)
+
+    def test_publish_acknowledged_before_tracked(self):
+        # on_publish may run on the network thread before publish() returned the mid
+        self.pool._on_publish(None, 'client_id', 1)
+        self.assertTrue(self.pool._track_publish('client_id', 1).is_set())
+        event = self.pool._track_publish('client_id', 1)
+        self.assertFalse(event.is_set())
+        self.pool._on_publish(None, 'client_id', 1)
+        self.assertTrue(event.is_set())
+        self.assertEqual((self.pool._pending, self.pool._acknowledged), ({}, {'client_id': {}}))
+
+    def test_untracked_acknowledgements_bounded(self):
+        self.pool.max_untracked_acks = 10
+        event = self.pool._track_publish('client_id', 1)
+        self.pool._untrack_publish('client_id', 1, event)  # Timed out
+        self.assertEqual(self.pool._pending, {})
+        for mid in range(1, 21):  # Late acknowledgements
+            self.pool._on_publish(None, 'client_id', mid)
+        self.assertEqual(list(self.pool._acknowledged['client_id']), list(range(11, 21)))
+        self.pool._on_connect(None, 'client_id', None, mqtt.CONNACK_ACCEPTED)
+        self.assertEqual(self.pool._acknowledged, {}, "Should forget acknowledgements of the previous connection")
+
+    def test_publish_batch_timeout_untracked(self):
+        self.broker.stop()
+        self.pool.reconnect_min_delay = 5
+        self.pool.start()
+        client = self.pool._clients[0]
+        client.is_connected = lambda: True  # Queued by paho (not connected), never acknowledged
+        results = self.pool.publish_batch([PublishRequest('device/switch', '1', None, time.monotonic())],
+                                          timeout=0.2)
+        self.assertEqual(results[0].error, 'Publish timed out')
+        self.assertEqual(self.pool._pending, {}, "Should stop tracking publishes that timed out")
+
+    def test_batch_publisher_retries_unsent(self):
+        self.broker.stop()
+        self.pool.reconnect_min_delay = 5
+        publisher = BatchPublisher(self.pool, batch_window=0, timeout=0.2, max_attempts=2)
+        publisher.submit('device/switch', '1', job_id='job_id')
+        deadline = time.monotonic() + 5
+        while publisher.failed_count == 0 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        publisher.stop()
+        self.assertEqual((publisher.retried_count, publisher.failed_count, publisher.published_count), (1, 1, 0),
+                         "Should publish again a message not handed to a connection, up to max_attempts")
+
+    def test_batch_publisher(self):
+        publisher = BatchPublisher(self.pool, batch_window=0.1)
+        for index in range(50):
+            publisher.submit('device_%d/switch' % index, '1', job_id='job_%d' % index)
+        self.assertTrue(self.broker.wait_for_messages(50))
+        publisher.stop()
+        self.assertEqual(publisher.published_count, 50)
+        self.assertEqual(publisher.failed_count, 0)
+        self.assertLessEqual(self.broker.connections_count, 2, "Should reuse pooled connections")
+
+
+class PartitionsTestCase(TransactionTestCase):
+    # Partition tables are created with DDL, that sqlite refuses to run inside the transaction of a TestCase
+    serialized_rollback = True
+
+    def setUp(self):
+        clear_partitions_cache()
+
+    def tearDown(self):
+        for partition in MessagePartition.objects.all():
+            drop_partition(partition)
+
+    def get_messages(self, device_id):
+        now = timezone.now()
+        return list(get_device_messages(device_id, now - datetime.timedelta(days=2), now + datetime.timedelta(days=1)))
+
+
+class TestMessageIngestion(PartitionsTestCase):
+    def setUp(self):
+        super().setUp()
+        self.device_id = 'ingest_device_id'
+        Device.objects.create_device(device_id=self.device_id, password='some_password',
+                                     model=DeviceModel.objects.get(model='esp8266'),
+                                     type=DeviceType.objects.get(type='dht'))
+        known_devices_cache.clear()
+        # Writer thread is not started, 'stop' writes queued messages from the test thread
+        self.ingestor = MessageIngestor(batch_size=10, flush_interval=0.1)
+
+    def test_batched_writes(self):
+        for index in range(25):
+            self.ingestor.put(self.device_id + '/temperature', str(index).encode(), 0)
+        with CaptureQueriesContext(connection) as queries:
+            self.ingestor.stop()
+        self.assertEqual(len([query for query in queries if 'INSERT INTO "messages_dht_' in query['sql']]), 3,
+                         "Should write a single executemany INSERT per batch of 10")
+        self.assertEqual(len([query for query in queries if 'FROM "devices"' in query['sql']]), 1,
+                         "Should look up devices once")
+
+        messages = self.get_messages(self.device_id)
+        self.assertEqual([message['message'] for message in messages], [str(index) for index in range(25)])
+        self.assertEqual(self.ingestor.stats()['written'], 25)
+        self.assertEqual(self.ingestor.stats()['flushes'], 3)
+
+    def test_unknown_device_rejected(self):
+        self.ingestor.put('unknown_device/temperature', b'1', 0)
+        self.ingestor.put(self.device_id + '/temperature', b'x' * 300, 0)
+        self.ingestor.stop()
+        self.assertEqual(self.ingestor.rejected_count, 1)
+        self.assertEqual(len(self.get_messages(self.device_id)[0]['message']), 256, "Should truncate payload")
+
+    def test_registered_device_accepted(self):
+        self.ingestor.put('new_device_id/temperature', b'1', 0)
+        self.ingestor.stop()
+        self.assertEqual(self.ingestor.rejected_count, 1)
+
+        Device.objects.create_device(device_id='new_device_id', password='some_password',
+                                     model=DeviceModel.objects.get(model='esp8266'),
+                                     type=DeviceType.objects.get(type='dht'))
+        self.ingestor.put('new_device_id/temperature', b'2', 0)
+        self.ingestor.stop()
+        self.assertEqual(self.ingestor.rejected_count, 1, "Should accept messages once the device is registered")
+        self.assertEqual([message['message'] for message in self.get_messages('new_device_id')], ['2'])
+
+    def test_unknown_device_ttl(self):
+        ingestor = MessageIngestor(unknown_devices_ttl=0)
+        self.assertEqual(ingestor.get_devices_types({'new_device_id'}), {})
+        # Registered by another process, no signal is received
+        Device.objects.bulk_create([Device(device_id='new_device_id', password='some_password',
+                                           model=DeviceModel.objects.get(model='esp8266'),
+                                           type=DeviceType.objects.get(type='dht'))])
+        self.assertEqual(ingestor.get_devices_types({'new_device_id'}), {'new_device_id': 'dht'})
+
+    def test_backpressure_drops(self):
+        ingestor = MessageIngestor(max_queue_size=2, put_timeout=0)
+        results = [ingestor.put(self.device_id + '/temperature', b'1', 0) for _ in range(3)]
+        self.assertEqual(results, [True, True, False])
+        self.assertEqual(ingestor.stats()['dropped'], 1)
+
+    def test_ingested_messages_last_values(self):
+        last_value_store.client.flushdb()
+        for value in ('20', '21'):
+            self.ingestor.put(self.device_id + '/temperature', value.encode(), 0)
+        self.ingestor.put(self.device_id + '/humidity', b'40', 0)
+        self.ingestor.stop()
+
+        state = last_value_store.get(self.device_id)
+        self.assertEqual({topic: value['message'] for topic, value in state.items()},
+                         {self.device_id + '/temperature': '21', self.device_id + '/humidity': '40'})
+
+        Device.objects.filter(device_id=self.device_id).delete()
+        self.assertEqual(last_value_store.get(self.device_id), {}, "Should forget last values of deleted devices")
+
+    def test_messages_ingested_signal(self):
+        received = []
+        messages_ingested.connect(lambda sender, messages, **kwargs: received.extend(messages),
+                                  sender=Message, dispatch_uid='test_messages_ingested', weak=False)
+        try:
+            self.ingestor.put(self.device_id + '/temperature', b'1', 0)
+            self.ingestor.stop()
+        finally:
+            messages_ingested.disconnect(sender=Message, dispatch_uid='test_messages_ingested')
+        self.assertEqual([message.message for message in received], ['1'])
+
+    def test_subscriber(self):
+        broker = LocalMQTTBroker().start()
+        subscriber = MQTTMessageSubscriber(self.ingestor, host=broker.host, port=broker.port, topic='#')
+        subscriber.start()
+        try:
+            self.assertTrue(broker.wait_for_subscriptions(1))
+            for index in range(100):
+                broker.publish(self.device_id + '/temperature', str(index))
+            deadline = time.monotonic() + 5
+            while self.ingestor.received_count < 100:
+                self.assertLess(time.monotonic(), deadline, "Should receive all messages")
+                time.sleep(0.01)
+        finally:
+            subscriber.stop()
+            broker.stop()
+        self.ingestor.stop()
+        self.assertEqual(len(self.get_messages(self.device_id)), 100)
+
+    def test_ingested_messages_rollups(self):
+        self.ingestor.put(self.device_id + '/temperature', b'20', 0)
+        self.ingestor.put(self.device_id + '/temperature', b'not a number', 0)
+        self.ingestor.put(self.device_id + '/temperature', b'22.5', 0)
+        self.ingestor.stop()
+
+        self.assertEqual(MessageRollup.objects.filter(device_id=self.device_id).count(), 3, "One per resolution")
+        rollup = MessageRollup.objects.get(device_id=self.device_id, resolution='1d')
+        self.assertEqual((rollup.count, rollup.min, rollup.max, rollup.avg), (2, 20, 22.5, 21.25))
+
+
+class TestMessagePartitions(PartitionsTestCase):
+    def setUp(self):
+        super().setUp()
+        self.now = timezone.now()
+
+    def test_partition_per_device_type_and_period(self):
+        yesterday = self.now - datetime.timedelta(days=1)
+        messages = [IngestedMessage('test_dht_simulator', 'test_dht_simulator/temperature', '1', 0, yesterday),
+                    IngestedMessage('test_dht_simulator', 'test_dht_simulator/temperature', '2', 0, self.now),
+                    IngestedMessage('test_switch_simulator', 'test_switch_simulator/switch', '3', 0, self.now)]
+        insert_messages(messages, {'test_dht_simulator': 'dht', 'test_switch_simulator': 'switch'})
+
+        self.assertEqual(set(MessagePartition.objects.values_list('table_name', flat=True)),
+                         {get_partition_table_name('dht', get_period_start(yesterday)),
+                          get_partition_table_name('dht', get_period_start(self.now)),
+                          get_partition_table_name('switch', get_period_start(self.now))})
+
+        # Only partitions of the requested period are queried
+        start = get_period_start(self.now)
+        self.assertEqual(get_partitions(start, self.now + datetime.timedelta(seconds=1)).count(), 2)
+        self.assertEqual([message['message'] for message in
+                          get_device_messages('test_dht_simulator', start, self.now + datetime.timedelta(seconds=1))],
+                         ['2'])
+        self.assertEqual([message['message'] for message in self.get_messages('test_dht_simulator')], ['1', '2'])
+
+    def test_get_period_start(self):
+        date = datetime.datetime(2019, 4, 17, 17, 59, tzinfo=datetime.timezone.utc)
+        self.assertEqual(get_period_start(date, 'day'), datetime.datetime(2019, 4, 17, tzinfo=datetime.timezone.utc))
+        self.assertEqual(get_period_start(date, 'month'), datetime.datetime(2019, 4, 1, tzinfo=datetime.timezone.utc))
+        self.assertEqual(get_period_end(get_period_start(date, 'month'), 'month'),
+                         datetime.datetime(2019, 5, 1, tzinfo=datetime.timezone.utc))
+        self.assertEqual(get_partition_table_name('Some Type', date, 'day'), 'messages_some_type_20190417')
+
+    def test_get_messages_chunks(self):
+        date = datetime.datetime(2019, 4, 17, 17, 59, 30, tzinfo=datetime.timezone.utc)
+        # Messages with the same date_created at chunk boundaries should be neither skipped nor repeated
+        insert_messages([IngestedMessage('test_dht_simulator', 'test_dht_simulator/temperature', str(value), 0,
+                                         date + datetime.timedelta(seconds=value // 2)) for value in range(7)],
+                        {'test_dht_simulator': 'dht'})
+        Message.objects.create(device_id='test_dht_simulator', topic='test_dht_simulator/temperature', message='old',
+                               date_created=date - datetime.timedelta(seconds=1))
+
+        with CaptureQueriesContext(connection) as queries:
+            messages = list(get_device_messages('test_dht_simulator', date - datetime.timedelta(hours=1),
+                                                date + datetime.timedelta(hours=1), chunk_size=3))
+        self.assertEqual([message['message'] for message in messages], ['old', '0', '1', '2', '3', '4', '5', '6'])
+        self.assertEqual(len([query for query in queries if 'FROM "messages_dht_' in query['sql']]), 3,
+                         "Should read the partition in chunks")
+
+    def test_compact_messages(self):
+        old_date = self.now - datetime.timedelta(days=40)
+        insert_messages([IngestedMessage('test_dht_simulator', 'test_dht_simulator/temperature', '1', 0, old_date),
+                         IngestedMessage('test_switch_simulator', 'test_switch_simulator/switch', '1', 0, old_date)],
+                        {'test_dht_simulator': 'dht', 'test_switch_simulator': 'switch'})
+        MessageRetentionPolicy.objects.create(device_type_id='dht', retention_days=30)
+        expired_table = get_partition_table_name('dht', get_period_start(old_date))
+
+        call_command('compact_messages', '--dry-run', stdout=io.StringIO())
+        self.assertEqual(MessagePartition.objects.count(), 2, "Dry run should not drop partitions")
+
+        with CaptureQueriesContext(connection) as queries:
+            call_command('compact_messages', stdout=io.StringIO())
+        self.assertFalse(any('DELETE FROM "%s"' % expired_table in query['sql'] for query in queries),
+                         "Should drop the table instead of deleting rows")
+        self.assertEqual(list(MessagePartition.objects.values_list('device_type', flat=True)), ['switch'],
+                         "Should keep partitions of device types with longer retention")
+        self.assertNotIn(expired_table, connection.introspection.table_names())
+
+    def test_create_upcoming_partitions(self):
+        insert_messages([IngestedMessage('test_dht_simulator', 'test_dht_simulator/temperature', '1', 0, self.now)],
+                        {'test_dht_simulator': 'dht'})
+        tomorrow = get_period_end(get_period_start(self.now, 'day'), 'day')
+        self.assertEqual(create_upcoming_partitions(periods=2, now=self.now),
+                         [get_partition_table_name('dht', tomorrow),
+                          get_partition_table_name('dht', tomorrow + datetime.timedelta(days=1))])
+        self.assertEqual(create_upcoming_partitions(periods=2, now=self.now), [])
+
+        clear_partitions_cache()
+        with CaptureQueriesContext(connection) as queries:
+            insert_messages([IngestedMessage('test_dht_simulator', 'test_dht_simulator/temperature', '2', 0,
+                                             tomorrow)], {'test_dht_simulator': 'dht'})
+        self.assertFalse(any('CREATE TABLE' in query['sql'] for query in queries),
+                         "Should not create tables while flushing messages")
+
+    def test_migrate_legacy_messages(self):
+        for value in range(5):
+            Message.objects.create(device_id='test_dht_simulator', topic='test_dht_simulator/temperature',
+                                   message=str(value), date_created=self.now - datetime.timedelta(minutes=value))
+        call_command('compact_messages', '--migrate-legacy', stdout=io.StringIO())
+        self.assertFalse(Message.objects.exists())
+        self.assertEqual(sorted(message['message'] for message in self.get_messages('test_dht_simulator')),
+                         ['0', '1', '2', '3', '4'])
+
+    def test_rebuild_rollups(self):
+        date = datetime.datetime(2019, 4, 17, 17, 59, 30, tzinfo=datetime.timezone.utc)
+        insert_messages([IngestedMessage('test_dht_simulator', 'test_dht_simulator/temperature', str(value), 0,
+                                         date + datetime.timedelta(seconds=value)) for value in range(60)],
+                        {'test_dht_simulator': 'dht'})
+        MessageRollup.objects.create(device_id='test_dht_simulator', topic='stale', resolution='1d',
+                                     bucket_start=get_bucket_start(date, '1d'), count=1, sum=1, min=1, max=1)
+
+        self.assertEqual(rebuild_rollups(date, date + datetime.timedelta(hours=1)), 60)
+        self.assertFalse(MessageRollup.objects.filter(topic='stale').exists(), "Should drop stale rollups")
+        series = get_rollup_series('test_dht_simulator', 'test_dht_simulator/temperature', '1m',
+                                   date - datetime.timedelta(minutes=1), date + datetime.timedelta(minutes=2))
+        self.assertEqual([(point['count'], point['min'], point['max']) for point in series], [(30, 0, 29), (30, 30, 59)])
+
+    def test_rebuild_rollups_device_types(self):
+        date = datetime.datetime(2019, 4, 17, 17, 59, 30, tzinfo=datetime.timezone.utc)
+        devices_types = {'test_dht_simulator': 'dht', 'test_switch_simulator': 'switch', 'user@nalkins.cloud': 'user'}
+        messages = [IngestedMessage(device_id, device_id + '/value', str(value), 0,
+                                    date + datetime.timedelta(minutes=value))
+                    for value in range(10) for device_id in devices_types]
+        insert_messages(messages, devices_types)
+        messages_ingested.send(sender=Message, messages=messages, devices_types=devices_types)
+
+        def get_rollups():
+            return sorted(MessageRollup.objects.values_list('device_id', 'topic', 'resolution', 'bucket_start',
+                                                            'count', 'sum', 'min', 'max'))
+
+        ingested_rollups = get_rollups()
+        self.assertFalse(MessageRollup.objects.filter(device_id='user@nalkins.cloud').exists())
+
+        self.assertEqual(rebuild_rollups(date, date + datetime.timedelta(hours=1)), 20)
+        self.assertEqual(get_rollups(), ingested_rollups, "Should rebuild the rollups ingestion maintains")
+
+
+class TestLastValueStore(TestCase):
+    def setUp(self):
+        self.store = LastValueStore(MemoryHashClient())
+        self.date = datetime.datetime(2019, 4, 17, 17, 59, 30, tzinfo=datetime.timezone.utc)
+
+    def test_update(self):
+        self.store.update([IngestedMessage('device_1', 'device_1/switch', 'on', 0, self.date),
+                           IngestedMessage('device_1', 'device_1/switch', 'off', 0, self.date),
+                           IngestedMessage('device_2', 'device_2/temperature', '21', 0, self.date)])
+        self.assertEqual(self.store.get_many(['device_1', 'device_2', 'device_3']), {
+            'device_1': {'device_1/switch': {'message': 'off', 'date_created': '2019-04-17T17:59:30Z'}},
+            'device_2': {'device_2/temperature': {'message': '21', 'date_created': '2019-04-17T17:59:30Z'}},
+            'device_3': {},
+        })
+
+    def test_store_unreachable(self):
+        class UnreachableClient(MemoryHashClient):
+            def pipeline(self, transaction=True):
+                raise ConnectionError('Connection refused')
+
+        store = LastValueStore(UnreachableClient())
+        with self.assertLogs(logging.getLogger(PROJECT_NAME), logging.WARNING) as logs:
+            self.assertEqual(store.get_many_or_empty(['device_1', 'device_2']), {'device_1': {}, 'device_2': {}})
+            store.get_many_or_empty(['device_1'])
+        self.assertEqual(len([record for record in logs.records if 'could not be read' in record.getMessage()]), 1,
+                         "Should warn once")
+
+    def test_redis_replies(self):
+        # The redis client returns bytes
+        self.store.client.hset('last_values:device_1', b'device_1/switch', b'{"message": "on", "date_created": null}')
+        self.assertEqual(self.store.get('device_1'), {'device_1/switch': {'message': 'on', 'date_created': None}})
+
+
+class TestMessageRollups(TestCase):
+    def setUp(self):
+        self.device_id = 'test_dht_simulator'
+        self.topic = 'test_dht_simulator/temperature'
+        self.date = datetime.datetime(2019, 4, 17, 17, 59, 30, tzinfo=datetime.timezone.utc)
+
+    def test_parse_value(self):
+        self.assertEqual(parse_value(' 21.5 '), 21.5)
+        self.assertEqual(parse_value('ON'), 1)
+        self.assertIsNone(parse_value('nan'))
+        self.assertIsNone(parse_value('{"temperature": 21}'))
+
+    def test_get_bucket_start(self):
+        self.assertEqual(get_bucket_start(self.date, '1m'), self.date.replace(second=0))
+        self.assertEqual(get_bucket_start(self.date, '1h'), self.date.replace(minute=0, second=0))
+        self.assertEqual(get_bucket_start(self.date, '1d'), self.date.replace(hour=0, minute=0, second=0))
+
+    def test_aggregate_messages(self):
+        messages = [IngestedMessage(self.device_id, self.topic, value, 0, self.date) for value in ('1', '3', 'x')]
+        aggregates = aggregate_messages(messages)
+        self.assertEqual(aggregates[(self.device_id, self.topic, '1h', get_bucket_start(self.date, '1h'))],
+                         [2, 4, 1, 3])
+
+    def test_update_rollups_merges(self):
+        update_rollups([IngestedMessage(self.device_id, self.topic, '1', 0, self.date)])
+        with self.assertNumQueries(4):  # Savepoint, select existing rollups, bulk update, release savepoint
+            update_rollups([IngestedMessage(self.device_id, self.topic, '5', 0, self.date)])
+
+        series = get_rollup_series(self.device_id, self.topic, '1h', self.date - datetime.timedelta(hours=1),
+                                   self.date)
+        self.assertEqual(series, [{'bucket_start': get_bucket_start(self.date, '1h'), 'count': 2, 'min': 1, 'max': 5,
+                                   'avg': 3}])
@@ -0,0 +1,12 @@
+from django.conf.urls import url
+
+from nalkinscloud_mosquitto import views
+
+app_name = 'nalkinscloud_mosquitto'
+
+urlpatterns = [
+    # MQTT broker HTTP auth backend urls
+    url(r'^mqtt_auth/user/', views.MQTTUserView.as_view(), name='mqtt_auth_user'),
+    url(r'^mqtt_auth/superuser/', views.MQTTSuperuserView.as_view(), name='mqtt_auth_superuser'),
+    url(r'^mqtt_auth/acl/', views.MQTTAclView.as_view(), name='mqtt_auth_acl'),
+]
@@ -1,4 +1,93 @@
+import logging
 
-from django.shortcuts import render
+from nalkinscloud_django.networks import parse_networks, is_direct_request_from
+from nalkinscloud_django.settings import PROJECT_NAME, MQTT_AUTH_ALLOWED_NETWORKS
+from nalkinscloud_mosquitto.functions import authenticate_device, is_device_superuser, is_topic_allowed
+from nalkinscloud_mosquitto.serializers import MQTTUserSerializer, MQTTSuperuserSerializer, MQTTAclSerializer
 
-# Create your views here.
+# REST Framework
+from rest_framework.response import Response
+from rest_framework import status
+from rest_framework.permissions import BasePermission
+from rest_framework.views import APIView
+
+# Define logger
+logger = logging.getLogger(PROJECT_NAME)
+
+# Views below implement mosquitto-go-auth HTTP backend (http_response_mode: status),
+# the broker allows the request on 200 and denies it on any other status code,
+# These endpoints are called by the broker only, see IsBrokerRequest
+
+allowed_networks = parse_networks(MQTT_AUTH_ALLOWED_NETWORKS)
+
+
+class IsBrokerRequest(BasePermission):
+    """
+    Allow requests made directly from an address of 'mqtt_auth_allowed_networks',
+    requests relayed by a reverse proxy (carrying X-Forwarded-For / X-Real-IP) are refused,
+    since behind the proxy every request comes from the (private) proxy address
+    """
+
+    def has_permission(self, request, view):
+        return is_direct_request_from(request, allowed_networks)
+
+
+def allowed():
+    return Response('ok', status=status.HTTP_200_OK)
+
+
+def denied():
+    return Response('denied', status=status.HTTP_403_FORBIDDEN)
+
+
+class MQTTUserView(APIView):
+    authentication_classes = ()
+    permission_classes = (IsBrokerRequest,)  # No Authentication, called by the broker
+
+    @staticmethod
+    def post(request):
+        serializer = MQTTUserSerializer(data=request.data)
+
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        data = serializer.validated_data
+        if not authenticate_device(data['username'], data['password']):
+            logger.info("MQTT authentication failed for device: %s", data['username'])
+            return denied()
+        return allowed()
+
+
+class MQTTSuperuserView(APIView):
+    authentication_classes = ()
+    permission_classes = (IsBrokerRequest,)  # No Authentication, called by the broker
+
+    @staticmethod
+    def post(request):
+        serializer = MQTTSuperuserSerializer(data=request.data)
+
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        if not is_device_superuser(serializer.validated_data['username']):
+            return denied()
+        return allowed()
+
+
+class MQTTAclView(APIView):
+    authentication_classes = ()
+    permission_classes = (IsBrokerRequest,)  # No Authentication, called by the broker
+
+    @staticmethod
+    def post(request):
+        serializer = MQTTAclSerializer(data=request.data)
+
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        data = serializer.validated_data
+        if not is_topic_allowed(data['username'], data['topic'], data['acc']):
+            logger.info("MQTT ACL check failed for device: %s, topic: %s, acc: %s",
+                        data['username'], data['topic'], data['acc'])
+            return denied()
+        return allowed()
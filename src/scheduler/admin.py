@@ -1,3 +1,15 @@
 from django.contrib import admin
 
-# Register your models here.
+from scheduler.models import ScheduledJob, SchedulerLease
+
+
+@admin.register(ScheduledJob)
+class ScheduledJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'next_run_time')
+    ordering = ('next_run_time',)
+    exclude = ('job_state',)
+
+
+@admin.register(SchedulerLease)
+class SchedulerLeaseAdmin(admin.ModelAdmin):
+    list_display = ('name', 'owner', 'expires_at')
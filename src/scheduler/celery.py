@@ -0,0 +1,16 @@
+# Celery application of the project, runs slow work (password hashing, emails, ACL and rollups rebuilds)
+# out of the request, workers of each queue are started with:
+# celery -A scheduler worker -Q default
+# celery -A scheduler worker -Q slow --concurrency 2
+# With CELERY_TASK_ALWAYS_EAGER (environment 'dev' and tests) tasks run inline, without a broker or worker
+import os
+
+from celery import Celery
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'nalkinscloud_django.settings')
+
+app = Celery('nalkinscloud')
+# Read the CELERY_ prefixed django settings (CELERY_BROKER_URL -> broker_url)
+app.config_from_object('django.conf:settings', namespace='CELERY')
+# Load the tasks.py module of each installed app
+app.autodiscover_tasks()
@@ -0,0 +1,55 @@
+import datetime
+import os
+import uuid
+
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from scheduler.models import SchedulerLease
+from nalkinscloud_django.settings import HOSTNAME
+
+
+def generate_lease_owner():
+    """
+    Generate unique identifier of current process, for example: nalkinscloud-api-1:42:1f0c2b7e
+
+    :return: string
+    """
+    return '%s:%d:%s' % (HOSTNAME, os.getpid(), uuid.uuid4().hex[:8])
+
+
+def acquire_lease(name, owner, ttl):
+    """
+    Acquire (or renew) lease 'name' for 'owner' for the next 'ttl' seconds,
+    Succeeds only if the lease does not exist, expired, or already held by owner,
+    The update is a single conditional UPDATE statement, so two processes can never both acquire it
+
+    :param name: string
+    :param owner: string
+    :param ttl: int seconds
+    :return: boolean, True if owner holds the lease
+    """
+    now = timezone.now()
+    expires_at = now + datetime.timedelta(seconds=ttl)
+    updated = SchedulerLease.objects.filter(Q(name=name), Q(owner=owner) | Q(expires_at__lt=now))\
+        .update(owner=owner, expires_at=expires_at)
+    if updated:
+        return True
+    try:
+        with transaction.atomic():
+            SchedulerLease.objects.create(name=name, owner=owner, expires_at=expires_at)
+        return True
+    except IntegrityError:  # Lease exists and held by another owner
+        return False
+
+
+def release_lease(name, owner):
+    """
+    Expire lease 'name' if held by 'owner', so another process may acquire it right away
+
+    :param name: string
+    :param owner: string
+    :return: boolean, True if lease was released
+    """
+    return SchedulerLease.objects.filter(name=name, owner=owner).update(expires_at=timezone.now()) > 0
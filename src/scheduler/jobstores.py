@@ -0,0 +1,97 @@
+import pickle
+import time
+
+from apscheduler.job import Job
+from apscheduler.jobstores.base import BaseJobStore, JobLookupError, ConflictingIdError
+from apscheduler.util import datetime_to_utc_timestamp, utc_timestamp_to_datetime
+from django.db import IntegrityError, transaction
+
+from scheduler.models import ScheduledJob
+
+
+class DjangoJobStore(BaseJobStore):
+    """
+    APScheduler job store that keeps jobs in the 'scheduled_jobs' table of the Django database,
+    Based on apscheduler.jobstores.sqlalchemy.SQLAlchemyJobStore
+
+    :param int due_jobs_batch_size: max number of due jobs returned per scheduler loop,
+        remaining due jobs are fetched on the following (immediate) loop
+    :param int pickle_protocol: pickle protocol level to use (for serialization)
+    """
+
+    def __init__(self, due_jobs_batch_size=500, pickle_protocol=pickle.HIGHEST_PROTOCOL):
+        super(DjangoJobStore, self).__init__()
+        self.due_jobs_batch_size = due_jobs_batch_size
+        self.pickle_protocol = pickle_protocol
+
+    def lookup_job(self, job_id):
+        job_state = ScheduledJob.objects.filter(id=job_id).values_list('job_state', flat=True).first()
+        return self._reconstitute_job(job_state) if job_state else None
+
+    def get_due_jobs(self, now):
+        timestamp = datetime_to_utc_timestamp(now)
+        jobs = ScheduledJob.objects.filter(next_run_time__lte=timestamp).order_by('next_run_time')
+        return self._get_jobs(jobs[:self.due_jobs_batch_size])
+
+    def get_next_run_time(self):
+        next_run_time = ScheduledJob.objects.filter(next_run_time__isnull=False)\
+            .order_by('next_run_time').values_list('next_run_time', flat=True).first()
+        return utc_timestamp_to_datetime(next_run_time)
+
+    def get_all_jobs(self):
+        jobs = self._get_jobs(ScheduledJob.objects.order_by('next_run_time'))
+        self._fix_paused_jobs_sorting(jobs)
+        return jobs
+
+    def add_job(self, job):
+        try:
+            with transaction.atomic():
+                ScheduledJob.objects.create(id=job.id,
+                                            next_run_time=datetime_to_utc_timestamp(job.next_run_time),
+                                            job_state=pickle.dumps(job.__getstate__(), self.pickle_protocol),
+                                            modified_at=time.time())
+        except IntegrityError:
+            raise ConflictingIdError(job.id)
+
+    def update_job(self, job):
+        updated = ScheduledJob.objects.filter(id=job.id).update(
+            next_run_time=datetime_to_utc_timestamp(job.next_run_time),
+            job_state=pickle.dumps(job.__getstate__(), self.pickle_protocol),
+            modified_at=time.time())
+        if updated == 0:
+            raise JobLookupError(job.id)
+
+    def remove_job(self, job_id):
+        if ScheduledJob.objects.filter(id=job_id).delete()[0] == 0:
+            raise JobLookupError(job_id)
+
+    def remove_all_jobs(self):
+        ScheduledJob.objects.all().delete()
+
+    def _reconstitute_job(self, job_state):
+        job_state = pickle.loads(job_state)
+        job_state['jobstore'] = self
+        job = Job.__new__(Job)
+        job.__setstate__(job_state)
+        job._scheduler = self._scheduler
+        job._jobstore_alias = self._alias
+        return job
+
+    def _get_jobs(self, queryset):
+        jobs = []
+        failed_job_ids = set()
+        for job_id, job_state in queryset.values_list('id', 'job_state'):
+            try:
+                jobs.append(self._reconstitute_job(job_state))
+            except BaseException:
+                self._logger.exception('Unable to restore job "%s" -- removing it', job_id)
+                failed_job_ids.add(job_id)
+
+        # Remove all the jobs we failed to restore
+        if failed_job_ids:
+            ScheduledJob.objects.filter(id__in=failed_job_ids).delete()
+
+        return jobs
+
+    def __repr__(self):
+        return '<%s>' % self.__class__.__name__
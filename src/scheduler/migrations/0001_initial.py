@@ -0,0 +1,40 @@
+# Generated by Django 3.0.12 on 2026-10-18 10:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScheduledJob',
+            fields=[
+                ('id', models.CharField(max_length=191, primary_key=True, serialize=False, verbose_name='Job Id')),
+                ('next_run_time', models.FloatField(blank=True, db_index=True, null=True, verbose_name='Next Run Time')),
+                ('job_state', models.BinaryField(verbose_name='Job State')),
+            ],
+            options={
+                'verbose_name': 'scheduled_job',
+                'verbose_name_plural': 'scheduled_jobs',
+                'db_table': 'scheduled_jobs',
+            },
+        ),
+        migrations.CreateModel(
+            name='SchedulerLease',
+            fields=[
+                ('name', models.CharField(max_length=64, primary_key=True, serialize=False, verbose_name='Lease Name')),
+                ('owner', models.CharField(max_length=255, verbose_name='Lease Owner')),
+                ('expires_at', models.DateTimeField(verbose_name='Expires At')),
+            ],
+            options={
+                'verbose_name': 'scheduler_lease',
+                'verbose_name_plural': 'scheduler_leases',
+                'db_table': 'scheduler_leases',
+            },
+        ),
+    ]
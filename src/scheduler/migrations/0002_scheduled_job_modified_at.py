@@ -0,0 +1,18 @@
+# Generated by Django 3.0.12 on 2026-10-18 12:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scheduler', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='scheduledjob',
+            name='modified_at',
+            field=models.FloatField(db_index=True, default=0, verbose_name='Modified At'),
+        ),
+    ]
@@ -1,3 +1,40 @@
 from django.db import models
+from django.utils.translation import ugettext_lazy as _
 
-# Create your models here.
+
+class ScheduledJob(models.Model):
+    """
+    APScheduler job, persisted by scheduler.jobstores.DjangoJobStore
+    """
+    # 191 = max key length in MySQL for InnoDB/utf8mb4 tables
+    id = models.CharField(_('Job Id'), max_length=191, primary_key=True)
+    # UTC timestamp, null when job is paused
+    next_run_time = models.FloatField(_('Next Run Time'), null=True, blank=True, db_index=True)
+    job_state = models.BinaryField(_('Job State'), null=False)
+    # UTC timestamp of the last write, changed jobs are read on this index (see LeasedTimingWheelScheduler.sync_jobs)
+    modified_at = models.FloatField(_('Modified At'), default=0, db_index=True)
+
+    def __str__(self):
+        return self.id
+
+    class Meta:
+        verbose_name = _('scheduled_job')
+        verbose_name_plural = _('scheduled_jobs')
+        db_table = 'scheduled_jobs'
+
+
+class SchedulerLease(models.Model):
+    """
+    Named lease, only the process holding (owner) a non expired lease is allowed to run due jobs
+    """
+    name = models.CharField(_('Lease Name'), max_length=64, primary_key=True)
+    owner = models.CharField(_('Lease Owner'), max_length=255, null=False)
+    expires_at = models.DateTimeField(_('Expires At'), null=False)
+
+    def __str__(self):
+        return self.name + ' held by ' + self.owner
+
+    class Meta:
+        verbose_name = _('scheduler_lease')
+        verbose_name_plural = _('scheduler_leases')
+        db_table = 'scheduler_leases'
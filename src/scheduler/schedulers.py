@@ -0,0 +1,368 @@
+import logging
+import pickle
+import time
+
+from apscheduler.executors.debug import DebugExecutor
+from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.schedulers.base import BaseScheduler, STATE_PAUSED
+from apscheduler.util import utc_timestamp_to_datetime
+from django.db import close_old_connections, connection, transaction
+
+from scheduler.functions import generate_lease_owner, acquire_lease, release_lease
+from scheduler.jobstores import DjangoJobStore
+from scheduler.models import ScheduledJob
+from scheduler.timing_wheel import TimingWheel, get_weekly_schedule, get_next_weekly_time
+from nalkinscloud_django.metrics import scheduler_job_lag, scheduler_jobs_missed
+from nalkinscloud_django.settings import PROJECT_NAME
+
+# Define logger
+logger = logging.getLogger(PROJECT_NAME)
+
+
+class LeaseSchedulerMixin(object):
+    """
+    Run due jobs only while holding a DB lease (see scheduler.functions.acquire_lease),
+    so with many processes (gunicorn workers, replicas) sharing the same job store,
+    each job runs exactly once, processes not holding the lease only add / remove jobs
+
+    :param str lease_name: name of the lease, processes competing on the same job store must share it
+    :param int lease_ttl: seconds until an un-renewed lease expires (and may be taken over)
+    :param int lease_renew_interval: max seconds between scheduler loops, also the interval
+        a non holding process retries to acquire the lease and picks up jobs added by other processes
+    """
+
+    def __init__(self, lease_name='scheduler', lease_ttl=30, lease_renew_interval=10, **options):
+        self.lease_name = lease_name
+        self.lease_ttl = lease_ttl
+        self.lease_renew_interval = lease_renew_interval
+        self.lease_owner = generate_lease_owner()
+        self.is_lease_holder = False
+        super(LeaseSchedulerMixin, self).__init__(**options)
+
+    def _process_jobs(self):
+        if self.state == STATE_PAUSED:
+            return None
+
+        # Scheduler loop runs on its own thread, make sure it does not use a stale DB connection
+        close_old_connections()
+        try:
+            is_lease_holder = acquire_lease(self.lease_name, self.lease_owner, self.lease_ttl)
+        except Exception as e:
+            logger.warning('Failed to acquire scheduler lease %s: %s', self.lease_name, e)
+            is_lease_holder = False
+
+        if is_lease_holder != self.is_lease_holder:
+            logger.info('Scheduler %s %s lease %s', self.lease_owner,
+                        'acquired' if is_lease_holder else 'lost', self.lease_name)
+            self.is_lease_holder = is_lease_holder
+
+        if not is_lease_holder:
+            return self.lease_renew_interval
+
+        wait_seconds = super(LeaseSchedulerMixin, self)._process_jobs()
+        if wait_seconds is None:
+            # No jobs in store, still wake up to renew the lease and pick up jobs added by other processes
+            return None if self.state == STATE_PAUSED else self.lease_renew_interval
+        return min(wait_seconds, self.lease_renew_interval)
+
+    def shutdown(self, wait=True):
+        super(LeaseSchedulerMixin, self).shutdown(wait)
+        if self.is_lease_holder:
+            release_lease(self.lease_name, self.lease_owner)
+            self.is_lease_holder = False
+
+
+class LeasedBackgroundScheduler(LeaseSchedulerMixin, BackgroundScheduler):
+    pass
+
+
+class JobStoreScheduler(BaseScheduler):
+    """
+    Scheduler that never runs jobs, it only adds, modifies and removes jobs of its job stores,
+    Always started paused, without threads or processes, for processes (gunicorn workers)
+    handing jobs to a process running a LeasedBackgroundScheduler on the same job store,
+    which picks up added jobs within its lease renew interval
+    """
+
+    def start(self, paused=True):
+        super(JobStoreScheduler, self).start(paused=True)
+
+    def resume(self):
+        raise RuntimeError('%s never runs jobs' % self.__class__.__name__)
+
+    def shutdown(self, wait=True):
+        super(JobStoreScheduler, self).shutdown(wait)
+
+    def wakeup(self):
+        pass
+
+    def _create_default_executor(self):
+        return DebugExecutor()  # Never used, jobs are not run
+
+
+class WheelJob(object):
+    """
+    Job held by a LeasedTimingWheelScheduler, with its next run time (UTC timestamp)
+    and weekly schedule (see scheduler.timing_wheel.get_weekly_schedule), None for other triggers
+    """
+    __slots__ = ('job', 'run_time', 'version', 'weekly_schedule')
+
+    def __init__(self, job, run_time, version):
+        self.job = job
+        self.run_time = run_time
+        self.version = version  # modified_at of the job store row the job was loaded from (or last written)
+        self.weekly_schedule = get_weekly_schedule(job.trigger)
+
+
+class LeasedTimingWheelScheduler(object):
+    """
+    Run the jobs of a DjangoJobStore (as added by a JobStoreScheduler) while holding the scheduler lease,
+    jobs are loaded once and kept in memory, bucketed by next run time in a TimingWheel,
+    the job store is then only read for jobs added or modified since the last sync (every lease renew,
+    on the modified_at index) and for the jobs due in a tick, to skip jobs removed or modified meanwhile,
+    and written once per tick for the jobs that ran, only if no other process wrote them since they were loaded
+
+    All jobs due in a tick are passed to 'dispatch_batch' in a single call, next run times of
+    weekly cron jobs are computed in constant time, other triggers by their get_next_fire_time,
+    missed runs are coalesced into one (as with coalesce=True), runs later than the job misfire grace time are skipped
+
+    :param dispatch_batch: function receiving a list of apscheduler.job.Job
+    :param executor: optional concurrent.futures executor batches are submitted to, by default dispatched inline
+    :param str lease_name: name of the lease, see LeaseSchedulerMixin
+    :param int lease_ttl: seconds until an un-renewed lease expires
+    :param int lease_renew_interval: seconds between lease renewals and job store syncs,
+        jobs added or removed by other processes are seen that late
+    :param float tick: seconds per tick, run times are rounded down to a tick
+    :param jobstore: DjangoJobStore
+    """
+    sync_batch_size = 500
+    # Seconds of changes read again on each sync, bounds the commit delay and clock skew of the processes writing jobs
+    sync_overlap = 60
+
+    def __init__(self, dispatch_batch, executor=None, lease_name='scheduler', lease_ttl=30, lease_renew_interval=10,
+                 tick=1.0, jobstore=None):
+        self.dispatch_batch = dispatch_batch
+        self.executor = executor
+        self.lease_name = lease_name
+        self.lease_ttl = lease_ttl
+        self.lease_renew_interval = lease_renew_interval
+        self.lease_owner = generate_lease_owner()
+        self.is_lease_holder = False
+        self.tick = tick
+        self.jobstore = jobstore or DjangoJobStore()
+        self.jobstore.start(None, 'default')
+        self.jobs = {}  # Job id to WheelJob
+        self.wheel = TimingWheel(tick, start=time.time())
+        self.synced_at = None  # Time of the last sync, None loads all jobs on the next sync
+
+    def reset(self, now):
+        self.jobs = {}
+        self.wheel = TimingWheel(self.tick, start=now)
+        self.synced_at = None
+
+    def sync_jobs(self):
+        """
+        Load jobs added or modified in the job store since the last sync (all jobs once the lease is acquired),
+        removed and paused jobs are dropped once due (see run_pending)
+
+        :return: int number of loaded jobs
+        """
+        sync_time = time.time()
+        queryset = ScheduledJob.objects.filter(next_run_time__isnull=False)
+        if self.synced_at is not None:
+            queryset = queryset.filter(modified_at__gte=self.synced_at - self.sync_overlap)
+        changed_ids = [job_id for job_id, version in queryset.values_list('id', 'modified_at')
+                       if job_id not in self.jobs or self.jobs[job_id].version != version]
+        self._load_jobs(changed_ids)
+        self.synced_at = sync_time
+        return len(changed_ids)
+
+    def _load_jobs(self, job_ids):
+        """
+        Load jobs from the job store into the wheel, jobs removed or paused are dropped
+        """
+        for index in range(0, len(job_ids), self.sync_batch_size):
+            batch_ids = job_ids[index:index + self.sync_batch_size]
+            rows = ScheduledJob.objects.filter(id__in=batch_ids, next_run_time__isnull=False)\
+                .values_list('id', 'next_run_time', 'modified_at', 'job_state')
+            loaded_ids = set()
+            for job_id, run_time, version, job_state in rows:
+                try:
+                    job = self.jobstore._reconstitute_job(job_state)
+                except Exception:
+                    logger.exception('Unable to restore job "%s" -- removing it', job_id)
+                    ScheduledJob.objects.filter(id=job_id).delete()
+                    continue
+                item = WheelJob(job, run_time, version)
+                self.jobs[job_id] = item
+                self.wheel.add(run_time, item)
+                loaded_ids.add(job_id)
+            for job_id in batch_ids:
+                if job_id not in loaded_ids:
+                    self.jobs.pop(job_id, None)
+
+    def _get_versions(self, job_ids):
+        """
+        :return: dict of job id -> modified_at, of the jobs still in the job store
+        """
+        versions = {}
+        for index in range(0, len(job_ids), self.sync_batch_size):
+            versions.update(ScheduledJob.objects.filter(id__in=job_ids[index:index + self.sync_batch_size])
+                            .values_list('id', 'modified_at'))
+        return versions
+
+    def run_pending(self, now=None):
+        """
+        Dispatch the jobs due until now, one batch per tick, then write their next run times to the job store
+
+        :param now: float UTC timestamp, current time by default
+        :return: int number of dispatched jobs
+        """
+        now = time.time() if now is None else now
+        dispatched = 0
+        updated_items = []
+        finished_items = []
+        changed_ids = []
+        for tick_time, items in self.wheel.advance(now):
+            # Removed or reloaded since added to the wheel
+            items = [item for item in items if self.jobs.get(item.job.id) is item]
+            # A single read of the due jobs, jobs removed, paused or modified by other processes since loaded
+            # are not run, modified jobs are loaded again
+            versions = self._get_versions([item.job.id for item in items])
+            batch = []
+            for item in items:
+                job = item.job
+                version = versions.get(job.id)
+                if version != item.version:
+                    del self.jobs[job.id]
+                    if version is not None:
+                        changed_ids.append(job.id)
+                    continue
+                lag = now - item.run_time
+                if job.misfire_grace_time is not None and lag > job.misfire_grace_time:
+                    logger.warning('Run time of job %s was missed by %.1f seconds', job.id, lag)
+                    scheduler_jobs_missed.inc()
+                else:
+                    scheduler_job_lag.observe(max(lag, 0))
+                    batch.append(job)
+
+                run_time = self._get_next_run_time(item, now)
+                if run_time is None:
+                    del self.jobs[job.id]
+                    finished_items.append(item)
+                else:
+                    item.run_time = run_time
+                    job.next_run_time = utc_timestamp_to_datetime(run_time)
+                    self.wheel.add(run_time, item)
+                    updated_items.append(item)
+
+            if batch:
+                self._dispatch(batch)
+                dispatched += len(batch)
+
+        self._save_jobs(updated_items, finished_items)
+        self._load_jobs(changed_ids)
+        return dispatched
+
+    def _dispatch(self, batch):
+        try:
+            if self.executor is None:
+                self.dispatch_batch(batch)
+            else:
+                self.executor.submit(self.dispatch_batch, batch)
+        except Exception:
+            logger.exception('Failed to dispatch a batch of %d jobs', len(batch))
+
+    @staticmethod
+    def _get_next_run_time(item, now):
+        """
+        :return: float UTC timestamp of the first run time of the job later than now, None if it has no more runs
+        """
+        trigger = item.job.trigger
+        if item.weekly_schedule is not None:
+            run_time = get_next_weekly_time(now, *item.weekly_schedule)
+            if run_time is None or (trigger.end_date and run_time > trigger.end_date.timestamp()):
+                return None
+            return run_time
+
+        now_date = utc_timestamp_to_datetime(now)
+        fire_time = trigger.get_next_fire_time(utc_timestamp_to_datetime(item.run_time), now_date)
+        while fire_time is not None and fire_time <= now_date:
+            fire_time = trigger.get_next_fire_time(fire_time, now_date)
+        return fire_time.timestamp() if fire_time else None
+
+    def _save_jobs(self, updated_items, finished_items):
+        """
+        Delete the jobs without more runs, and update the others with a single executemany() of one prepared
+        UPDATE statement, avoids compiling the CASE expressions of bulk_update, that grow with the batch,
+        rows are only written if their modified_at is the one loaded (or last written),
+        rows modified meanwhile by other processes are kept and loaded again by the next sync
+        """
+        quote_name = connection.ops.quote_name
+        table_name, id_column, version_column = (quote_name(name) for name in
+                                                 (ScheduledJob._meta.db_table, 'id', 'modified_at'))
+        version = time.time()
+        with transaction.atomic(), connection.cursor() as cursor:
+            if finished_items:
+                cursor.executemany('DELETE FROM %s WHERE %s = %%s AND %s = %%s'
+                                   % (table_name, id_column, version_column),
+                                   [(item.job.id, item.version) for item in finished_items])
+            if updated_items:
+                cursor.executemany('UPDATE %s SET %s = %%s, %s = %%s, %s = %%s WHERE %s = %%s AND %s = %%s'
+                                   % (table_name, quote_name('next_run_time'), quote_name('job_state'),
+                                      version_column, id_column, version_column),
+                                   [(item.run_time, pickle.dumps(item.job.__getstate__(),
+                                                                 self.jobstore.pickle_protocol),
+                                     version, item.job.id, item.version) for item in updated_items])
+        for item in updated_items:
+            item.version = version
+
+    def renew_lease(self, now):
+        """
+        Acquire or renew the scheduler lease, jobs are loaded again from the job store each time it is acquired
+
+        :return: boolean, True if holding the lease
+        """
+        try:
+            is_lease_holder = acquire_lease(self.lease_name, self.lease_owner, self.lease_ttl)
+        except Exception as e:
+            logger.warning('Failed to acquire scheduler lease %s: %s', self.lease_name, e)
+            is_lease_holder = False
+
+        if is_lease_holder != self.is_lease_holder:
+            logger.info('Scheduler %s %s lease %s', self.lease_owner,
+                        'acquired' if is_lease_holder else 'lost', self.lease_name)
+            self.is_lease_holder = is_lease_holder
+            self.reset(now)
+        return is_lease_holder
+
+    def run(self, stop_event):
+        """
+        Run jobs until stop_event is set, then release the lease
+
+        :param stop_event: threading.Event
+        """
+        next_renew_time = 0
+        try:
+            while not stop_event.is_set():
+                now = time.time()
+                try:
+                    if now >= next_renew_time:
+                        close_old_connections()
+                        next_renew_time = now + self.lease_renew_interval
+                        if self.renew_lease(now):
+                            self.sync_jobs()
+                    if self.is_lease_holder:
+                        self.run_pending(now)
+                except Exception:
+                    logger.exception('Scheduler %s loop failed', self.lease_owner)
+                wake_up_time = next_renew_time
+                if self.is_lease_holder:
+                    wake_up_time = min(wake_up_time, (self.wheel.current_tick + 1) * self.tick)
+                stop_event.wait(max(wake_up_time - time.time(), 0))
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
+            if self.is_lease_holder:
+                release_lease(self.lease_name, self.lease_owner)
+                self.is_lease_holder = False
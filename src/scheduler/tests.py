@@ -1,3 +1,303 @@
+import datetime
+import random
+import threading
+
+from apscheduler.job import Job
+from apscheduler.jobstores.base import ConflictingIdError, JobLookupError
+from apscheduler.schedulers.blocking import BlockingScheduler
+from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.date import DateTrigger
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from pytz import utc
+
+from django_user_email_extension.models import User
+from nalkinscloud_api.tasks import add
+from nalkinscloud_mosquitto.models import AccessList, CustomerDevice, Device
+from nalkinscloud_mosquitto.tasks import create_devices, rebuild_access_lists
+from scheduler.celery import app
+from scheduler.functions import acquire_lease, release_lease
+from scheduler.jobstores import DjangoJobStore
+from scheduler.models import ScheduledJob, SchedulerLease
+from scheduler.schedulers import LeasedBackgroundScheduler, JobStoreScheduler, LeasedTimingWheelScheduler
+from scheduler.timing_wheel import TimingWheel, get_next_weekly_time, get_weekdays_mask, get_weekly_schedule
+
+
+def scheduled_test_job():
+    pass
+
+
+class TestDjangoJobStore(TestCase):
+    def setUp(self):
+        self.scheduler = BlockingScheduler(timezone=utc)
+        self.jobstore = DjangoJobStore(due_jobs_batch_size=2)
+        self.jobstore.start(self.scheduler, 'default')
+        self.now = datetime.datetime(2019, 1, 1, 12, 0, 0, tzinfo=utc)
+
+    def create_job(self, job_id, run_date):
+        job = Job(self.scheduler, id=job_id, func=scheduled_test_job, trigger=DateTrigger(run_date, utc),
+                  executor='default', args=(), kwargs={}, name=job_id, misfire_grace_time=1,
+                  coalesce=False, max_instances=1, next_run_time=run_date)
+        self.jobstore.add_job(job)
+        return job
+
+    def test_add_and_lookup_job(self):
+        self.create_job('job_1', self.now)
+        self.assertEqual(ScheduledJob.objects.count(), 1)
+        job = self.jobstore.lookup_job('job_1')
+        self.assertEqual(job.id, 'job_1')
+        self.assertEqual(job.next_run_time, self.now)
+        self.assertIsNone(self.jobstore.lookup_job('non_existing_job'))
+        self.assertRaises(ConflictingIdError, self.create_job, 'job_1', self.now)
+
+    def test_get_due_jobs(self):
+        for minutes in range(3):
+            self.create_job('job_%d' % minutes, self.now + datetime.timedelta(minutes=minutes))
+        self.create_job('future_job', self.now + datetime.timedelta(days=1))
+
+        due_jobs = self.jobstore.get_due_jobs(self.now + datetime.timedelta(minutes=5))
+        self.assertEqual([job.id for job in due_jobs], ['job_0', 'job_1'],
+                         "Should return earliest due jobs, limited to batch size")
+        self.assertEqual(self.jobstore.get_next_run_time(), self.now)
+
+    def test_update_and_remove_job(self):
+        job = self.create_job('job_1', self.now)
+        job._modify(next_run_time=self.now + datetime.timedelta(hours=1))
+        self.jobstore.update_job(job)
+        self.assertEqual(self.jobstore.get_next_run_time(), self.now + datetime.timedelta(hours=1))
+
+        self.jobstore.remove_job('job_1')
+        self.assertIsNone(self.jobstore.get_next_run_time())
+        self.assertRaises(JobLookupError, self.jobstore.remove_job, 'job_1')
+        self.assertRaises(JobLookupError, self.jobstore.update_job, job)
+
+
+class TestSchedulerLease(TestCase):
+    def test_acquire_lease(self):
+        self.assertTrue(acquire_lease('test_lease', 'owner_1', ttl=30))
+        self.assertTrue(acquire_lease('test_lease', 'owner_1', ttl=30), "Should renew lease of current owner")
+        self.assertFalse(acquire_lease('test_lease', 'owner_2', ttl=30), "Should fail, lease held by owner_1")
+
+    def test_acquire_expired_lease(self):
+        self.assertTrue(acquire_lease('test_lease', 'owner_1', ttl=-1))
+        self.assertTrue(acquire_lease('test_lease', 'owner_2', ttl=30), "Should succeed, lease expired")
+        self.assertEqual(SchedulerLease.objects.get(name='test_lease').owner, 'owner_2')
+
+    def test_release_lease(self):
+        self.assertTrue(acquire_lease('test_lease', 'owner_1', ttl=30))
+        self.assertFalse(release_lease('test_lease', 'owner_2'), "Should fail, owner_2 does not hold the lease")
+        self.assertTrue(release_lease('test_lease', 'owner_1'))
+        self.assertTrue(acquire_lease('test_lease', 'owner_2', ttl=30))
+
+    def test_only_lease_holder_processes_jobs(self):
+        first_scheduler = LeasedBackgroundScheduler(lease_name='test_lease', lease_renew_interval=5, timezone=utc)
+        second_scheduler = LeasedBackgroundScheduler(lease_name='test_lease', lease_renew_interval=5, timezone=utc)
+
+        self.assertEqual(first_scheduler._process_jobs(), 5)
+        self.assertTrue(first_scheduler.is_lease_holder)
+        self.assertEqual(second_scheduler._process_jobs(), 5)
+        self.assertFalse(second_scheduler.is_lease_holder, "Should not hold the lease, first scheduler does")
+
+
+class TestJobStoreScheduler(TestCase):
+    def test_only_writes_job_store(self):
+        threads_count = threading.active_count()
+        scheduler = JobStoreScheduler(jobstores={'default': DjangoJobStore()}, timezone=utc)
+        scheduler.start()
+        self.assertEqual(threading.active_count(), threads_count, "Should not start threads")
+
+        run_date = datetime.datetime(2030, 1, 1, 12, 0, 0, tzinfo=utc)
+        scheduler.add_job(scheduled_test_job, 'date', id='job_1', run_date=run_date)
+        self.assertEqual(ScheduledJob.objects.get(id='job_1').next_run_time, run_date.timestamp())
+        self.assertRaises(RuntimeError, scheduler.resume)
+
+        # Due for the scheduler of another process
+        jobstore = DjangoJobStore()
+        jobstore.start(BlockingScheduler(timezone=utc), 'default')
+        self.assertEqual([job.id for job in jobstore.get_due_jobs(run_date)], ['job_1'])
+
+        scheduler.remove_job('job_1')
+        self.assertFalse(ScheduledJob.objects.exists())
+        scheduler.shutdown()
+
+
+class TestTimingWheel(TestCase):
+    def test_next_weekly_time(self):
+        randomizer = random.Random(0)
+        for _ in range(500):
+            weekdays = randomizer.sample(range(7), randomizer.randint(1, 7))
+            hour, minute, second = randomizer.randrange(24), randomizer.randrange(60), randomizer.randrange(60)
+            trigger = CronTrigger(day_of_week=','.join(str(weekday) for weekday in weekdays),
+                                  hour=hour, minute=minute, second=second, timezone=utc)
+            after = datetime.datetime(2019, 1, 1, tzinfo=utc) + datetime.timedelta(
+                seconds=randomizer.randrange(86400 * 400))
+            expected = trigger.get_next_fire_time(None, after + datetime.timedelta(microseconds=1))
+            self.assertEqual(get_next_weekly_time(after.timestamp(), get_weekdays_mask(weekdays),
+                                                  hour * 3600 + minute * 60 + second), expected.timestamp())
+        self.assertIsNone(get_next_weekly_time(0, 0, 0))
+
+    def test_weekly_schedule(self):
+        trigger = CronTrigger(day_of_week='mon,thu', hour=8, minute=30, second=0, timezone=utc)
+        self.assertEqual(get_weekly_schedule(trigger), (get_weekdays_mask([0, 3]), 8 * 3600 + 30 * 60))
+        self.assertEqual(get_weekly_schedule(CronTrigger(hour=8, minute=0, second=0, timezone=utc)),
+                         (get_weekdays_mask(range(7)), 8 * 3600))
+        self.assertEqual(get_weekly_schedule(CronTrigger(day_of_week='mon', timezone=utc)), (1, 0),
+                         "Should match, runs at midnight (fields after day_of_week default to their minimum)")
+        self.assertIsNone(get_weekly_schedule(CronTrigger(day_of_week='mon', hour='*/2', timezone=utc)))
+        self.assertIsNone(get_weekly_schedule(CronTrigger(day='1', hour=8, minute=0, second=0, timezone=utc)))
+        self.assertIsNone(get_weekly_schedule(CronTrigger(hour=8, minute=0, second=0, timezone='Asia/Jerusalem')))
+        self.assertIsNone(get_weekly_schedule(DateTrigger(datetime.datetime(2030, 1, 1, tzinfo=utc), utc)))
+
+    def test_advance(self):
+        # 4 * 4 * 2 ticks, later items wait in the overflow
+        wheel = TimingWheel(tick=0.5, levels=(4, 4, 2), start=0)
+        randomizer = random.Random(0)
+        times = [randomizer.randrange(1, 100) / 2.0 for _ in range(200)]
+        for index, timestamp in enumerate(times):
+            wheel.add(timestamp, index)
+        wheel.add(0, 'expired')
+
+        batches = wheel.advance(10)
+        batches += wheel.advance(49.5)
+        self.assertEqual(batches[0], (0, ['expired']))
+        self.assertEqual([tick_time for tick_time, _ in batches], sorted(set(times) | {0}),
+                         "Should return a batch per tick with items, in order")
+        for tick_time, items in batches[1:]:
+            self.assertEqual(sorted(items), [index for index, timestamp in enumerate(times) if timestamp == tick_time])
+        self.assertEqual(wheel.count, 0)
+        self.assertEqual(wheel.advance(1000), [])
+
+
+class TestLeasedTimingWheelScheduler(TestCase):
+    def setUp(self):
+        self.scheduler = JobStoreScheduler(jobstores={'default': DjangoJobStore()}, timezone=utc)
+        self.scheduler.start()
+        self.run_date = datetime.datetime(2030, 1, 1, 12, 0, 0, tzinfo=utc)  # A tuesday
+        self.batches = []
+        self.runner = LeasedTimingWheelScheduler(self.batches.append, lease_name='test_lease', tick=1.0)
+
+    def tearDown(self):
+        self.scheduler.shutdown()
+
+    def test_run_pending(self):
+        self.scheduler.add_job(scheduled_test_job, 'date', id='date_job', run_date=self.run_date)
+        self.scheduler.add_job(scheduled_test_job, 'cron', id='cron_job', day_of_week='tue,fri', hour=12, minute=0,
+                               second=0, start_date=self.run_date - datetime.timedelta(days=1))
+        self.scheduler.add_job(scheduled_test_job, 'interval', id='interval_job', hours=1, misfire_grace_time=3600,
+                               start_date=self.run_date - datetime.timedelta(minutes=30))
+        self.runner.renew_lease(self.run_date.timestamp() - 60)
+        self.assertTrue(self.runner.is_lease_holder)
+        self.assertEqual(self.runner.sync_jobs(), 3)
+        self.assertEqual(self.runner.sync_jobs(), 0, "Should not load unchanged jobs again")
+
+        self.assertEqual(self.runner.run_pending(self.run_date.timestamp() + 0.5), 3)
+        self.assertEqual(len(self.batches), 2, "Should dispatch a batch per tick")
+        self.assertEqual([job.id for job in self.batches[0]], ['interval_job'])
+        self.assertEqual(sorted(job.id for job in self.batches[1]), ['cron_job', 'date_job'])
+
+        self.assertFalse(ScheduledJob.objects.filter(id='date_job').exists(), "Should remove jobs without more runs")
+        cron_job = self.scheduler.get_job('cron_job')
+        self.assertEqual(cron_job.next_run_time, self.run_date + datetime.timedelta(days=3))
+        self.assertEqual(ScheduledJob.objects.get(id='cron_job').next_run_time,
+                         (self.run_date + datetime.timedelta(days=3)).timestamp())
+        self.assertEqual(self.scheduler.get_job('interval_job').next_run_time,
+                         self.run_date + datetime.timedelta(minutes=30))
+        self.assertEqual(self.runner.sync_jobs(), 0, "Should not load jobs updated by the runner")
+
+    def test_removed_and_missed_jobs(self):
+        self.scheduler.add_job(scheduled_test_job, 'date', id='removed_job', run_date=self.run_date)
+        self.scheduler.add_job(scheduled_test_job, 'date', id='missed_job', run_date=self.run_date,
+                               misfire_grace_time=10)
+        self.runner.renew_lease(self.run_date.timestamp() - 60)
+        self.runner.sync_jobs()
+        self.scheduler.remove_job('removed_job')
+        self.runner.sync_jobs()
+
+        self.assertEqual(self.runner.run_pending(self.run_date.timestamp() + 60), 0)
+        self.assertEqual(self.batches, [])
+        self.assertFalse(ScheduledJob.objects.exists())
+        self.assertEqual(self.runner.jobs, {})
+
+    def test_sync_changed_jobs(self):
+        self.scheduler.add_job(scheduled_test_job, 'date', id='job_1', run_date=self.run_date)
+        self.scheduler.add_job(scheduled_test_job, 'date', id='job_2', run_date=self.run_date)
+        self.runner.renew_lease(self.run_date.timestamp() - 60)
+        self.assertEqual(self.runner.sync_jobs(), 2)
+
+        later_date = self.run_date + datetime.timedelta(minutes=5)
+        self.scheduler.reschedule_job('job_2', trigger='date', run_date=later_date)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.runner.sync_jobs(), 1, "Should only load the modified job")
+        self.assertIn('"modified_at" >=', queries[0]['sql'], "Should only read jobs modified since the last sync")
+        self.assertEqual(self.runner.jobs['job_2'].run_time, later_date.timestamp())
+
+    def test_concurrent_job_changes(self):
+        self.scheduler.add_job(scheduled_test_job, 'cron', id='cron_job', day_of_week='tue', hour=12, minute=0,
+                               second=0, start_date=self.run_date - datetime.timedelta(days=1))
+        self.runner.renew_lease(self.run_date.timestamp() - 60)
+        self.runner.sync_jobs()
+
+        # Modified by another process since loaded, the runner does not run the job, and loads it again
+        later_date = self.run_date + datetime.timedelta(hours=1)
+        self.scheduler.reschedule_job('cron_job', trigger='cron', day_of_week='tue', hour=13, minute=0, second=0,
+                                     start_date=self.run_date - datetime.timedelta(days=1))
+        self.assertEqual(self.runner.run_pending(self.run_date.timestamp() + 0.5), 0)
+        self.assertEqual(ScheduledJob.objects.get(id='cron_job').next_run_time, later_date.timestamp())
+        self.assertEqual(self.runner.jobs['cron_job'].run_time, later_date.timestamp())
+
+        # Modified between the run and the write of its next run time, the write does not overwrite the change
+        item = self.runner.jobs['cron_job']
+        item.run_time = (later_date + datetime.timedelta(days=7)).timestamp()
+        self.scheduler.reschedule_job('cron_job', trigger='cron', day_of_week='tue', hour=14, minute=0, second=0,
+                                     start_date=self.run_date - datetime.timedelta(days=1))
+        self.runner._save_jobs([item], [])
+        self.assertEqual(ScheduledJob.objects.get(id='cron_job').next_run_time,
+                         (later_date + datetime.timedelta(hours=1)).timestamp())
+        self.assertEqual(self.runner.sync_jobs(), 1, "Should load the job modified meanwhile")
+
+    def test_run(self):
+        stop_event = threading.Event()
+        stop_event.set()
+        self.runner.run(stop_event)
+        self.assertFalse(self.runner.is_lease_holder, "Should release the lease")
+
+
+class TestCeleryTasks(TestCase):
+    def test_task_routes(self):
+        def get_queue(task_name):
+            return app.amqp.router.route({}, task_name)['queue'].name
+
+        self.assertEqual(get_queue('nalkinscloud_api.tasks.add'), 'default')
+        self.assertEqual(get_queue('nalkinscloud_mosquitto.tasks.create_devices'), 'slow')
+        self.assertEqual(get_queue('nalkinscloud_api.tasks.send_queued_emails'), 'slow')
+
+    def test_eager_tasks(self):
+        self.assertTrue(app.conf.task_always_eager, "Tests run tasks inline")
+        self.assertEqual(add.delay(1, 2).get(), 3)
+
+    def test_create_devices(self):
+        Device.objects.create_device(device_id='existing_device', password='some_password',
+                                     model_id='esp8266', type_id='dht')
+        result = create_devices.delay(['new_device_1', 'new_device_2', 'existing_device'], 'esp8266', 'dht')
+        self.assertEqual(sorted(result.get()), ['new_device_1', 'new_device_2'])
+        self.assertTrue(Device.objects.get(device_id='new_device_1').has_usable_password())
+        self.assertTrue(Device.objects.get(device_id='existing_device').check_password('some_password'))
+        self.assertEqual(create_devices.delay(['new_device_1'], 'esp8266', 'dht').get(), [])
+
+    def test_slow_tasks_acks_late(self):
+        self.assertTrue(create_devices.acks_late, "Should be re-delivered if a worker dies while running it")
+        self.assertFalse(add.acks_late)
+
+    def test_rebuild_access_lists(self):
+        user = User.objects.create_user(email='acl@nalkins.cloud', password='some_password')
+        Device.objects.create_device(device_id=user.email, password='some_password',
+                                     model_id='application', type_id='user')
+        device = Device.objects.create_device(device_id='acl_device', password='some_password',
+                                              model_id='esp8266', type_id='dht')
+        CustomerDevice.objects.create(user_id=user, device_id=device, device_name='device')
+        AccessList.objects.create(device=device, topic='acl_device/#', rw=2, is_enabled=True)
 
-# Create your tests here.
+        self.assertEqual(rebuild_access_lists.delay(user.pk).get(), 1, "Should only create the missing record")
+        self.assertTrue(AccessList.objects.filter(device_id=user.email, topic='acl_device/#').exists())
+        self.assertEqual(rebuild_access_lists.delay(user.pk).get(), 0)
@@ -0,0 +1,180 @@
+# Dispatch core of scheduler.schedulers.LeasedTimingWheelScheduler: a hierarchical timing wheel bucketing jobs
+# by their next run time, and constant time next run times of weekly cron jobs (as created by the API)
+import datetime
+
+from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.cron.expressions import RangeExpression
+
+SECONDS_PER_DAY = 86400
+# 1970-01-01 was a thursday, weekdays are numbered from monday (0) as in APScheduler
+EPOCH_WEEKDAY = 3
+# A monday, used to evaluate the weekdays of a cron 'day_of_week' field
+REFERENCE_WEEK = [datetime.datetime(2024, 1, 1 + weekday) for weekday in range(7)]
+
+
+def build_next_day_offsets():
+    """
+    :return: list indexed by weekdays mask (bit 0 is monday) of lists indexed by weekday,
+        of the number of days (1 to 7) until the next weekday of the mask, 0 for an empty mask
+    """
+    return [[next((days for days in range(1, 8) if mask & (1 << (weekday + days) % 7)), 0)
+             for weekday in range(7)] for mask in range(128)]
+
+
+NEXT_DAY_OFFSETS = build_next_day_offsets()
+
+
+def get_weekdays_mask(weekdays):
+    """
+    :param weekdays: iterable of ints, 0 (monday) to 6 (sunday)
+    :return: int, bit 0 is monday
+    """
+    return sum(1 << weekday for weekday in set(weekdays))
+
+
+def get_next_weekly_time(after, weekdays_mask, time_of_day):
+    """
+    Return the first time later than 'after' on one of the weekdays of the mask at 'time_of_day' (UTC),
+    in constant time, the days until the next weekday are looked up in NEXT_DAY_OFFSETS
+
+    :param after: float UTC timestamp
+    :param weekdays_mask: int, bit 0 is monday
+    :param time_of_day: int seconds since midnight
+    :return: float UTC timestamp, None for an empty mask
+    """
+    day = int(after // SECONDS_PER_DAY)
+    weekday = (day + EPOCH_WEEKDAY) % 7
+    if weekdays_mask & (1 << weekday) and day * SECONDS_PER_DAY + time_of_day > after:
+        return float(day * SECONDS_PER_DAY + time_of_day)
+    offset = NEXT_DAY_OFFSETS[weekdays_mask][weekday]
+    if not offset:
+        return None
+    return float((day + offset) * SECONDS_PER_DAY + time_of_day)
+
+
+def get_single_value(field):
+    """
+    :return: int, value of a cron field matching a single value, None if it matches more
+    """
+    if len(field.expressions) != 1:
+        return None
+    expression = field.expressions[0]
+    if type(expression) is not RangeExpression or expression.step or expression.first != expression.last:
+        return None
+    return expression.first
+
+
+def get_weekly_schedule(trigger):
+    """
+    Return the weekdays and time of day of a UTC cron trigger firing once a day at a fixed time on some weekdays
+    (as created by nalkinscloud_api.scheduler.schedule_new_job), None for any other trigger
+
+    :param trigger: APScheduler trigger
+    :return: tuple of (weekdays mask, seconds since midnight) or None
+    """
+    if not isinstance(trigger, CronTrigger) or trigger.jitter or getattr(trigger.timezone, 'zone', None) != 'UTC':
+        return None
+    fields = {field.name: field for field in trigger.fields}
+    if not all(fields[name].is_default for name in ('year', 'month', 'day', 'week')):
+        return None
+    hour, minute, second = (get_single_value(fields[name]) for name in ('hour', 'minute', 'second'))
+    if hour is None or minute is None or second is None:
+        return None
+    day_of_week = fields['day_of_week']
+    weekdays_mask = get_weekdays_mask(weekday for weekday, date in enumerate(REFERENCE_WEEK)
+                                      if day_of_week.get_next_value(date) == weekday)
+    return weekdays_mask, hour * 3600 + minute * 60 + second
+
+
+class TimingWheel(object):
+    """
+    Hierarchical timing wheel of items keyed by their time, adding an item and collecting the items of a tick
+    cost O(1), amortized over the cascades of higher levels (each item moves down at most once per level)
+
+    Level 0 has a slot per tick, a slot of level i spans a whole rotation of level i - 1,
+    items beyond the top level rotation wait in an overflow list and are added again once the wheel reaches them,
+    removed items are not looked up, owners skip the items they no longer hold when collected
+
+    :param float tick: seconds per slot of level 0
+    :param tuple levels: number of slots of each level, by default 64 ** 4 ticks (194 days of 1 second ticks)
+    :param float start: timestamp of the current tick
+    """
+
+    def __init__(self, tick=1.0, levels=(64, 64, 64, 64), start=0.0):
+        self.tick = tick
+        self.levels = levels
+        self.spans = []  # Ticks of a slot, per level
+        span = 1
+        for slots_count in levels:
+            self.spans.append(span)
+            span *= slots_count
+        self.horizon = span
+        self.slots = [[[] for _ in range(slots_count)] for slots_count in levels]
+        self.overflow = []
+        self.expired = []  # Items added at or before the current tick, collected on the next advance
+        self.current_tick = self.get_tick(start)
+        self.count = 0
+
+    def get_tick(self, timestamp):
+        return int(timestamp // self.tick)
+
+    def add(self, timestamp, item):
+        self._add(self.get_tick(timestamp), item)
+        self.count += 1
+
+    def _add(self, tick, item):
+        if tick <= self.current_tick:
+            self.expired.append(item)
+            return
+        for level, slots_count in enumerate(self.levels):
+            rotation = self.spans[level] * slots_count
+            # Lowest level whose current rotation includes tick
+            if tick // rotation == self.current_tick // rotation:
+                self.slots[level][(tick // self.spans[level]) % slots_count].append((tick, item))
+                return
+        self.overflow.append((tick, item))
+
+    def advance(self, timestamp):
+        """
+        Move the wheel to the tick of timestamp
+
+        :param timestamp: float
+        :return: list of (tick time, list of items due at that tick), in tick order
+        """
+        batches = []
+        remaining = self.count
+        if self.expired:
+            batches.append((self.current_tick * self.tick, self.expired))
+            remaining -= len(self.expired)
+            self.expired = []
+        target = self.get_tick(timestamp)
+        while self.current_tick < target:
+            if not remaining:
+                self.current_tick = target  # Nothing left, skip the empty ticks
+                break
+            self.current_tick += 1
+            items = self._step()
+            if items:
+                batches.append((self.current_tick * self.tick, items))
+                remaining -= len(items)
+        self.count = remaining
+        return batches
+
+    def _step(self):
+        tick = self.current_tick
+        if tick % self.horizon == 0:
+            overflow, self.overflow = self.overflow, []
+            for item_tick, item in overflow:
+                self._add(item_tick, item)
+        # Entering a slot of a higher level moves its items down, from the top so they may move again
+        for level in range(len(self.levels) - 1, 0, -1):
+            if tick % self.spans[level] == 0:
+                slot_index = (tick // self.spans[level]) % self.levels[level]
+                slot, self.slots[level][slot_index] = self.slots[level][slot_index], []
+                for item_tick, item in slot:
+                    self._add(item_tick, item)
+        slot_index = tick % self.levels[0]
+        slot, self.slots[0][slot_index] = self.slots[0][slot_index], []
+        items = self.expired + [item for _, item in slot]
+        self.expired = []
+        return items
@@ -1,15 +1,31 @@
 
+from django.core import mail
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.utils.crypto import get_random_string
 from django.urls import reverse
 from django.utils import timezone
 
+from prometheus_client import REGISTRY
 from rest_framework.test import APITestCase
 from oauth2_provider.models import AccessToken
 from oauth2_provider.models import Application
 
-from nalkinscloud_mosquitto.models import Device, DeviceType, DeviceModel, CustomerDevice
+from nalkinscloud_api.authentication import access_token_cache
+from nalkinscloud_api.email_queue import send_queued_emails
+from nalkinscloud_api.models import OutboundEmail
+from nalkinscloud_mosquitto.acl import MQTT_ACCESS_READ, MQTT_ACCESS_WRITE
+from nalkinscloud_mosquitto.functions import get_customers_device_list, is_topic_allowed
+from nalkinscloud_mosquitto.ingestion import IngestedMessage
+from nalkinscloud_mosquitto.last_values import last_value_store
+from nalkinscloud_mosquitto.models import Device, DeviceType, DeviceModel, CustomerDevice, AccessList, Message, \
+    MessageRollup
 from django_user_email_extension.models import User
+from scheduler.models import ScheduledJob
 import datetime
+import json
+import time
 import logging
 from nalkinscloud_django.settings import PROJECT_NAME
 
@@ -19,6 +35,9 @@ logger = logging.getLogger(PROJECT_NAME)
 
 class APIViewsTestCase(APITestCase):
     def setUp(self):
+        cache.clear()
+        access_token_cache.clear()
+
         # Create OAuth application
         self.oauth_client_id = 'some_client_id'
         self.oauth_client_secret = 'some_client_secret'
@@ -71,11 +90,21 @@ class APIViewsTestCase(APITestCase):
         self.health_check_url = reverse('nalkinscloud_api:health_check')
         self.registration_url = reverse('nalkinscloud_api:register')
         self.device_activation_url = reverse('nalkinscloud_api:device_activation')
+        self.device_activation_bulk_url = reverse('nalkinscloud_api:device_activation_bulk')
+        self.remove_device_bulk_url = reverse('nalkinscloud_api:remove_device_bulk')
         self.device_list_url = reverse('nalkinscloud_api:device_list')
+        self.device_list_page_url = reverse('nalkinscloud_api:device_list_page')
+        self.device_rollups_url = reverse('nalkinscloud_api:device_rollups')
+        self.device_messages_url = reverse('nalkinscloud_api:device_messages')
+        self.devices_state_url = reverse('nalkinscloud_api:devices_state')
+        self.device_share_url = reverse('nalkinscloud_api:device_share')
+        self.device_unshare_url = reverse('nalkinscloud_api:device_unshare')
+        self.device_members_url = reverse('nalkinscloud_api:device_members')
         self.forgot_password_url = reverse('nalkinscloud_api:forgot_password')
         self.get_device_pass_url = reverse('nalkinscloud_api:get_device_pass')
         self.remove_device_url = reverse('nalkinscloud_api:remove_device')
         self.reset_password_url = reverse('nalkinscloud_api:reset_password')
+        self.set_scheduled_job_url = reverse('nalkinscloud_api:set_scheduled_job')
         self.update_device_pass_url = reverse('nalkinscloud_api:update_device_pass')
 
     def test_registration(self):
@@ -104,6 +133,11 @@ class APIViewsTestCase(APITestCase):
 
         self.assertEqual(User.objects.count(), 2, "Two users should be present in the system by this point")
 
+        self.assertEqual(len(mail.outbox), 0, "Should not send email inside the request")
+        email = OutboundEmail.objects.get()
+        self.assertEqual((email.to_email, email.status), ('arielev@nalkins.cloud', OutboundEmail.STATUS_PENDING))
+        self.assertIn(str(User.objects.get(email='arielev@nalkins.cloud').get_uuid_of_email()), email.body)
+
     def test_health_check_view(self):
         """
         Test Health Check view
@@ -113,6 +147,79 @@ class APIViewsTestCase(APITestCase):
         logger.debug('test_health_check_view response: ' + str(response.json()))
         self.assertEqual(200, response.status_code, "Should return username")
 
+    def test_metrics(self):
+        """
+        Test case that requests are observed per view and exported on /metrics/
+        :return:
+        """
+        labels = {'view': 'nalkinscloud_api:health_check', 'method': 'POST', 'status': '200'}
+        before = REGISTRY.get_sample_value('http_responses_total', labels) or 0
+        self.client.post(self.health_check_url)
+        self.client.post(self.health_check_url)
+        self.assertEqual(REGISTRY.get_sample_value('http_responses_total', labels), before + 2)
+        self.assertIsNotNone(REGISTRY.get_sample_value('http_request_db_queries_count',
+                                                       {'view': 'nalkinscloud_api:health_check'}))
+
+        self.client.get('/non/existing/url/')
+        self.assertIsNotNone(REGISTRY.get_sample_value('http_responses_total',
+                                                       {'view': '<unresolved>', 'method': 'GET', 'status': '404'}))
+
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(200, response.status_code)
+        self.assertIn(b'http_request_duration_seconds_bucket{', response.content)
+
+    def test_metrics_allowed_networks(self):
+        """
+        Test case that without a token metrics are only served to requests from the allowed networks
+        :return:
+        """
+        response = self.client.get(reverse('metrics'), REMOTE_ADDR='10.1.2.3')
+        self.assertEqual(200, response.status_code, "Should return 200, called from a private network")
+        response = self.client.get(reverse('metrics'), REMOTE_ADDR='8.8.8.8')
+        self.assertEqual(403, response.status_code, "Should return 403, called from a public address")
+        response = self.client.get(reverse('metrics'), HTTP_X_FORWARDED_FOR='8.8.8.8')
+        self.assertEqual(403, response.status_code, "Should return 403, relayed by a reverse proxy")
+
+    def test_cached_authentication(self):
+        """
+        Test case that authenticates a known token without queries, until it is revoked
+        :return:
+        """
+        self.client.post(self.health_check_url)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(self.health_check_url)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(len(queries), 0, "Should authenticate from cache")
+
+        self.access_token.revoke()
+        response = self.client.post(self.health_check_url)
+        self.assertEqual(401, response.status_code, "Should reject a revoked token")
+
+    def test_cached_authentication_user_change(self):
+        """
+        Test case that cached tokens of a user are forgotten once the user changes
+        :return:
+        """
+        self.client.post(self.health_check_url)
+        self.assertEqual(len(access_token_cache), 1)
+        self.user.first_name = 'changed'
+        self.user.save()
+        self.assertEqual(len(access_token_cache), 0)
+
+        response = self.client.post(self.health_check_url)
+        self.assertEqual(200, response.status_code)
+
+    def test_cached_authentication_expired(self):
+        """
+        Test case that a cached token is not used once expired
+        :return:
+        """
+        self.access_token.expires = timezone.now() + datetime.timedelta(seconds=1)
+        self.access_token.save()
+        self.assertEqual(200, self.client.post(self.health_check_url).status_code)
+        time.sleep(1)
+        self.assertEqual(401, self.client.post(self.health_check_url).status_code)
+
     def test_device_activation_view_204(self):
         """
         Test case when trying to attach a device that does not exists
@@ -224,6 +331,302 @@ class APIViewsTestCase(APITestCase):
         self.assertEqual(200, response.status_code, "Should return devices list")
         CustomerDevice.objects.filter(user_id=self.user, device_id=self.user_device).delete()
 
+    def test_device_list_view_constant_queries(self):
+        """
+        Test case that device list query count does not depend on the number of devices
+        :return:
+        """
+        def count_device_list_queries():
+            cache.clear()
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.post(self.device_list_url)
+            self.assertEqual(200, response.status_code)
+            return len(queries), len(response.json()['message'])
+
+        self.client.post(self.health_check_url)  # Cache the access token, so each request authenticates alike
+        CustomerDevice.objects.create(user_id=self.user, device_id=self.device, device_name='device_0')
+        queries_count, devices_count = count_device_list_queries()
+        self.assertEqual(devices_count, 1)
+
+        for index in range(1, 20):
+            device = Device.objects.create_device(device_id='device_list_test_%d' % index,
+                                                  password=self.device_password,
+                                                  model=DeviceModel.objects.get(model=self.device_model),
+                                                  type=DeviceType.objects.get(type=self.device_type))
+            CustomerDevice.objects.create(user_id=self.user, device_id=device, device_name='device_%d' % index)
+
+        self.assertEqual(count_device_list_queries(), (queries_count, 20),
+                         "Should run the same number of queries for 1 and 20 devices")
+
+        response = self.client.post(self.device_list_url)
+        self.assertEqual(response.json()['message'][0], {'device_id': self.device_id,
+                                                         'device_name': 'device_0',
+                                                         'device_type': self.device_type,
+                                                         'role': 'owner'})
+
+    def test_device_list_page_view_200(self):
+        """
+        Test case that walks all pages of a filtered, sparse device listing
+        :return:
+        """
+        CustomerDevice.objects.create(user_id=self.user, device_id=self.user_device, device_name='user_device')
+        for index in range(5):
+            device = Device.objects.create_device(device_id='device_page_test_%d' % index,
+                                                  password=self.device_password,
+                                                  model=DeviceModel.objects.get(model=self.device_model),
+                                                  type=DeviceType.objects.get(type=self.device_type))
+            CustomerDevice.objects.create(user_id=self.user, device_id=device, device_name='device_%d' % index)
+
+        results = []
+        url = self.device_list_page_url + '?page_size=2&device_type=dht&fields=device_id,device_model'
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(200, response.status_code, "Should return devices page")
+            page = response.json()['message']
+            self.assertLessEqual(len(page['results']), 2)
+            results += page['results']
+            url = page['next']
+
+        self.assertEqual(results, [{'device_id': 'device_page_test_%d' % index, 'device_model': self.device_model}
+                                   for index in range(5)])
+
+        response = self.client.get(self.device_list_page_url)
+        self.assertEqual(len(response.json()['message']['results']), 6)
+        self.assertEqual(set(response.json()['message']['results'][0]),
+                         {'device_id', 'device_name', 'device_type', 'device_model', 'date_created', 'role'})
+
+    def test_device_list_page_view_400(self):
+        """
+        Test case that should fail on unknown sparse field
+        :return:
+        """
+        response = self.client.get(self.device_list_page_url + '?fields=device_id,password')
+        self.assertEqual(400, response.status_code, "Should reject unknown fields")
+
+    def create_test_devices(self, count):
+        return [Device.objects.create_device(device_id='bulk_test_device_%d' % index, password=self.device_password,
+                                             model=DeviceModel.objects.get(model=self.device_model),
+                                             type=DeviceType.objects.get(type=self.device_type)).device_id
+                for index in range(count)]
+
+    def test_device_activation_bulk_view_200(self):
+        """
+        Test case that activates a batch of devices and reports each device result
+        :return:
+        """
+        device_ids = self.create_test_devices(3)
+        other_user = User.objects.create_user(email='other@nalkins.cloud', password=self.password, is_active=True)
+        CustomerDevice.objects.create(user_id=other_user, device_id=Device.objects.get(device_id=device_ids[2]),
+                                      device_name='other')
+        CustomerDevice.objects.create(user_id=self.user, device_id=self.device, device_name='existing')
+
+        devices = [{'device_id': device_id, 'device_name': 'bulk'} for device_id in device_ids]
+        devices += [{'device_id': self.device_id, 'device_name': 'existing'},
+                    {'device_id': 'non_existing_device', 'device_name': 'bulk'}]
+        response = self.client.post(self.device_activation_bulk_url, {'devices': devices}, format='json')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([(item['device_id'], item['status']) for item in response.json()['message']],
+                         [(device_ids[0], 'success'), (device_ids[1], 'success'), (device_ids[2], 'failed'),
+                          (self.device_id, 'success'), ('non_existing_device', 'failed')])
+
+        for device_id in device_ids[:2]:
+            self.assertTrue(CustomerDevice.objects.filter(user_id=self.user, device_id=device_id).exists())
+            self.assertTrue(is_topic_allowed(device_id, device_id + '/status', MQTT_ACCESS_WRITE))
+            self.assertTrue(is_topic_allowed(self.user_device_id, device_id + '/status', MQTT_ACCESS_READ))
+        self.assertFalse(CustomerDevice.objects.filter(user_id=self.user, device_id=device_ids[2]).exists())
+        self.assertEqual(len(get_customers_device_list(self.user)), 3)
+
+    def test_device_activation_bulk_view_constant_queries(self):
+        """
+        Test case that bulk activation query count does not depend on the number of devices
+        :return:
+        """
+        device_ids = self.create_test_devices(21)
+        self.client.post(self.health_check_url)  # Cache the access token, so each request authenticates alike
+
+        def count_activation_queries(ids):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.post(self.device_activation_bulk_url,
+                                            {'devices': [{'device_id': device_id, 'device_name': 'bulk'}
+                                                         for device_id in ids]}, format='json')
+            self.assertEqual(200, response.status_code)
+            return len(queries)
+
+        self.assertEqual(count_activation_queries(device_ids[:1]), count_activation_queries(device_ids[1:]),
+                         "Should run the same number of queries for 1 and 20 devices")
+
+    def test_device_activation_bulk_view_400(self):
+        """
+        Test case that should fail on an empty devices list
+        :return:
+        """
+        response = self.client.post(self.device_activation_bulk_url, {'devices': []}, format='json')
+        self.assertEqual(400, response.status_code, "Should reject empty devices list")
+
+    def test_remove_device_bulk_view_200(self):
+        """
+        Test case that removes a batch of devices, only owned devices are removed
+        :return:
+        """
+        device_ids = self.create_test_devices(3)
+        response = self.client.post(self.device_activation_bulk_url,
+                                    {'devices': [{'device_id': device_id, 'device_name': 'bulk'}
+                                                 for device_id in device_ids[:2]]}, format='json')
+        self.assertEqual(200, response.status_code)
+
+        response = self.client.post(self.remove_device_bulk_url, {'device_ids': device_ids}, format='json')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([item['status'] for item in response.json()['message']], ['success', 'success', 'failed'])
+
+        self.assertFalse(CustomerDevice.objects.filter(user_id=self.user).exists())
+        self.assertFalse(AccessList.objects.filter(topic__in=[device_id + '/#' for device_id in device_ids]).exists())
+        self.assertFalse(is_topic_allowed(self.user_device_id, device_ids[0] + '/status', MQTT_ACCESS_READ))
+        self.assertFalse(Device.objects.get(device_id=device_ids[0]).has_usable_password())
+        self.assertTrue(Device.objects.get(device_id=device_ids[2]).check_password(self.device_password))
+
+    def test_device_rollups_view_200(self):
+        """
+        Test case that returns hourly rollups of an owned device
+        :return:
+        """
+        CustomerDevice.objects.create(user_id=self.user, device_id=self.device, device_name='device')
+        bucket_start = datetime.datetime(2019, 4, 17, 17, tzinfo=datetime.timezone.utc)
+        MessageRollup.objects.create(device=self.device, topic=self.device_id + '/temperature', resolution='1h',
+                                     bucket_start=bucket_start, count=2, sum=40, min=19, max=21)
+
+        response = self.client.get(self.device_rollups_url, {'device_id': self.device_id,
+                                                             'topic': self.device_id + '/temperature',
+                                                             'resolution': '1h',
+                                                             'start': '2019-04-17T00:00:00Z',
+                                                             'end': '2019-04-18T00:00:00Z'})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(response.json()['message'], [{'bucket_start': '2019-04-17T17:00:00Z', 'count': 2,
+                                                       'min': 19.0, 'max': 21.0, 'avg': 20.0}])
+
+    def test_device_rollups_view_409(self):
+        """
+        Test case that should fail on a device not owned by the user
+        :return:
+        """
+        response = self.client.get(self.device_rollups_url, {'device_id': self.device_id, 'topic': 'some/topic',
+                                                             'resolution': '1h', 'start': '2019-04-17T00:00:00Z',
+                                                             'end': '2019-04-18T00:00:00Z'})
+        self.assertEqual(409, response.status_code)
+
+    def test_device_rollups_view_400(self):
+        """
+        Test case that should fail on a range with too many points
+        :return:
+        """
+        response = self.client.get(self.device_rollups_url, {'device_id': self.device_id, 'topic': 'some/topic',
+                                                             'resolution': '1m', 'start': '2019-01-01T00:00:00Z',
+                                                             'end': '2019-04-18T00:00:00Z'})
+        self.assertEqual(400, response.status_code)
+
+    def create_device_messages(self):
+        date = datetime.datetime(2019, 4, 17, 17, tzinfo=datetime.timezone.utc)
+        for value in range(3):
+            Message.objects.create(device=self.device, topic=self.device_id + '/temperature', message=str(value),
+                                   qos=0, date_created=date + datetime.timedelta(minutes=value))
+
+    def test_device_messages_view_200(self):
+        """
+        Test case that streams the messages of an owned device as json
+        :return:
+        """
+        CustomerDevice.objects.create(user_id=self.user, device_id=self.device, device_name='device')
+        self.create_device_messages()
+
+        response = self.client.get(self.device_messages_url, {'device_id': self.device_id,
+                                                              'start': '2019-04-17T17:01:00Z',
+                                                              'end': '2019-04-18T00:00:00Z'})
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(response.streaming)
+        body = json.loads(b''.join(response.streaming_content))
+        self.assertEqual(body['status'], 'success')
+        self.assertEqual(body['message'], [
+            {'topic': self.device_id + '/temperature', 'message': '1', 'qos': 0, 'date_created': '2019-04-17T17:01:00Z'},
+            {'topic': self.device_id + '/temperature', 'message': '2', 'qos': 0, 'date_created': '2019-04-17T17:02:00Z'},
+        ])
+
+    def test_device_messages_view_ndjson(self):
+        """
+        Test case that streams the messages of an owned device, one json object per line
+        :return:
+        """
+        CustomerDevice.objects.create(user_id=self.user, device_id=self.device, device_name='device')
+        self.create_device_messages()
+
+        response = self.client.get(self.device_messages_url, {'device_id': self.device_id, 'output': 'ndjson',
+                                                              'start': '2019-04-17T00:00:00Z',
+                                                              'end': '2019-04-18T00:00:00Z'})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual([json.loads(line)['message'] for line in lines], ['0', '1', '2'])
+
+    def test_device_messages_view_409(self):
+        """
+        Test case that should fail on a device not owned by the user
+        :return:
+        """
+        self.create_device_messages()
+        response = self.client.get(self.device_messages_url, {'device_id': self.device_id,
+                                                              'start': '2019-04-17T00:00:00Z',
+                                                              'end': '2019-04-18T00:00:00Z'})
+        self.assertEqual(409, response.status_code)
+
+    def test_device_messages_view_400(self):
+        """
+        Test case that should fail on a range longer than allowed
+        :return:
+        """
+        response = self.client.get(self.device_messages_url, {'device_id': self.device_id,
+                                                              'start': '2018-01-01T00:00:00Z',
+                                                              'end': '2019-04-18T00:00:00Z'})
+        self.assertEqual(400, response.status_code)
+
+    def test_devices_state_view(self):
+        """
+        Test case that returns the last values of the user devices, without querying messages
+        :return:
+        """
+        last_value_store.client.flushdb()
+        CustomerDevice.objects.create(user_id=self.user, device_id=self.device, device_name='device')
+        last_value_store.update([IngestedMessage(self.device_id, self.device_id + '/temperature', '21', 0,
+                                                 datetime.datetime(2019, 4, 17, 17, tzinfo=datetime.timezone.utc))])
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.devices_state_url)
+        self.assertEqual(200, response.status_code)
+        self.assertFalse(any('"messages"' in query['sql'] for query in queries))
+        self.assertEqual(response.json()['message'], [{
+            'device_id': self.device_id, 'device_name': 'device', 'device_type': self.device_type, 'role': 'owner',
+            'state': {self.device_id + '/temperature': {'message': '21', 'date_created': '2019-04-17T17:00:00Z'}},
+        }])
+
+    def test_devices_view(self):
+        """
+        Test case that renders the devices page with the default (in process) last value store
+        :return:
+        """
+        CustomerDevice.objects.create(user_id=self.user, device_id=self.device, device_name='device')
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('nalkinscloud_api:devices'))
+        self.assertEqual(200, response.status_code)
+        self.assertContains(response, 'device')
+
+    def test_devices_state_view_store_empty(self):
+        """
+        Test case when the last value store holds no values (for example in memory, outside the ingesting process)
+        :return:
+        """
+        last_value_store.client.flushdb()
+        CustomerDevice.objects.create(user_id=self.user, device_id=self.device, device_name='device')
+        response = self.client.get(self.devices_state_url)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(response.json()['message'][0]['state'], {})
+
     def test_forgot_password_view_400(self):
         """
         Test case when no data provided
@@ -270,6 +673,11 @@ class APIViewsTestCase(APITestCase):
         response = self.client.post(self.forgot_password_url, data=post_data, format='json')
         logger.debug('test_forgot_password_view_200_2 response: ' + str(response.json()))
         self.assertEqual(200, response.status_code, "Should return 200, process completed")
+        self.assertEqual(len(mail.outbox), 0, "Should not send email inside the request")
+        self.assertEqual(OutboundEmail.objects.get().to_email, self.user.email)
+
+        self.assertEqual(send_queued_emails(), (1, 0))
+        self.assertEqual(mail.outbox[0].to, [self.user.email])
 
     def test_get_device_pass_view_400(self):
         """
@@ -327,6 +735,66 @@ class APIViewsTestCase(APITestCase):
         response = self.client.post(self.get_device_pass_url, data=post_data)
         self.assertEqual(200, response.status_code, "Should return 200, process succeeded")
 
+    def share_device_with_user(self, role):
+        """
+        Make the current user a member (with role) of the test device, owned by another user
+        :return:
+        """
+        owner = User.objects.create_user(email='owner@nalkins.cloud', password=self.password, is_active=True)
+        CustomerDevice.objects.create(user_id=owner, device_id=self.device)
+        CustomerDevice.objects.create(user_id=self.user, device_id=self.device, role=role)
+
+    def test_get_device_pass_view_operator(self):
+        """
+        Test case when a member that is not an owner (an operator) requests the device password
+        :return:
+        """
+        self.share_device_with_user(CustomerDevice.ROLE_OPERATOR)
+        response = self.client.post(self.get_device_pass_url, data={'device_id': self.device_id})
+        self.assertEqual(409, response.status_code, "Should return 409, since only owners may reset the password")
+        self.assertTrue(Device.objects.get(device_id=self.device_id).check_password(self.device_password))
+
+    def test_get_device_pass_view_viewer(self):
+        """
+        Test case when a viewer of a shared device requests the device password
+        :return:
+        """
+        self.share_device_with_user(CustomerDevice.ROLE_VIEWER)
+        response = self.client.post(self.get_device_pass_url, data={'device_id': self.device_id})
+        self.assertEqual(409, response.status_code, "Should return 409, since only owners may reset the password")
+
+    def get_scheduled_job_data(self):
+        return {
+            'app_params': {'device_id': self.device_id, 'topic': self.device_id + '/switch'},
+            'repeated_job': {'repeat_job': False,
+                             'repeat_days': {'sunday': False, 'monday': False, 'tuesday': False, 'wednesday': False,
+                                             'thursday': False, 'friday': False, 'saturday': False}},
+            'job_action': True,
+            'start_date_time': {'start_date_time_selected': True,
+                                'start_date_time_values': '2030-01-01 12:00:00+0200'},
+            'end_date_time': {'end_date_time_selected': False, 'end_date_time_values': '2030-01-01 12:00:00+0200'},
+        }
+
+    def test_set_scheduled_job_view_viewer(self):
+        """
+        Test case when a viewer of a shared device sets a job, viewers may not publish to the device
+        :return:
+        """
+        self.share_device_with_user(CustomerDevice.ROLE_VIEWER)
+        response = self.client.post(self.set_scheduled_job_url, data=self.get_scheduled_job_data(), format='json')
+        self.assertEqual(response.json(), {'status': 'failed', 'message': 'You cannot set new job for this device'})
+        self.assertFalse(ScheduledJob.objects.exists())
+
+    def test_set_scheduled_job_view_operator(self):
+        """
+        Test case when an operator of a shared device sets a job
+        :return:
+        """
+        self.share_device_with_user(CustomerDevice.ROLE_OPERATOR)
+        response = self.client.post(self.set_scheduled_job_url, data=self.get_scheduled_job_data(), format='json')
+        self.assertEqual(response.json()['status'], 'success')
+        self.assertTrue(ScheduledJob.objects.filter(id=response.json()['message']).exists())
+
     def test_remove_device_view_400(self):
         """
         Test case when no data received
@@ -360,6 +828,44 @@ class APIViewsTestCase(APITestCase):
         logger.debug('test_remove_device_view_409_200 response: ' + str(response.json()))
         self.assertEqual(200, response.status_code, "Should return 200, since device owned by current user")
 
+    def test_device_share_view(self):
+        """
+        Test case that shares a device with a viewer, that may only read the device topics
+        :return:
+        """
+        member_email = 'member@nalkins.cloud'
+        member = User.objects.create_user(email=member_email, password=self.password, is_active=True)
+        Device.objects.create_device(device_id=member_email, password=self.device_password,
+                                     model=DeviceModel.objects.get(model=self.user_device_model),
+                                     type=DeviceType.objects.get(type=self.user_device_type))
+        post_data = {'device_id': self.device_id, 'email': member_email, 'role': 'viewer'}
+
+        response = self.client.post(self.device_share_url, data=post_data)
+        self.assertEqual(409, response.status_code, "Should return 409, since device is not owned by current user")
+
+        CustomerDevice.objects.create(user_id=self.user, device_id=self.device, device_name='shared')
+        response = self.client.post(self.device_share_url, data=dict(post_data, role='admin'))
+        self.assertEqual(400, response.status_code, "Should return 400, since role is not valid")
+        response = self.client.post(self.device_share_url, data=dict(post_data, email='missing@nalkins.cloud'))
+        self.assertEqual(204, response.status_code, "Should return 204, since user does not exist")
+
+        response = self.client.post(self.device_share_url, data=post_data)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(get_customers_device_list(member), [{'device_id': self.device_id, 'device_name': 'shared',
+                                                              'device_type': self.device_type, 'role': 'viewer'}])
+        self.assertTrue(is_topic_allowed(member_email, self.device_id + '/status', MQTT_ACCESS_READ))
+        self.assertFalse(is_topic_allowed(member_email, self.device_id + '/status', MQTT_ACCESS_WRITE))
+
+        response = self.client.post(self.device_members_url, data={'device_id': self.device_id})
+        self.assertEqual(response.json()['message'], [{'email': self.email, 'role': 'owner'},
+                                                      {'email': member_email, 'role': 'viewer'}])
+
+        response = self.client.post(self.device_unshare_url, data={'device_id': self.device_id, 'email': self.email})
+        self.assertEqual(409, response.status_code, "Should return 409, since the last owner cannot be removed")
+        response = self.client.post(self.device_unshare_url, data={'device_id': self.device_id, 'email': member_email})
+        self.assertEqual(200, response.status_code)
+        self.assertFalse(is_topic_allowed(member_email, self.device_id + '/status', MQTT_ACCESS_READ))
+
     def test_reset_password_view_400(self):
         """
         Test case when no data received
@@ -399,6 +905,21 @@ class APIViewsTestCase(APITestCase):
         logger.debug('test_reset_password_view_200 response: ' + str(response.json()))
         self.assertEqual(200, response.status_code, "Should return 200, since current password is correct")
 
+    def test_reset_password_view_stale_user(self):
+        """
+        Test case when the user changed since its access token was cached, only the password should be written
+        :return:
+        """
+        self.client.post(self.device_list_url)  # Caches the access token and its user
+        User.objects.filter(pk=self.user.pk).update(user_name='changed_user_name')
+
+        response = self.client.post(self.reset_password_url, data={'current_password': self.password,
+                                                                   'new_password': 'new_password'})
+        self.assertEqual(200, response.status_code)
+        user = User.objects.get(pk=self.user.pk)
+        self.assertEqual(user.user_name, 'changed_user_name', "Should not write back cached user fields")
+        self.assertTrue(user.check_password('new_password'))
+
     def test_update_mqtt_user_pass_view_200(self):
         """
         Test case when pass updates successfully